@@ -348,6 +348,44 @@ class OscCollabProject(dict):
 #######################################################################
 
 
+# Same rules as version_key() in the util.py module of the server, so that
+# versions are compared the same way everywhere.
+_osc_collab_re_version_part = re.compile('([0-9]*)(.*)', re.DOTALL)
+_osc_collab_version_keys = {}
+
+def _collab_version_key(version):
+    """ Return a key for version, so that versions can be compared by
+        comparing their keys.
+
+        Versions are split in fields on '-' and in parts on '.'. Parts are
+        compared by their leading number, and then by what follows it; a
+        part without leading number is older than a part with one. When
+        everything else is equal, the version with more parts (or fields)
+        wins.
+
+    """
+    if version in _osc_collab_version_keys:
+        return _osc_collab_version_keys[version]
+
+    key = []
+    for field in version.split('-'):
+        parts = []
+        for part in field.split('.'):
+            (number, rest) = _osc_collab_re_version_part.match(part).groups()
+            if number:
+                parts.append((1, int(number), rest))
+            else:
+                parts.append((0, 0, rest))
+        key.append(tuple(parts))
+    key = tuple(key)
+
+    _osc_collab_version_keys[version] = key
+    return key
+
+
+#######################################################################
+
+
 class OscCollabPackage:
 
     def __init__(self, node, project):
@@ -427,29 +465,10 @@ class OscCollabPackage:
             # upstream version
             return rpm.labelCompare((None, a, '1'), (None, b, '1')) > 0
 
-        split_a = a.split('.')
-        split_b = b.split('.')
-
-        # the two versions don't have the same format; we don't know how to
-        # handle this
-        if len(split_a) != len(split_b):
-            return a > b
-
-        for i in range(len(split_a)):
-            try:
-                int_a = int(split_a[i])
-                int_b = int(split_b[i])
-                if int_a > int_b:
-                    return True
-                if int_b > int_a:
-                    return False
-            except ValueError:
-                if split_a[i] > split_b[i]:
-                    return True
-                if split_b[i] > split_a[i]:
-                    return False
+        if a == b:
+            return False
 
-        return False
+        return _collab_version_key(a) > _collab_version_key(b)
 
 
     def parent_more_recent(self):
@@ -147,6 +147,8 @@ class Config:
         self.no_full_check = False
         self.allow_project_catchup = False
         self.threads = 10
+        self.processes = 0
+        self.spec_cache_size = 50000
         self.sockettimeout = 30
         self.threads_sockettimeout = 30
 
@@ -269,6 +271,8 @@ class Config:
         self.no_full_check = cp.safe_getboolean('General', 'no-full-check', self.no_full_check)
         self.allow_project_catchup = cp.safe_getboolean('General', 'allow-project-catchup', self.allow_project_catchup)
         self.threads = cp.safe_getint('General', 'threads', self.threads)
+        self.processes = cp.safe_getint('General', 'processes', self.processes)
+        self.spec_cache_size = cp.safe_getint('General', 'spec-cache-size', self.spec_cache_size)
         self.sockettimeout = cp.safe_getint('General', 'sockettimeout', self.sockettimeout)
         self.threads_sockettimeout = cp.safe_getint('General', 'threads-sockettimeout', self.threads_sockettimeout)
 
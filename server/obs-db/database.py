@@ -37,9 +37,17 @@
 import os
 import sys
 
+import hashlib
+import collections
+import itertools
+import multiprocessing
 import operator
+import queue
 import re
 import sqlite3
+import threading
+import time
+import uuid
 
 try:
     from lxml import etree as ET
@@ -49,6 +57,7 @@ except ImportError:
     except ImportError:
         import cElementTree as ET
 
+import speccache
 import upstream
 import util
 
@@ -72,7 +81,59 @@ RPMLINT_ERRORS_PATH = ''
 DB_MAJOR = 4
 # Changing this means changing the db while keeping compatibility
 # Increase when changing the db. Reset to 0 when changing DB_MAJOR.
-DB_MINOR = 0
+DB_MINOR = 8
+
+# Increase when changing the way packages are analyzed, so that packages that
+# were analyzed before get analyzed again (see SrcPackage.get_fingerprint())
+ANALYSIS_VERSION = 1
+# Increase when changing the way spec files are parsed. This invalidates the
+# spec cache, and the analysis of all packages.
+SPEC_PARSER_VERSION = 3
+
+# Errors that are only set by ObsDb.post_analyze(). Those errors depend on
+# other packages, and they replace the errors from the analysis of the package
+# itself, so a package with such an error always needs to be analyzed again.
+POST_ANALYSIS_ERRORS = [ 'not-link-not-in-parent', 'not-real-devel', 'parent-without-devel' ]
+
+# Size of the page cache of the database, in kB
+DB_CACHE_SIZE = 64 * 1024
+# Size of the database that can be accessed through mmap, in bytes
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Maximum number of changed source packages for which the post-analysis only
+# looks at the source packages depending on them; above this, all source
+# packages are looked at, as this is faster
+POST_ANALYSIS_INCREMENTAL_MAX = 1000
+
+# Maximum number of values in a "IN (...)" SQL expression, since sqlite limits
+# the number of parameters of a query
+SQL_IN_CHUNK_SIZE = 500
+
+# Number of source packages sent at once to a worker process when analyzing
+# the mirror
+ANALYSIS_CHUNK_SIZE = 16
+# Maximum number of chunks of source packages being analyzed, or waiting to be
+# consumed, at the same time
+ANALYSIS_PENDING_CHUNKS = 64
+# Maximum number of objects waiting to be written by the writer thread
+WRITER_QUEUE_SIZE = 2000
+# Maximum number of objects taken at once from its queue by the writer thread
+WRITER_BATCH_SIZE = 500
+# Number of queued rows after which the writer thread writes them
+WRITER_FLUSH_ROWS = 20000
+
+# Number of runs for which the changes are kept, see ObsDb.get_changes_since()
+CHANGES_MAX_RUNS = 1000
+
+# Kinds of changes recorded for source packages and projects
+CHANGE_ADD = 'add'
+CHANGE_UPDATE = 'update'
+CHANGE_REMOVE = 'remove'
+CHANGE_UPSTREAM = 'upstream'
+CHANGE_ANALYSIS = 'analysis'
+# A project stopped depending on a changed project (for its XML), see
+# ObsDb._update_project_dependencies()
+CHANGE_DEPENDENCY = 'dependency'
 
 
 #######################################################################
@@ -82,32 +143,128 @@ class ObsDbException(Exception):
 
 #######################################################################
 
+class SqlBatch:
+    """ Collect rows to insert, and write them with executemany().
+
+        Ids are assigned when rows are added, from a range starting after the
+        biggest id already used in each table. Therefore, nothing else must be
+        inserted in those tables until flush() is called.
+
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.size = 0
+
+        self._next_ids = {}
+        # this is ordered by first use, which ensures we insert rows in
+        # parent tables before rows referencing them
+        self._rows = {}
+
+    def _allocate_id(self, table):
+        if table not in self._next_ids:
+            self.cursor.execute('''SELECT MAX(id) FROM %s;''' % table)
+            self._next_ids[table] = (self.cursor.fetchone()[0] or 0) + 1
+
+        id = self._next_ids[table]
+        self._next_ids[table] = id + 1
+        return id
+
+    def add(self, obj, row):
+        """ Queue row (without the id) for obj, and set the id of obj. """
+        table = obj.sql_table
+
+        obj.sql_id = self._allocate_id(table)
+        obj.__class__.sql_lastid = obj.sql_id
+
+        if table not in self._rows:
+            self._rows[table] = []
+        self._rows[table].append((obj.sql_id,) + tuple(row))
+        self.size += 1
+
+    def flush(self):
+        """ Write all queued rows. """
+        for (table, rows) in self._rows.items():
+            if not rows:
+                continue
+            self.cursor.executemany('''INSERT INTO %s VALUES (
+                %s
+                );''' % (table, ', '.join([ '?' ] * len(rows[0]))),
+                rows)
+            # keep the key so that the order of tables is kept
+            self._rows[table] = []
+
+        self.size = 0
+
+#######################################################################
+
 class Base:
     sql_table = 'undefined'
     sql_lastid = -1
 
+    # There can be millions of instances of the subclasses during a rebuild,
+    # so they use __slots__ instead of a per-instance __dict__. Subclasses
+    # must list all the attributes they use.
+    __slots__ = ('sql_id',)
+
     @classmethod
     def sql_setup(cls, cursor):
         pass
 
+    @classmethod
+    def _sql_create_index(cls, cursor, columns):
+        """ Create an index on columns (a list of column names). """
+        cursor.execute('''CREATE INDEX %s_%s ON %s (%s);''' % (cls.sql_table, '_'.join(columns), cls.sql_table, ', '.join(columns)))
+
+    @classmethod
+    def _sql_remove_where(cls, cursor, column, values):
+        """ Remove all rows where column is one of values (or is values). """
+        if type(values) != list:
+            values = [ values ]
+        cursor.executemany('''DELETE FROM %s WHERE
+            %s = ?
+            ;''' % (cls.sql_table, column),
+            [ (value,) for value in values ])
+
     def _sql_update_last_id(self, cursor):
         cursor.execute('''SELECT last_insert_rowid();''')
         self.sql_id = cursor.fetchone()[0]
         self.__class__.sql_lastid = self.sql_id
 
+    def _sql_add_row(self, cursor, batch, row):
+        """ Add row (without the id) for this object, possibly via batch. """
+        if batch is not None:
+            batch.add(self, row)
+            return
+
+        cursor.execute('''INSERT INTO %s VALUES (
+            NULL, %s
+            );''' % (self.sql_table, ', '.join([ '?' ] * len(row))),
+            row)
+        self._sql_update_last_id(cursor)
+
 #######################################################################
 
 class File(Base):
     sql_table = 'file'
 
+    __slots__ = ('filename', 'mtime', 'src_package')
+
     @classmethod
     def sql_setup(cls, cursor):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
             filename TEXT,
             mtime INTEGER,
-            srcpackage INTEGER
-            );''' % cls.sql_table)
+            srcpackage INTEGER REFERENCES %s (id) ON DELETE CASCADE
+            );''' % (cls.sql_table, SrcPackage.sql_table))
+        cls._sql_create_index(cursor, [ 'srcpackage' ])
+
+    @classmethod
+    def _sql_get_from_row(cls, srcpackage, row):
+        file = File(srcpackage, row['filename'], row['mtime'])
+        file.sql_id = row['id']
+        return file
 
     @classmethod
     def sql_get_all(cls, cursor, srcpackage):
@@ -118,26 +275,11 @@ class File(Base):
             ;''' % cls.sql_table,
             (srcpackage.sql_id,))
 
-        for row in cursor.fetchall():
-            file = File(srcpackage, row['filename'], row['mtime'])
-            file.sql_id = row['id']
-            files.append(file)
+        for row in cursor:
+            files.append(cls._sql_get_from_row(srcpackage, row))
 
         return files
 
-    @classmethod
-    def sql_remove_all(cls, cursor, ids):
-        if type(ids) == list:
-            where = ' OR '.join([ 'srcpackage = ?' for i in range(len(ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                srcpackage = ?
-                ;''' % cls.sql_table,
-                (ids,))
-
     def __init__(self, src, name, mtime):
         self.sql_id = -1
 
@@ -149,14 +291,11 @@ class File(Base):
             print('Cannot parse %s as mtime for %s/%s: %s' % (mtime, src, name, e), file=sys.stderr)
             self.mtime = -1
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
         if self.src_package.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding file %s.' % (self.src_package.name, self.filename))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?, ?, ?
-            );''' % self.sql_table,
+        self._sql_add_row(cursor, batch,
             (self.filename, self.mtime, self.src_package.sql_id))
-        self._sql_update_last_id(cursor)
 
     def sql_update_from(self, cursor, new_file):
         if self.sql_id < 0:
@@ -192,14 +331,23 @@ class File(Base):
 class Source(Base):
     sql_table = 'source'
 
+    __slots__ = ('filename', 'number', 'src_package')
+
     @classmethod
     def sql_setup(cls, cursor):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
             filename TEXT,
-            srcpackage INTEGER,
+            srcpackage INTEGER REFERENCES %s (id) ON DELETE CASCADE,
             nb_in_pack INTEGER
-            );''' % cls.sql_table)
+            );''' % (cls.sql_table, SrcPackage.sql_table))
+        cls._sql_create_index(cursor, [ 'srcpackage' ])
+
+    @classmethod
+    def _sql_get_from_row(cls, srcpackage, row):
+        source = Source(srcpackage, row['filename'], row['nb_in_pack'])
+        source.sql_id = row['id']
+        return source
 
     @classmethod
     def sql_get_all(cls, cursor, srcpackage):
@@ -210,26 +358,11 @@ class Source(Base):
             ;''' % cls.sql_table,
             (srcpackage.sql_id,))
 
-        for row in cursor.fetchall():
-            source = Source(srcpackage, row['filename'], row['nb_in_pack'])
-            source.sql_id = row['id']
-            sources.append(source)
+        for row in cursor:
+            sources.append(cls._sql_get_from_row(srcpackage, row))
 
         return sources
 
-    @classmethod
-    def sql_remove_all(cls, cursor, ids):
-        if type(ids) == list:
-            where = ' OR '.join([ 'srcpackage = ?' for i in range(len(ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                srcpackage = ?
-                ;''' % cls.sql_table,
-                (ids,))
-
     def __init__(self, src, name, i):
         self.sql_id = -1
 
@@ -237,14 +370,11 @@ class Source(Base):
         self.src_package = src
         self.number = i
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
         if self.src_package.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding source %s.' % (self.src_package.name, self.filename))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?, ?, ?
-            );''' % self.sql_table,
+        self._sql_add_row(cursor, batch,
             (self.filename, self.src_package.sql_id, self.number))
-        self._sql_update_last_id(cursor)
 
     def sql_update_from(self, cursor, new_source):
         if self.sql_id < 0:
@@ -281,6 +411,10 @@ class Source(Base):
 class Patch(Base):
     sql_table = 'patch'
 
+    __slots__ = ('filename', 'number', 'apply_order', 'disabled', 'src_package',
+                 'tag', 'tag_filename', 'short_descr', 'descr',
+                 'bnc', 'bgo', 'bmo', 'bln', 'brc', 'fate', 'cve')
+
     # Format of tag is: "# PATCH-{FIX|FEATURE}-{OPENSUSE|SLED|UPSTREAM} name-of-file.patch bncb.novell.com_bug_number bgob.gnome.org_bug_number you@example.com -- this patch..."
     # PATCH-NEEDS-REBASE is also a known tag
     # We remove trailing ':' for tags too...
@@ -299,7 +433,7 @@ class Patch(Base):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
             filename TEXT,
-            srcpackage INTEGER,
+            srcpackage INTEGER REFERENCES %s (id) ON DELETE CASCADE,
             nb_in_pack INTEGER,
             apply_order INTEGER,
             disabled INTEGER,
@@ -314,7 +448,26 @@ class Patch(Base):
             brc INTEGER,
             fate INTEGER,
             cve INTEGER
-            );''' % cls.sql_table)
+            );''' % (cls.sql_table, SrcPackage.sql_table))
+        cls._sql_create_index(cursor, [ 'srcpackage' ])
+
+    @classmethod
+    def _sql_get_from_row(cls, srcpackage, row):
+        patch = Patch(srcpackage, row['filename'], row['nb_in_pack'], row['disabled'])
+        patch.sql_id = row['id']
+        patch.apply_order = row['apply_order']
+        patch.tag = row['tag']
+        patch.tag_filename = row['tag_filename']
+        patch.bnc = row['bnc']
+        patch.bgo = row['bgo']
+        patch.bmo = row['bmo']
+        patch.bln = row['bln']
+        patch.brc = row['brc']
+        patch.fate = row['fate']
+        patch.cve = row['cve']
+        patch.short_descr = row['short_descr']
+        patch.descr = row['descr']
+        return patch
 
     @classmethod
     def sql_get_all(cls, cursor, srcpackage):
@@ -325,38 +478,11 @@ class Patch(Base):
             ;''' % cls.sql_table,
             (srcpackage.sql_id,))
 
-        for row in cursor.fetchall():
-            patch = Patch(srcpackage, row['filename'], row['nb_in_pack'], row['disabled'])
-            patch.sql_id = row['id']
-            patch.apply_order = row['apply_order']
-            patch.tag = row['tag']
-            patch.tag_filename = row['tag_filename']
-            patch.bnc = row['bnc']
-            patch.bgo = row['bgo']
-            patch.bmo = row['bmo']
-            patch.bln = row['bln']
-            patch.brc = row['brc']
-            patch.fate = row['fate']
-            patch.cve = row['cve']
-            patch.short_descr = row['short_descr']
-            patch.descr = row['descr']
-            patches.append(patch)
+        for row in cursor:
+            patches.append(cls._sql_get_from_row(srcpackage, row))
 
         return patches
 
-    @classmethod
-    def sql_remove_all(cls, cursor, ids):
-        if type(ids) == list:
-            where = ' OR '.join([ 'srcpackage = ?' for i in range(len(ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                srcpackage = ?
-                ;''' % cls.sql_table,
-                (ids,))
-
     def __init__(self, src, name, i, disabled=True):
         self.sql_id = -1
 
@@ -436,18 +562,13 @@ class Patch(Base):
         else:
             self.disabled = 0
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
         if self.src_package.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding patch %s.' % (self.src_package.name, self.filename))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?, ?, ?, ?, ?,
-            ?, ?, ?, ?,
-            ?, ?, ?, ?, ?, ?, ?
-            );''' % self.sql_table,
+        self._sql_add_row(cursor, batch,
             (self.filename, self.src_package.sql_id, self.number, self.apply_order, self.disabled,
              self.tag, self.tag_filename, self.short_descr, self.descr,
              self.bnc, self.bgo, self.bmo, self.bln, self.brc, self.fate, self.cve))
-        self._sql_update_last_id(cursor)
 
     def sql_update_from(self, cursor, new_patch):
         if self.sql_id < 0:
@@ -512,6 +633,8 @@ class Patch(Base):
 
 class RpmlintReport(Base):
     sql_table = 'rpmlint'
+
+    __slots__ = ('src_package', 'level', 'type', 'detail', 'descr')
     re_rpmlint = re.compile('\s*(.+):\s+(.):\s+(\S+)\s+(\S*)(?:\s+.*)?')
     re_rpmlint_summary = re.compile('\s*\d+\s+packages\s+and\s+\d+\s+spec\s*files\s+checked\s*;')
 
@@ -519,12 +642,20 @@ class RpmlintReport(Base):
     def sql_setup(cls, cursor):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
-            srcpackage INTEGER,
+            srcpackage INTEGER REFERENCES %s (id) ON DELETE CASCADE,
             level TEXT,
             type TEXT,
             detail TEXT,
             descr TEXT
-            );''' % cls.sql_table)
+            );''' % (cls.sql_table, SrcPackage.sql_table))
+        cls._sql_create_index(cursor, [ 'srcpackage' ])
+
+    @classmethod
+    def _sql_get_from_row(cls, srcpackage, row):
+        rpmlint = RpmlintReport(srcpackage, row['level'], row['type'], row['detail'])
+        rpmlint.sql_id = row['id']
+        rpmlint.descr = row['descr']
+        return rpmlint
 
     @classmethod
     def sql_get_all(cls, cursor, srcpackage):
@@ -535,27 +666,11 @@ class RpmlintReport(Base):
             ;''' % cls.sql_table,
             (srcpackage.sql_id,))
 
-        for row in cursor.fetchall():
-            rpmlint = RpmlintReport(srcpackage, row['level'], row['type'], row['detail'])
-            rpmlint.sql_id = row['id']
-            rpmlint.descr = row['descr']
-            rpmlints.append(rpmlint)
+        for row in cursor:
+            rpmlints.append(cls._sql_get_from_row(srcpackage, row))
 
         return rpmlints
 
-    @classmethod
-    def sql_remove_all(cls, cursor, ids):
-        if type(ids) == list:
-            where = ' OR '.join([ 'srcpackage = ?' for i in range(len(ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                srcpackage = ?
-                ;''' % cls.sql_table,
-                (ids,))
-
     @classmethod
     def analyze(cls, srcpackage, filepath):
         rpmlints = []
@@ -674,16 +789,12 @@ class RpmlintReport(Base):
         self.detail = detail
         self.descr = None
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
         if self.src_package.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding rpmlint report.' % (self.src_package.name,))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?,
-            ?, ?, ?, ?
-            );''' % self.sql_table,
+        self._sql_add_row(cursor, batch,
             (self.src_package.sql_id,
              self.level, self.type, self.detail, self.descr))
-        self._sql_update_last_id(cursor)
 
     def sql_update_from(self, cursor, new_report):
         raise ObsDbException('Rpmlint reports cannot be updated since they do not change with time (they get added or removed).')
@@ -718,15 +829,26 @@ class RpmlintReport(Base):
 class Package(Base):
     sql_table = 'package'
 
+    __slots__ = ('name', 'src_package', 'summary', 'description')
+
     @classmethod
     def sql_setup(cls, cursor):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
             name TEXT,
-            srcpackage INTEGER,
+            srcpackage INTEGER REFERENCES %s (id) ON DELETE CASCADE,
             summary TEXT,
             description TEXT
-            );''' % cls.sql_table)
+            );''' % (cls.sql_table, SrcPackage.sql_table))
+        cls._sql_create_index(cursor, [ 'srcpackage' ])
+
+    @classmethod
+    def _sql_get_from_row(cls, srcpackage, row):
+        package = Package(srcpackage, row['name'])
+        package.sql_id = row['id']
+        package.summary = row['summary']
+        package.description = row['description']
+        return package
 
     @classmethod
     def sql_get_all(cls, cursor, srcpackage):
@@ -737,28 +859,11 @@ class Package(Base):
             ;''' % cls.sql_table,
             (srcpackage.sql_id,))
 
-        for row in cursor.fetchall():
-            package = Package(srcpackage, row['name'])
-            package.sql_id = row['id']
-            package.summary = row['summary']
-            package.description = row['description']
-            packages.append(package)
+        for row in cursor:
+            packages.append(cls._sql_get_from_row(srcpackage, row))
 
         return packages
 
-    @classmethod
-    def sql_remove_all(cls, cursor, ids):
-        if type(ids) == list:
-            where = ' OR '.join([ 'srcpackage = ?' for i in range(len(ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                srcpackage = ?
-                ;''' % cls.sql_table,
-                (ids,))
-
     def __init__(self, src, name):
         self.sql_id = -1
 
@@ -768,16 +873,12 @@ class Package(Base):
 #FIXME we don't parse the descriptions right now
         self.description = ''
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
         if self.src_package.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding package %s.' % (self.src_package.name, self.name))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?, ?,
-            ?, ?
-            );''' % self.sql_table,
+        self._sql_add_row(cursor, batch,
             (self.name, self.src_package.sql_id,
              self.summary, self.description))
-        self._sql_update_last_id(cursor)
 
     def sql_update_from(self, cursor, new_package):
         if self.sql_id < 0:
@@ -828,28 +929,205 @@ class Package(Base):
 
 #######################################################################
 
+def _get_files_header(srcpackage_dir):
+    """ Return the beginning of the file list of a package, until the first entry.
+
+        This contains the srcmd5 of the package and the link information, and
+        it's much faster to get than parsing the whole file.
+
+    """
+    filename = '_files-expanded'
+    files = os.path.join(srcpackage_dir, filename)
+    if not os.path.exists(files):
+        filename = '_files'
+        files = os.path.join(srcpackage_dir, filename)
+    if not os.path.exists(files):
+        return b''
+
+    header = b''
+    file = open(files, 'rb')
+    while True:
+        data = file.read(4096)
+        header += data
+        index = header.find(b'<entry')
+        if index != -1:
+            header = header[:index]
+            break
+        if not data:
+            break
+    file.close()
+
+    return filename.encode('utf-8') + b':' + header
+
+
+def _get_mtime(path):
+    """ Return the mtime of path, as a string, or '' if it doesn't exist. """
+    try:
+        return repr(os.stat(path).st_mtime)
+    except OSError:
+        return ''
+
+
+#######################################################################
+
+# Caches used when comparing packages with their parent package. They live for
+# one run (see reset_analysis_caches()), and each worker process has its own.
+#
+# Manifests (filename -> md5) of packages of parent projects, by parent
+# project directory and then by package name. The stat of the file list is
+# kept to detect changes in the mirror.
+_parent_manifests = {}
+# Digest of a spec file once normalized by _read_lenient_spec(), by md5 of the
+# spec file (as found in the file list).
+_lenient_spec_digests = {}
+
+
+def reset_analysis_caches():
+    """ Forget all data cached while analyzing packages. """
+    _parent_manifests.clear()
+    _lenient_spec_digests.clear()
+
+
+def _get_files_list(srcpackage_dir):
+    """ Return the path of the file list of a package. """
+    files = os.path.join(srcpackage_dir, '_files-expanded')
+    if not os.path.exists(files):
+        files = os.path.join(srcpackage_dir, '_files')
+    return files
+
+
+def _get_manifest(root):
+    """ Return a dict filename -> md5 for the file list root. """
+    manifest = {}
+    for node in root.findall('entry'):
+        filename = node.get('name')
+        if filename in IGNORE_FILES:
+            continue
+        manifest[filename] = node.get('md5')
+    return manifest
+
+
+def _get_parent_manifest(parent_project_dir, name):
+    """ Return the manifest of a package of a parent project, or None.
+
+        The file list of the package is only parsed if it changed since the
+        last call.
+
+    """
+    files = _get_files_list(os.path.join(parent_project_dir, name))
+    try:
+        st = os.stat(files)
+    except OSError:
+        return None
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    manifests = _parent_manifests.setdefault(os.path.normpath(parent_project_dir), {})
+    if name in manifests and manifests[name][0] == stat_key:
+        return manifests[name][1]
+
+    try:
+        manifest = _get_manifest(ET.parse(files).getroot())
+    except SyntaxError as e:
+        print('Cannot parse %s: %s' % (files, e), file=sys.stderr)
+        manifest = None
+
+    manifests[name] = (stat_key, manifest)
+    return manifest
+
+
+def _read_lenient_spec(spec):
+    '''
+        Return the lines of a spec file that matter when comparing it with
+        another spec file, ignoring some useless changes:
+         - ignore space changes
+         - ignore blank lines
+         - ignore comments
+         - ignore Release tag
+         - ignore %changelog
+    '''
+    lines = []
+
+    # surrogateescape: invalid UTF-8 is kept as-is, and can be compared
+    file = open(spec, encoding = 'utf-8', errors = 'surrogateescape')
+    for line in file:
+        line = ' '.join(line[:-1].split())
+        if not line:
+            continue
+        if line[0] == '#':
+            continue
+        if line.startswith('Release:'):
+            continue
+        if line == '%changelog':
+            break
+        lines.append(line)
+    file.close()
+
+    return lines
+
+
+def _get_lenient_spec_digest(spec, md5):
+    """ Return a digest of the normalized content of a spec file, or None if it doesn't exist.
+
+        md5 -- The md5 of the spec file, from the file list. Can be None.
+
+    """
+    if md5 and md5 in _lenient_spec_digests:
+        return _lenient_spec_digests[md5]
+
+    if not os.path.exists(spec):
+        return None
+
+    digest = hashlib.md5()
+    for line in _read_lenient_spec(spec):
+        digest.update(line.encode('utf-8', 'surrogateescape'))
+        digest.update(b'\n')
+    digest = digest.hexdigest()
+
+    if md5:
+        _lenient_spec_digests[md5] = digest
+    return digest
+
+
+#######################################################################
+
 class SrcPackage(Base):
     sql_table = 'srcpackage'
 
-    re_spec_define = re.compile('^%define\s+(\S*)\s+(\S*)', re.IGNORECASE)
-    re_spec_name = re.compile('^Name:\s*(\S*)', re.IGNORECASE)
-    re_spec_version = re.compile('^Version:\s*(\S*)', re.IGNORECASE)
-    re_spec_summary = re.compile('^Summary:\s*(.*)', re.IGNORECASE)
-    re_spec_source = re.compile('^Source(\d*):\s*(\S*)', re.IGNORECASE)
-    re_spec_patch = re.compile('^((?:#[#\s]*)?)Patch(\d*):\s*(\S*)', re.IGNORECASE)
-    re_spec_package = re.compile('^%package\s*(\S.*)', re.IGNORECASE)
+    __slots__ = ('name', 'project', 'srcmd5', 'version',
+                 'upstream_name', 'upstream_version', 'upstream_url',
+                 'packages', 'sources', 'patches', 'files', 'rpmlint_reports',
+                 'link_project', 'link_package', 'devel_project', 'devel_package',
+                 'is_link', 'has_delta', 'error', 'error_details',
+                 'has_branch', 'has_meta', 'fingerprint',
+                 '_spec_cache_entry', '_ready_for_sql')
+
+    # The lines of the preamble we're interested in. Each alternative has a
+    # named group, so that lastgroup tells us which one matched; they're
+    # tried in order, so the first one wins.
+    re_spec_preamble = re.compile('''^(?:
+        (?P<prep>%prep)
+        | (?P<define>%define\s+(\S*)\s+(\S*))
+        | (?P<name>Name:\s*(\S*))
+        | (?P<lang_package>%lang_package)
+        | (?P<package>%package\s*(\S.*))
+        | (?P<version>Version:\s*(\S*))
+        | (?P<summary>Summary:\s*(.*))
+        | (?P<source>Source(\d*):\s*(\S*))
+        | (?P<patch>((?:\#[\#\s]*)?)Patch(\d*):\s*(\S*))
+        )''', re.IGNORECASE | re.VERBOSE)
     re_spec_package2 = re.compile('^-n\s*(\S*)', re.IGNORECASE)
-    re_spec_lang_package = re.compile('^%lang_package', re.IGNORECASE)
-    re_spec_prep = re.compile('^%prep', re.IGNORECASE)
-    re_spec_build = re.compile('^%build', re.IGNORECASE)
-    re_spec_apply_patch = re.compile('^((?:#[#\s]*)?)%patch(\d*)', re.IGNORECASE)
+    # The lines of %prep we're interested in
+    re_spec_prep_section = re.compile('''^(?:
+        (?P<build>%build)
+        | (?P<apply_patch>((?:\#[\#\s]*)?)%patch(\d*))
+        )''', re.IGNORECASE | re.VERBOSE)
 
     @classmethod
     def sql_setup(cls, cursor):
         cursor.execute('''CREATE TABLE %s (
             id INTEGER PRIMARY KEY,
             name TEXT,
-            project INTEGER,
+            project INTEGER REFERENCES %s (id) ON DELETE CASCADE,
             srcmd5 TEXT,
             version TEXT,
             link_project TEXT,
@@ -862,8 +1140,14 @@ class SrcPackage(Base):
             is_obs_link INTEGER,
             obs_link_has_delta INTEGER,
             obs_error TEXT,
-            obs_error_details TEXT
-            );''' % cls.sql_table)
+            obs_error_details TEXT,
+            fingerprint TEXT
+            );''' % (cls.sql_table, Project.sql_table))
+        cls._sql_create_index(cursor, [ 'project' ])
+        # used to find the source packages depending on a changed source
+        # package, in ObsDb.post_analyze()
+        cls._sql_create_index(cursor, [ 'name' ])
+        cls._sql_create_index(cursor, [ 'link_project', 'link_package' ])
 
     def _sql_fill(self, cursor):
         self.files = File.sql_get_all(cursor, self)
@@ -887,9 +1171,11 @@ class SrcPackage(Base):
         pkg_object.upstream_version = row['upstream_version']
         pkg_object.upstream_url = row['upstream_url']
         pkg_object.is_link = row['is_obs_link'] != 0
-        pkg_object.has_delta = row['obs_link_has_delta'] != 0
+        # not a boolean: see comment in __init__()
+        pkg_object.has_delta = row['obs_link_has_delta']
         pkg_object.error = row['obs_error']
         pkg_object.error_details = row['obs_error_details']
+        pkg_object.fingerprint = row['fingerprint']
 
         if recursive:
             pkg_object._sql_fill(cursor)
@@ -923,51 +1209,47 @@ class SrcPackage(Base):
             ;''' % cls.sql_table,
             (project.sql_id,))
 
-        for row in cursor.fetchall():
+        for row in cursor:
             srcpackage = cls._sql_get_from_row(cursor, project, row, False)
             srcpackages.append(srcpackage)
 
         if recursive:
-            # we do a second loop so we can use only one cursor, that shouldn't
-            # matter much since the loop is not the slow part
-            for srcpackage in srcpackages:
-                srcpackage._sql_fill(cursor)
+            cls._sql_fill_all(cursor, project, srcpackages)
 
         return srcpackages
 
     @classmethod
-    def sql_remove_all(cls, cursor, project_ids):
-        if type(project_ids) == list:
-            where = ' OR '.join([ 'project = ?' for i in range(len(project_ids)) ])
-            cursor.execute('''SELECT id FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                project_ids)
-        else:
-            cursor.execute('''SELECT id FROM %s WHERE
-                project = ?
-                ;''' % cls.sql_table,
-                (project_ids,))
+    def _sql_fill_all(cls, cursor, project, srcpackages):
+        """ Fill the children of all source packages of project.
 
-        ids = [ id for (id,) in cursor.fetchall() ]
-        if not ids:
-            return
+            This does one query per table, instead of one query per table and
+            per source package.
 
-        Package.sql_remove_all(cursor, ids)
-        RpmlintReport.sql_remove_all(cursor, ids)
-        Source.sql_remove_all(cursor, ids)
-        Patch.sql_remove_all(cursor, ids)
-        File.sql_remove_all(cursor, ids)
-
-        if type(project_ids) == list:
-            where = ' OR '.join([ 'project = ?' for i in range(len(project_ids)) ])
-            cursor.execute('''DELETE FROM %s WHERE
-                %s;''' % (cls.sql_table, where),
-                project_ids)
-        else:
-            cursor.execute('''DELETE FROM %s WHERE
-                project = ?
-                ;''' % cls.sql_table,
-                (project_ids,))
+        """
+        srcpackages_by_id = {}
+        for srcpackage in srcpackages:
+            srcpackage.files = []
+            srcpackage.sources = []
+            srcpackage.patches = []
+            srcpackage.rpmlint_reports = []
+            srcpackage.packages = []
+            srcpackages_by_id[srcpackage.sql_id] = srcpackage
+
+        for (child_cls, attr) in [ (File, 'files'),
+                                   (Source, 'sources'),
+                                   (Patch, 'patches'),
+                                   (RpmlintReport, 'rpmlint_reports'),
+                                   (Package, 'packages') ]:
+            cursor.execute('''SELECT B.* FROM %s AS A, %s AS B WHERE
+                A.project = ? AND
+                B.srcpackage = A.id
+                ORDER BY B.id
+                ;''' % (cls.sql_table, child_cls.sql_table),
+                (project.sql_id,))
+
+            for row in cursor:
+                srcpackage = srcpackages_by_id[row['srcpackage']]
+                getattr(srcpackage, attr).append(child_cls._sql_get_from_row(srcpackage, row))
 
     @classmethod
     def sql_simple_remove(cls, cursor, project, package):
@@ -980,18 +1262,12 @@ class SrcPackage(Base):
 
         ids = [ id for (id,) in cursor.fetchall() ]
         if not ids:
-            return
+            return ids
 
-        Package.sql_remove_all(cursor, ids)
-        RpmlintReport.sql_remove_all(cursor, ids)
-        Source.sql_remove_all(cursor, ids)
-        Patch.sql_remove_all(cursor, ids)
-        File.sql_remove_all(cursor, ids)
+        # the children are removed by the database (ON DELETE CASCADE)
+        cls._sql_remove_where(cursor, 'id', ids)
 
-        where = ' OR '.join([ 'id = ?' for i in range(len(ids)) ])
-        cursor.execute('''DELETE FROM %s WHERE
-            %s;''' % (cls.sql_table, where),
-            ids)
+        return ids
 
     def __init__(self, name, project):
         self.sql_id = -1
@@ -1029,37 +1305,76 @@ class SrcPackage(Base):
         # there's a local _meta file for this package
         self.has_meta = False
 
+        # see get_fingerprint()
+        self.fingerprint = ''
+        # (key, analysis) to save in the spec cache, once we're back in the
+        # main process; analysis is None if it was found in the cache
+        self._spec_cache_entry = None
+
         self._ready_for_sql = False
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
+        """ Add the source package and its children to the database.
+
+            batch -- A SqlBatch used to add rows. If None, a batch is created
+                     for this source package only.
+
+        """
         if not self._ready_for_sql:
             raise ObsDbException('Source package %s is a shim object, not to be put in database.' % (self.name,))
 
         if self.project.sql_id == -1:
             raise ObsDbException('No SQL id for %s when adding source package %s.' % (self.project.name, self.name))
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL,
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-            );''' % self.sql_table,
-            (self.name, self.project.sql_id, self.srcmd5, self.version, self.link_project, self.link_package, self.devel_project, self.devel_package, self.upstream_name, self.upstream_version, self.upstream_url, self.is_link, self.has_delta, self.error, self.error_details))
-        self._sql_update_last_id(cursor)
+
+        own_batch = batch is None
+        if own_batch:
+            batch = SqlBatch(cursor)
+
+        self._sql_add_row(cursor, batch,
+            (self.name, self.project.sql_id, self.srcmd5, self.version, self.link_project, self.link_package, self.devel_project, self.devel_package, self.upstream_name, self.upstream_version, self.upstream_url, self.is_link, self.has_delta, self.error, self.error_details, self.fingerprint))
 
         for package in self.packages:
-            package.sql_add(cursor)
+            package.sql_add(cursor, batch)
 
         for rpmlint in self.rpmlint_reports:
-            rpmlint.sql_add(cursor)
+            rpmlint.sql_add(cursor, batch)
 
         for source in self.sources:
-            source.sql_add(cursor)
+            source.sql_add(cursor, batch)
 
         for patch in self.patches:
-            patch.sql_add(cursor)
+            patch.sql_add(cursor, batch)
 
         for file in self.files:
-            file.sql_add(cursor)
+            file.sql_add(cursor, batch)
+
+        if own_batch:
+            batch.flush()
+
+    def _sql_row_differs(self, other):
+        """ Return True if the row of other in the srcpackage table would differ. """
+        # we obviously don't need to compare the id, the name or the project
+        return (self.srcmd5 != other.srcmd5 or
+                self.version != other.version or
+                self.link_project != other.link_project or
+                self.link_package != other.link_package or
+                self.devel_project != other.devel_project or
+                self.devel_package != other.devel_package or
+                self.upstream_name != other.upstream_name or
+                self.upstream_version != other.upstream_version or
+                self.upstream_url != other.upstream_url or
+                self.is_link != other.is_link or
+                self.has_delta != other.has_delta or
+                self.error != other.error or
+                self.error_details != other.error_details)
 
     def sql_update_from(self, cursor, new_srcpackage):
+        """ Update the database to contain new_srcpackage instead of self.
+
+            Only the rows that changed are written. Return True if anything
+            changed.
+
+        """
         if not new_srcpackage._ready_for_sql:
             raise ObsDbException('Source package %s used for update is a shim object, not to be put in database.' % (new_srcpackage.name,))
         if self.sql_id < 0:
@@ -1069,24 +1384,14 @@ class SrcPackage(Base):
         # if they were not present before
         new_srcpackage.sql_id = self.sql_id
 
-        # we obviously don't need to update the id, the name or the project
-        cursor.execute('''UPDATE %s SET
-            srcmd5 = ?,
-            version = ?,
-            link_project = ?,
-            link_package = ?,
-            devel_project = ?,
-            devel_package = ?,
-            upstream_name = ?,
-            upstream_version = ?,
-            upstream_url = ?,
-            is_obs_link = ?,
-            obs_link_has_delta = ?,
-            obs_error = ?,
-            obs_error_details = ?
-            WHERE id = ?
-            ;''' % self.sql_table,
-            (new_srcpackage.srcmd5, new_srcpackage.version, new_srcpackage.link_project, new_srcpackage.link_package, new_srcpackage.devel_project, new_srcpackage.devel_package, new_srcpackage.upstream_name, new_srcpackage.upstream_version, new_srcpackage.upstream_url, new_srcpackage.is_link, new_srcpackage.has_delta, new_srcpackage.error, new_srcpackage.error_details, self.sql_id))
+        changed = False
+
+        if self._sql_row_differs(new_srcpackage):
+            changed = True
+            self._sql_update_row_from(cursor, new_srcpackage)
+        elif self.fingerprint != new_srcpackage.fingerprint:
+            # this is not a change of the data, but we still need to save it
+            self._sql_update_row_from(cursor, new_srcpackage)
 
         def pop_first(list):
             try:
@@ -1101,7 +1406,10 @@ class SrcPackage(Base):
                 (attr) and that __ne__ and sql_update_from methods exists for
                 the objects.
 
+                Return True if anything changed.
+
             """
+            changed = False
             oldlist.sort(key=operator.attrgetter(attr))
             newlist.sort(key=operator.attrgetter(attr))
             # copy the new list to not edit it
@@ -1110,15 +1418,18 @@ class SrcPackage(Base):
             for olditem in oldlist:
                 if not newitem:
                     olditem.sql_remove(cursor)
+                    changed = True
                     continue
                 oldattr = getattr(olditem, attr)
                 newattr = getattr(newitem, attr)
                 if oldattr < newattr:
                     olditem.sql_remove(cursor)
+                    changed = True
                 else:
                     if oldattr > newattr:
                         while newitem and oldattr > newattr:
                             newitem.sql_add(cursor)
+                            changed = True
                             newitem = pop_first(copylist)
                             if newitem:
                                 newattr = getattr(newitem, attr)
@@ -1128,25 +1439,79 @@ class SrcPackage(Base):
                     if oldattr == newattr:
                         if olditem != newitem:
                             olditem.sql_update_from(cursor, newitem)
+                            changed = True
                         newitem = pop_first(copylist)
 
             # add remaining items
             while newitem:
                 newitem.sql_add(cursor)
+                changed = True
                 newitem = pop_first(copylist)
 
-        update_list(cursor, self.packages, new_srcpackage.packages, 'name')
-        update_list(cursor, self.sources,  new_srcpackage.sources,  'filename')
-        update_list(cursor, self.patches,  new_srcpackage.patches,  'filename')
-        update_list(cursor, self.files,    new_srcpackage.files,    'filename')
+            return changed
+
+        # not using "or" on purpose: all lists must be updated
+        changed = update_list(cursor, self.packages, new_srcpackage.packages, 'name') or changed
+        changed = update_list(cursor, self.sources,  new_srcpackage.sources,  'filename') or changed
+        changed = update_list(cursor, self.patches,  new_srcpackage.patches,  'filename') or changed
+        changed = update_list(cursor, self.files,    new_srcpackage.files,    'filename') or changed
 
         # Rpmlint warnings can only get added/removed, not updated
         for rpmlint in self.rpmlint_reports:
             if not rpmlint in new_srcpackage.rpmlint_reports:
                 rpmlint.sql_remove(cursor)
+                changed = True
         for rpmlint in new_srcpackage.rpmlint_reports:
             if not rpmlint in self.rpmlint_reports:
                 rpmlint.sql_add(cursor)
+                changed = True
+
+        return changed
+
+    def _sql_update_row_from(self, cursor, new_srcpackage):
+        # we obviously don't need to update the id, the name or the project
+        cursor.execute('''UPDATE %s SET
+            srcmd5 = ?,
+            version = ?,
+            link_project = ?,
+            link_package = ?,
+            devel_project = ?,
+            devel_package = ?,
+            upstream_name = ?,
+            upstream_version = ?,
+            upstream_url = ?,
+            is_obs_link = ?,
+            obs_link_has_delta = ?,
+            obs_error = ?,
+            obs_error_details = ?,
+            fingerprint = ?
+            WHERE id = ?
+            ;''' % self.sql_table,
+            (new_srcpackage.srcmd5, new_srcpackage.version, new_srcpackage.link_project, new_srcpackage.link_package, new_srcpackage.devel_project, new_srcpackage.devel_package, new_srcpackage.upstream_name, new_srcpackage.upstream_version, new_srcpackage.upstream_url, new_srcpackage.is_link, new_srcpackage.has_delta, new_srcpackage.error, new_srcpackage.error_details, new_srcpackage.fingerprint, self.sql_id))
+
+    def sql_update_upstream(self, cursor, upstream_db):
+        """ Update the upstream data of the source package, if needed.
+
+            Return True if it changed.
+
+        """
+        if self.sql_id < 0:
+            raise ObsDbException('Source package %s used for update does not have a SQL id.' % (self.name,))
+
+        upstream_data = self._get_upstream_data(upstream_db)
+        if upstream_data == (self.upstream_name, self.upstream_version, self.upstream_url):
+            return False
+
+        (self.upstream_name, self.upstream_version, self.upstream_url) = upstream_data
+        cursor.execute('''UPDATE %s SET
+            upstream_name = ?,
+            upstream_version = ?,
+            upstream_url = ?
+            WHERE id = ?
+            ;''' % self.sql_table,
+            (self.upstream_name, self.upstream_version, self.upstream_url, self.sql_id))
+
+        return True
 
     def sql_remove(self, cursor):
         if self.project.sql_id == -1:
@@ -1160,27 +1525,191 @@ class SrcPackage(Base):
                 (self.name, self.project.sql_id))
             self.sql_id = cursor.fetchone()[0]
 
-        Package.sql_remove_all(cursor, self.sql_id)
-        RpmlintReport.sql_remove_all(cursor, self.sql_id)
-        Source.sql_remove_all(cursor, self.sql_id)
-        Patch.sql_remove_all(cursor, self.sql_id)
-        File.sql_remove_all(cursor, self.sql_id)
-
+        # the children are removed by the database (ON DELETE CASCADE)
         cursor.execute('''DELETE FROM %s WHERE
             id = ?
             ;''' % self.sql_table,
             (self.sql_id,))
 
-    def read_from_disk(self, project_directory, upstream_db):
+    def read_from_disk(self, project_directory, upstream_db, spec_cache = None):
+        self.analyze_from_disk(project_directory, spec_cache)
+        self._finish_read_from_disk(upstream_db, spec_cache)
+
+    def analyze_from_disk(self, project_directory, spec_cache = None):
+        """ Parse the files of the package in the mirror.
+
+            This only does the parsing, and does not need any database, so
+            this can be done in a different process. See
+            get_analysis_record().
+
+            spec_cache -- A speccache.SpecCache to look up the analysis of the
+                          spec file. It is not modified here, see
+                          _finish_read_from_disk().
+
+        """
         srcpackage_dir = os.path.join(project_directory, self.name)
 
+        # compute this first: if the files change during the analysis, the
+        # package will simply be analyzed again next time
+        self.fingerprint = self.get_fingerprint(project_directory)
+
         self._analyze_files(srcpackage_dir)
-        self._analyze_specs(srcpackage_dir)
+        self._analyze_specs(srcpackage_dir, spec_cache)
         self._analyze_meta(srcpackage_dir)
         self._get_rpmlint_errors()
 
+    def get_fingerprint(self, project_directory):
+        """ Return a fingerprint of everything the analysis of the package depends on.
+
+            This is based on the srcmd5 of the package (and of the package in
+            the parent project, which is used to find a delta), the mtime of
+            the _meta file and of the rpmlint log, and the configuration of
+            the project. It's much cheaper to compute than the analysis.
+
+            Note that the upstream data and the errors from post_analyze() are
+            not part of it, since they do not come from the mirror.
+
+        """
+        srcpackage_dir = os.path.join(project_directory, self.name)
+
+        fingerprint = hashlib.md5()
+
+        items = [ str(ANALYSIS_VERSION),
+                  str(SPEC_PARSER_VERSION),
+                  self.project.parent or '',
+                  str(self.project.force_project_parent),
+                  str(self.project.lenient_delta),
+                  _get_mtime(os.path.join(srcpackage_dir, '_meta')) ]
+        if RPMLINT_ERRORS_PATH:
+            items.append(_get_mtime(os.path.join(os.sep, RPMLINT_ERRORS_PATH, self.project.name, self.name + '.log')))
+        fingerprint.update('\0'.join(items).encode('utf-8'))
+
+        fingerprint.update(b'\0')
+        fingerprint.update(_get_files_header(srcpackage_dir))
+
+        if self.project.parent and self.project.parent != self.project.name:
+            parent_package_dir = os.path.join(project_directory, '..', self.project.parent, self.name)
+            fingerprint.update(b'\0')
+            fingerprint.update(_get_files_header(parent_package_dir))
+
+        return fingerprint.hexdigest()
+
+    def can_reuse_analysis(self, fingerprint):
+        """ Return True if the analysis of the package is still valid.
+
+            fingerprint -- The current fingerprint of the package, as
+                           returned by get_fingerprint().
+
+        """
+        if not self.fingerprint or self.fingerprint != fingerprint:
+            return False
+
+        return self.error not in POST_ANALYSIS_ERRORS
+
+    def _get_spec_analysis(self):
+        """ Return the data coming from the spec file, as nested lists. """
+        return (self.version,
+                [ (package.name, package.summary, package.description) for package in self.packages ],
+                [ (source.filename, source.number) for source in self.sources ],
+                [ (patch.filename, patch.number, patch.apply_order, patch.disabled,
+                   patch.tag, patch.tag_filename, patch.short_descr, patch.descr,
+                   patch.bnc, patch.bgo, patch.bmo, patch.bln, patch.brc, patch.fate, patch.cve) for patch in self.patches ])
+
+    def _set_spec_analysis(self, spec_analysis):
+        """ Set the data coming from the spec file, from _get_spec_analysis(). """
+        (version, packages, sources, patches) = spec_analysis
+
+        self.version = version
+
+        for (package_name, summary, description) in packages:
+            package = Package(self, package_name)
+            package.summary = summary
+            package.description = description
+            self.packages.append(package)
+
+        for (filename, number) in sources:
+            self.sources.append(Source(self, filename, number))
+
+        for (filename, number, apply_order, disabled,
+             tag, tag_filename, short_descr, descr,
+             bnc, bgo, bmo, bln, brc, fate, cve) in patches:
+            patch = Patch(self, filename, number, disabled)
+            patch.apply_order = apply_order
+            patch.tag = tag
+            patch.tag_filename = tag_filename
+            patch.short_descr = short_descr
+            patch.descr = descr
+            patch.bnc = bnc
+            patch.bgo = bgo
+            patch.bmo = bmo
+            patch.bln = bln
+            patch.brc = brc
+            patch.fate = fate
+            patch.cve = cve
+            self.patches.append(patch)
+
+    def get_analysis_record(self):
+        """ Return a compact and picklable record of the analysis. """
+        return (self.name, self.fingerprint, self.srcmd5,
+                self.link_project, self.link_package,
+                self.devel_project, self.devel_package,
+                self.is_link, self.has_delta, self.has_branch, self.has_meta,
+                self.error, self.error_details,
+                self._get_spec_analysis(),
+                [ (file.filename, file.mtime) for file in self.files ],
+                [ (rpmlint.level, rpmlint.type, rpmlint.detail, rpmlint.descr) for rpmlint in self.rpmlint_reports ],
+                self._spec_cache_entry)
+
+    @classmethod
+    def from_analysis_record(cls, project, record):
+        """ Create a source package from a record created by get_analysis_record(). """
+        (name, fingerprint, srcmd5,
+         link_project, link_package,
+         devel_project, devel_package,
+         is_link, has_delta, has_branch, has_meta,
+         error, error_details,
+         spec_analysis, files, rpmlints,
+         spec_cache_entry) = record
+
+        srcpackage = SrcPackage(name, project)
+        srcpackage.fingerprint = fingerprint
+        srcpackage.srcmd5 = srcmd5
+        srcpackage.link_project = link_project
+        srcpackage.link_package = link_package
+        srcpackage.devel_project = devel_project
+        srcpackage.devel_package = devel_package
+        srcpackage.is_link = is_link
+        srcpackage.has_delta = has_delta
+        srcpackage.has_branch = has_branch
+        srcpackage.has_meta = has_meta
+        srcpackage.error = error
+        srcpackage.error_details = error_details
+        srcpackage._spec_cache_entry = spec_cache_entry
+
+        srcpackage._set_spec_analysis(spec_analysis)
+
+        for (filename, mtime) in files:
+            srcpackage.files.append(File(srcpackage, filename, mtime))
+
+        for (level, type, detail, descr) in rpmlints:
+            rpmlint = RpmlintReport(srcpackage, level, type, detail)
+            rpmlint.descr = descr
+            srcpackage.rpmlint_reports.append(rpmlint)
+
+        return srcpackage
+
+    def _get_upstream_data(self, upstream_db):
         if upstream_db and self.project.branches:
-            (self.upstream_name, self.upstream_version, self.upstream_url) = upstream_db.get_upstream_data(self.project.branches, self.name)
+            return upstream_db.get_upstream_data(self.project.branches, self.name)
+        return ('', '', '')
+
+    def _finish_read_from_disk(self, upstream_db, spec_cache = None):
+        """ Complete the analysis with data that is not in the mirror. """
+        if spec_cache and self._spec_cache_entry:
+            spec_cache.add(*self._spec_cache_entry)
+        self._spec_cache_entry = None
+
+        (self.upstream_name, self.upstream_version, self.upstream_url) = self._get_upstream_data(upstream_db)
 
         if self.project.parent and self.project.parent != self.project.name and not self.is_link and not self.error:
             self.error = 'not-link'
@@ -1205,9 +1734,7 @@ class SrcPackage(Base):
                         self.has_branch = 1
 
         root = None
-        files = os.path.join(srcpackage_dir, '_files-expanded')
-        if not os.path.exists(files):
-            files = os.path.join(srcpackage_dir, '_files')
+        files = _get_files_list(srcpackage_dir)
         if os.path.exists(files):
             try:
                 root = ET.parse(files).getroot()
@@ -1268,37 +1795,16 @@ class SrcPackage(Base):
         if not self.project.parent or self.project.parent == self.project.name:
             return
 
-        parent_package_dir = os.path.join(srcpackage_dir, '..', '..', self.project.parent, self.name)
-        files = os.path.join(parent_package_dir, '_files-expanded')
-        if not os.path.exists(files):
-            files = os.path.join(parent_package_dir, '_files')
-
-        if not os.path.exists(files):
-            return
-
-        try:
-            parent_root = ET.parse(files).getroot()
-        except SyntaxError as e:
-            print('Cannot parse %s: %s' % (files, e), file=sys.stderr)
+        parent_project_dir = os.path.join(srcpackage_dir, '..', '..', self.project.parent)
+        parent_manifest = _get_parent_manifest(parent_project_dir, self.name)
+        if parent_manifest is None:
             return
 
-        parent_files = {}
-        for node in parent_root.findall('entry'):
-            filename = node.get('name')
-            if filename in IGNORE_FILES:
-                continue
-            md5 = node.get('md5')
-            parent_files[filename] = md5
-
-        for node in root.findall('entry'):
-            filename = node.get('name')
-            if filename in IGNORE_FILES:
-                continue
-            md5 = node.get('md5')
-            if filename not in parent_files:
+        for (filename, md5) in _get_manifest(root).items():
+            if filename not in parent_manifest:
                 self.has_delta = 2
                 break
-            elif md5 != parent_files[filename]:
+            elif md5 != parent_manifest[filename]:
                 if self.project.lenient_delta:
                     # we don't really care about .changes here
                     if filename[-8:] == '.changes':
@@ -1306,73 +1812,32 @@ class SrcPackage(Base):
                     # for spec files, we try to ignore the irrelevant stuff
                     elif filename[-5:] == '.spec':
                         spec = os.path.join(srcpackage_dir, filename)
-                        parent_spec = os.path.join(parent_package_dir, filename)
-                        if self._specs_are_different_lenient(spec, parent_spec):
+                        parent_spec = os.path.join(parent_project_dir, self.name, filename)
+                        if self._specs_are_different_lenient(spec, parent_spec, md5, parent_manifest[filename]):
                             self.has_delta = 2
                             break
                 else:
                     self.has_delta = 2
                     break
-            del parent_files[filename]
 
-    def _specs_are_different_lenient(self, spec_a, spec_b):
+    def _specs_are_different_lenient(self, spec_a, spec_b, md5_a = None, md5_b = None):
         '''
-            Compare two spec files, but ignore some useless changes:
-             - ignore space changes
-             - ignore blank lines
-             - ignore comments
-             - ignore Release tag
-             - ignore %changelog
-        '''
-
-        def strip_useless_spaces(s):
-            return ' '.join(s.split())
-
-        def get_next_line(file):
-            while True:
-                line = file.readline()
-                if len(line) == 0:
-                    return None
-                line = line[:-1]
-                line = strip_useless_spaces(line)
-                if not line:
-                    continue
-                if line[0] == '#':
-                    continue
-                if line.startswith('Release:'):
-                    continue
-                if line == '%changelog':
-                    return None
-                return line
+            Compare two spec files, but ignore some useless changes (see
+            _read_lenient_spec()).
 
-        if not os.path.exists(spec_a) or not os.path.exists(spec_b):
+            md5_a and md5_b are the md5 of the spec files, if known: they are
+            used to avoid reading again spec files that were already seen.
+        '''
+        digest_a = _get_lenient_spec_digest(spec_a, md5_a)
+        if digest_a is None:
+            return True
+        digest_b = _get_lenient_spec_digest(spec_b, md5_b)
+        if digest_b is None:
             return True
 
-        file_a = open(spec_a)
-        file_b = open(spec_b)
-
-        diff = False
-
-        while True:
-            line_a = get_next_line(file_a)
-            line_b = get_next_line(file_b)
-            if line_a is None:
-                if line_b is not None:
-                    diff = True
-                break
-            if line_b is None:
-                diff = True
-                break
-            if line_a != line_b:
-                diff = True
-                break
-
-        file_a.close()
-        file_b.close()
-
-        return diff
+        return digest_a != digest_b
 
-    def _analyze_specs(self, srcpackage_dir):
+    def _analyze_specs(self, srcpackage_dir, spec_cache = None):
         # If there's an error, then nothing to do: the package is broken anyway
         if self.is_link and self.error:
             return
@@ -1402,83 +1867,115 @@ class SrcPackage(Base):
                         bestfile = file
 
         if bestfile:
-            self._analyze_spec(os.path.join(srcpackage_dir, bestfile.filename))
+            self._analyze_spec(os.path.join(srcpackage_dir, bestfile.filename), spec_cache)
 
-    def _analyze_spec(self, filename):
+    def _analyze_spec(self, filename, spec_cache = None):
         '''Analyze a spec file and extract the relevant data from there'''
         if not os.path.exists(filename):
             print('Spec file %s of %s/%s does not exist' % (os.path.basename(filename), self.project.name, self.name), file=sys.stderr)
             return
 
+        if spec_cache:
+            spec = open(filename, 'rb')
+            key = speccache.get_key(self.name, spec.read())
+            spec.close()
+
+            spec_analysis = spec_cache.get(key)
+            if spec_analysis is not None:
+                self._set_spec_analysis(spec_analysis)
+                self._spec_cache_entry = (key, None)
+                return
+
+        self._parse_spec(filename)
+
+        if spec_cache:
+            self._spec_cache_entry = (key, self._get_spec_analysis())
+
+    def _parse_spec(self, filename):
         spec = open(filename)
 
         current_package = None
         defines = {}
         defines['name'] = self.name
 
+        # regular expression matching all the known macros, compiled when
+        # needed; set to None when defines changes
+        re_defines = None
+
+        def replace_define(match):
+            key = match.group(1)
+            if key is None:
+                key = match.group(2)
+            return defines[key]
+
         def subst_defines(s, defines):
             '''Replace macros like %{version} and %{name} in strings. Useful
                for sources and patches '''
-            for key in list(defines.keys()):
-                if s.find(key) != -1:
-                    value = defines[key]
-                    s = s.replace('%%{%s}' % key, value)
-                    s = s.replace('%%%s' % key, value)
-            return s
+            nonlocal re_defines
+
+            if '%' not in s:
+                return s
+
+            if re_defines is None:
+                # longest names first, so that %version is not seen as %ver
+                keys = '|'.join([ re.escape(key) for key in sorted(defines.keys(), key = len, reverse = True) ])
+                re_defines = re.compile('%%(?:\\{(%s)\\}|(%s))' % (keys, keys))
+
+            # values of defines are already substituted when they're defined,
+            # so one pass is enough (and keeps the size of the result bounded)
+            return re_defines.sub(replace_define, s)
 
         # to help if Summary is defined before Name
         early_summary = False
 
         line = 'empty'
-        while True:
+        for next_line in spec:
             # we need to remember the previous line for patch tags
 #FIXME: some packages have comments on two lines...
             previous_line = line
-            line = spec.readline()
-            if line == '':
-                break
+            line = next_line
 
-            match = SrcPackage.re_spec_prep.match(line)
-            if match:
+            match = SrcPackage.re_spec_preamble.match(line)
+            if not match:
+                continue
+
+            token = match.lastgroup
+            # index of the first group inside the token group
+            i = match.lastindex + 1
+
+            if token == 'prep':
                 break
 
-            match = SrcPackage.re_spec_define.match(line)
-            if match:
-                value = subst_defines(match.group(2), defines)
-                defines[match.group(1)] = value
-                continue
+            elif token == 'define':
+                value = subst_defines(match.group(i + 1), defines)
+                defines[match.group(i)] = value
+                re_defines = None
 
-            match = SrcPackage.re_spec_name.match(line)
-            if match:
-                name = match.group(1)
+            elif token == 'name':
+                name = match.group(i)
                 defines['name'] = name
-                current_package = Package(self, match.group(1))
+                re_defines = None
+                current_package = Package(self, name)
                 if early_summary:
                     # if we had a summary before the name, then use it now
                     current_package.set_summary(early_summary)
                     early_summary = None
                 self.packages.append(current_package)
-                continue
 
-            match = SrcPackage.re_spec_lang_package.match(line)
-            if match:
+            elif token == 'lang_package':
                 current_package = Package(self, defines['name'] + '-lang')
                 self.packages.append(current_package)
-                continue
 
-            match = SrcPackage.re_spec_package.match(line)
-            if match:
-                pack_line = subst_defines(match.group(1), defines)
+            elif token == 'package':
+                pack_line = subst_defines(match.group(i), defines)
                 match = SrcPackage.re_spec_package2.match(pack_line)
                 if match:
                     current_package = Package(self, match.group(1))
                 else:
                     current_package = Package(self, defines['name'] + '-' + pack_line)
                 self.packages.append(current_package)
-                continue
 
-            match = SrcPackage.re_spec_version.match(line)
-            if match:
+            elif token == 'version':
                 # Ignore version if it's redefined for a second package.
                 # Test case: MozillaThunderbird.spec, where the main package
                 # has a version, and the enigmail subpackage has another
@@ -1486,69 +1983,55 @@ class SrcPackage(Base):
                 if self.version and len(self.packages) > 1:
                     continue
 
-                self.version = subst_defines(match.group(1), defines)
+                self.version = subst_defines(match.group(i), defines)
                 defines['version'] = self.version
-                continue
+                re_defines = None
 
-            match = SrcPackage.re_spec_summary.match(line)
-            if match:
+            elif token == 'summary':
                 if not current_package:
                     # save the summary for later
-                    early_summary = match.group(1)
+                    early_summary = match.group(i)
                     continue
-                current_package.set_summary(match.group(1))
-                continue
+                current_package.set_summary(match.group(i))
 
-            match = SrcPackage.re_spec_source.match(line)
-            if match:
-                if match.group(1) == '':
-                    nb = '0'
-                else:
-                    nb = match.group(1)
-                buf = subst_defines(match.group(2), defines)
+            elif token == 'source':
+                nb = int(match.group(i) or 0)
+                buf = subst_defines(match.group(i + 1), defines)
                 source = Source(self, buf, nb)
                 self.sources.append(source)
-                continue
 
-            match = SrcPackage.re_spec_patch.match(line)
-            if match:
+            elif token == 'patch':
                 # we don't need it here: we'll explicitly mark the patches as
                 # applied later
-                disabled = (match.group(1) != '')
-                if match.group(2) == '':
-                    nb = '0'
-                else:
-                    nb = match.group(2)
-                buf = subst_defines(match.group(3), defines)
+                disabled = (match.group(i) != '')
+                nb = int(match.group(i + 1) or 0)
+                buf = subst_defines(match.group(i + 2), defines)
                 patch = Patch(self, buf, nb)
                 patch.set_tag(previous_line)
                 self.patches.append(patch)
-                continue
+
+        # the first patch with a given number is the one that gets applied
+        patches = {}
+        for patch in self.patches:
+            if patch.number not in patches:
+                patches[patch.number] = patch
 
         order = 0
-        while True:
-            line = spec.readline()
-            if line == '':
-                break
+        for line in spec:
+            match = SrcPackage.re_spec_prep_section.match(line)
+            if not match:
+                continue
 
-            match = SrcPackage.re_spec_build.match(line)
-            if match:
+            if match.lastgroup == 'build':
                 break
 
-            match = SrcPackage.re_spec_apply_patch.match(line)
-            if match:
-                disabled = (match.group(1) != '')
-                if match.group(2) == '':
-                    nb = '0'
-                else:
-                    nb = match.group(2)
-                for patch in self.patches:
-                    if patch.number == nb:
-                        patch.set_disabled(disabled)
-                        patch.set_apply_order(order)
-                        break
-                order = order + 1
-                continue
+            i = match.lastindex + 1
+            disabled = (match.group(i) != '')
+            nb = int(match.group(i + 1) or 0)
+            if nb in patches:
+                patches[nb].set_disabled(disabled)
+                patches[nb].set_apply_order(order)
+            order = order + 1
 
         spec.close()
 
@@ -1645,28 +2128,20 @@ class Project(Base):
         if recursive:
             # we do a second loop so we can use only one cursor, that shouldn't
             # matter much since the loop is not the slow part
-            prj_object.srcpackages = SrcPackage.sql_get_all(cursor, prj_object, recursive)
+            for prj_object in projects:
+                prj_object.srcpackages = SrcPackage.sql_get_all(cursor, prj_object, recursive)
 
         return projects
 
     @classmethod
     def sql_simple_remove(cls, cursor, project):
-        cursor.execute('''SELECT id FROM %s WHERE
+        # the source packages and their children are removed by the database
+        # (ON DELETE CASCADE)
+        cursor.execute('''DELETE FROM %s WHERE
             name = ?
             ;''' % cls.sql_table,
             (project,))
 
-        ids = [ id for (id,) in cursor.fetchall() ]
-        if not ids:
-            return
-
-        SrcPackage.sql_remove_all(cursor, ids)
-
-        where = ' OR '.join([ 'id = ?' for i in range(len(ids)) ])
-        cursor.execute('''DELETE FROM %s WHERE
-            %s;''' % (cls.sql_table, where),
-            ids)
-
     def __init__(self, name):
         self.sql_id = -1
 
@@ -1690,18 +2165,40 @@ class Project(Base):
 
         self._ready_for_sql = False
 
-    def sql_add(self, cursor):
+    def sql_add(self, cursor, batch = None):
+        """ Add the project and its source packages to the database.
+
+            batch -- A SqlBatch used to add rows. If None, a batch is created
+                     for this project only.
+
+        """
         if not self._ready_for_sql:
             raise ObsDbException('Project %s is a shim object, not to be put in database.' % (self.name,))
 
-        cursor.execute('''INSERT INTO %s VALUES (
-            NULL, ?, ?, ?
-            );''' % self.sql_table,
+        own_batch = batch is None
+        if own_batch:
+            batch = SqlBatch(cursor)
+
+        self._sql_add_row(cursor, batch,
             (self.name, self.parent, not self.branches))
-        self._sql_update_last_id(cursor)
 
         for srcpackage in self.srcpackages:
-            srcpackage.sql_add(cursor)
+            srcpackage.sql_add(cursor, batch)
+
+        if own_batch:
+            batch.flush()
+
+    def sql_update_row(self, cursor):
+        """ Update the row of the project, without touching the source packages. """
+        if self.sql_id == -1:
+            raise ObsDbException('Project %s used for update does not have a SQL id.' % (self.name,))
+
+        cursor.execute('''UPDATE %s SET
+            parent = ?,
+            ignore_upstream = ?
+            WHERE id = ?
+            ;''' % self.sql_table,
+            (self.parent, not self.branches, self.sql_id))
 
     def sql_remove(self, cursor):
         if self.sql_id == -1:
@@ -1711,8 +2208,8 @@ class Project(Base):
                 (self.name,))
             self.sql_id = cursor.fetchone()[0]
 
-        SrcPackage.sql_remove_all(cursor, self.sql_id)
-
+        # the source packages and their children are removed by the database
+        # (ON DELETE CASCADE)
         cursor.execute('''DELETE FROM %s WHERE
             id = ?
             ;''' % self.sql_table,
@@ -1855,17 +2352,43 @@ class Project(Base):
 
         return meta_devel
 
-    def read_from_disk(self, parent_directory, upstream_db):
+    def get_analysis_config(self):
+        """ Return the options needed by _analyze_srcpackage_record(). """
+        return (self.name, self.parent, self.force_project_parent, self.lenient_delta)
+
+    def read_from_disk(self, parent_directory, upstream_db, pool = None, spec_cache = None):
         """
             Note: read_config() has to be called before.
 
+        """
+        for srcpackage in self.iter_from_disk(parent_directory, upstream_db, pool, spec_cache = spec_cache):
+            self.srcpackages.append(srcpackage)
+
+    def iter_from_disk(self, parent_directory, upstream_db, pool = None, previous = None, spec_cache = None):
+        """ Return an iterator over the source packages of the project.
+
+            The source packages are not added to the project, so the caller
+            is responsible for them.
+
+            pool -- A multiprocessing pool used to analyze the packages. If
+                    None, everything is done in the current process.
+            previous -- A PreviousAnalysis of the project. The analysis of
+                        packages that did not change since then is copied
+                        instead of being done again.
+            spec_cache -- A speccache.SpecCache used for the analysis of spec
+                          files. If a pool is used, its processes need to use
+                          the same cache file.
+
+            Note: read_config() has to be called before.
+
         """
         project_dir = os.path.join(parent_directory, self.name)
         if not os.path.exists(project_dir):
-            return
+            return iter([])
 
         meta_devel = self._read_meta(project_dir)
 
+        names = []
         for file in os.listdir(project_dir):
             if file in ['_pkgmeta']:
                 continue
@@ -1873,15 +2396,291 @@ class Project(Base):
             if not os.path.isdir(os.path.join(project_dir, file)):
                 continue
 
-            srcpackage = SrcPackage(file, self)
-            srcpackage.read_from_disk(project_dir, upstream_db)
+            names.append(file)
 
-            if not srcpackage.has_meta and srcpackage.name in meta_devel:
-                (srcpackage.devel_project, srcpackage.devel_package) = meta_devel[srcpackage.name]
+        self._ready_for_sql = True
 
-            self.srcpackages.append(srcpackage)
+        return self._iter_srcpackages(project_dir, names, meta_devel, upstream_db, pool, previous, spec_cache)
+
+    def _iter_srcpackages(self, project_dir, names, meta_devel, upstream_db, pool, previous, spec_cache):
+        reusable = set()
+        if previous:
+            for name in names:
+                if previous.can_reuse(name, SrcPackage(name, self).get_fingerprint(project_dir)):
+                    reusable.add(name)
+
+        if pool:
+            records = self._iter_analysis_records(project_dir, [ name for name in names if name not in reusable ], pool)
+
+        for name in names:
+            if name in reusable:
+                srcpackage = SrcPackage.from_analysis_record(self, previous.get_analysis_record(name))
+                # this is not saved in the database
+                srcpackage.has_meta = os.path.exists(os.path.join(project_dir, name, '_meta'))
+                srcpackage._finish_read_from_disk(upstream_db)
+            elif pool:
+                srcpackage = SrcPackage.from_analysis_record(self, next(records))
+                srcpackage._finish_read_from_disk(upstream_db, spec_cache)
+            else:
+                srcpackage = SrcPackage(name, self)
+                srcpackage.read_from_disk(project_dir, upstream_db, spec_cache)
 
-        self._ready_for_sql = True
+            if not srcpackage.has_meta:
+                (srcpackage.devel_project, srcpackage.devel_package) = meta_devel.get(srcpackage.name, ('', ''))
+
+            yield srcpackage
+
+    def _iter_analysis_records(self, project_dir, names, pool):
+        """ Analyze packages with pool, and return an iterator over the records.
+
+            The records are returned in the same order as names, so that we
+            get the same ids in the database as without a pool. Only a limited
+            number of packages are analyzed in advance, so that the results do
+            not pile up in memory if they're consumed more slowly than they
+            are produced.
+
+        """
+        analysis_config = self.get_analysis_config()
+        chunks = ( [ (analysis_config, project_dir, name) for name in names[i:i + ANALYSIS_CHUNK_SIZE] ]
+                   for i in range(0, len(names), ANALYSIS_CHUNK_SIZE) )
+
+        pending = collections.deque()
+        for args in itertools.islice(chunks, ANALYSIS_PENDING_CHUNKS):
+            pending.append(pool.apply_async(_analyze_srcpackage_records, (args,)))
+
+        while pending:
+            records = pending.popleft().get()
+            for args in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(_analyze_srcpackage_records, (args,)))
+
+            for record in records:
+                yield record
+
+#######################################################################
+
+class PreviousAnalysis:
+    """ The analysis of the source packages of a project, as found in a
+        database, so that it can be reused for unchanged packages.
+
+        Only the rows of the source packages are kept in memory; the rest is
+        loaded when needed.
+
+    """
+
+    def __init__(self, cursor, project, srcpackages = None):
+        """ srcpackages -- The source packages of project, if they were
+                           already loaded, without their children.
+        """
+        self._cursor = cursor
+
+        if srcpackages is None:
+            srcpackages = SrcPackage.sql_get_all(cursor, project)
+
+        self._srcpackages = {}
+        for srcpackage in srcpackages:
+            self._srcpackages[srcpackage.name] = srcpackage
+
+        self._reused = set()
+
+    def can_reuse(self, name, fingerprint):
+        """ Return True if the analysis of a package can be reused. """
+        if name not in self._srcpackages:
+            return False
+        return self._srcpackages[name].can_reuse_analysis(fingerprint)
+
+    def get_analysis_record(self, name):
+        """ Return the analysis record of a package. This can only be called
+            once per package.
+        """
+        srcpackage = self._srcpackages.pop(name)
+        srcpackage._sql_fill(self._cursor)
+        self._reused.add(name)
+        return srcpackage.get_analysis_record()
+
+    def was_reused(self, name):
+        """ Return True if the analysis of a package has been reused. """
+        return name in self._reused
+
+#######################################################################
+
+def _analyze_srcpackage_record(args):
+    """ Analyze a source package, and return a record of the analysis.
+
+        This is run in worker processes of the pool used by ObsDb, so it
+        does not have access to any database.
+
+    """
+    ((name, parent, force_project_parent, lenient_delta), project_dir, srcpackage_name) = args
+
+    project = Project(name)
+    project.parent = parent
+    project.force_project_parent = force_project_parent
+    project.lenient_delta = lenient_delta
+
+    srcpackage = SrcPackage(srcpackage_name, project)
+    srcpackage.analyze_from_disk(project_dir, _worker_spec_cache)
+
+    return srcpackage.get_analysis_record()
+
+
+def _analyze_srcpackage_records(args_list):
+    """ Analyze a list of source packages. See _analyze_srcpackage_record(). """
+    return [ _analyze_srcpackage_record(args) for args in args_list ]
+
+
+# Read-only spec cache of the worker processes
+_worker_spec_cache = None
+
+def _init_analysis_worker(spec_cache_args):
+    """ Initialize a worker process of the pool used by ObsDb. """
+    global _worker_spec_cache
+
+    if spec_cache_args:
+        _worker_spec_cache = speccache.SpecCache(*spec_cache_args, readonly = True)
+
+def _sql_setup_data_tables(cursor):
+    """ Create the tables containing the data about projects and packages. """
+    Project.sql_setup(cursor)
+    SrcPackage.sql_setup(cursor)
+    Package.sql_setup(cursor)
+    Source.sql_setup(cursor)
+    Patch.sql_setup(cursor)
+    File.sql_setup(cursor)
+    RpmlintReport.sql_setup(cursor)
+
+
+def _sql_setup_changes_tables(cursor):
+    """ Create the tables containing the log of changes made in each run.
+
+        See ObsDb.get_changes_since().
+
+    """
+    cursor.execute('''CREATE TABLE run (
+        id INTEGER PRIMARY KEY,
+        finished INTEGER
+        );''')
+    cursor.execute('''CREATE TABLE changes (
+        run INTEGER,
+        project TEXT,
+        package TEXT,
+        kind TEXT,
+        UNIQUE (run, project, package, kind)
+        );''')
+
+
+def _sql_setup_dependency_table(cursor):
+    """ Create the table of dependencies between projects.
+
+        The data about a project (its XML, for instance) depends on the
+        versions of packages in other projects. A row (project, dependent,
+        origin) means that dependent needs to be looked at again when project
+        changes, because of the data of origin:
+          + packages of origin link to project, or have it as devel project
+            (dependent is origin);
+          + project is the parent of origin (dependent is origin);
+          + packages of project have dependent as devel project (origin is
+            project), and need to be listed as missing in dependent if they
+            do not exist there.
+
+    """
+    cursor.execute('''CREATE TABLE project_dependency (
+        project TEXT,
+        dependent TEXT,
+        origin TEXT,
+        UNIQUE (project, dependent, origin)
+        );''')
+    cursor.execute('''CREATE INDEX project_dependency_origin ON project_dependency (origin);''')
+
+
+def _remove_db_file(filename, only_wal = False):
+    """ Remove a database file, and the files used for its WAL.
+
+        only_wal -- Whether to only remove the files used for the WAL.
+
+    """
+    if only_wal:
+        filenames = []
+    else:
+        filenames = [ filename ]
+    filenames.extend([ filename + '-wal', filename + '-shm' ])
+
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+#######################################################################
+
+class ObsDbWriter(threading.Thread):
+    """ Thread writing projects and source packages to the database.
+
+        Objects are queued with add(), and written in the order they were
+        queued. The thread owns the database connection until finish() is
+        called.
+
+    """
+
+    def __init__(self, dbconn):
+        threading.Thread.__init__(self, name = 'ObsDbWriter')
+        self.daemon = True
+
+        self._dbconn = dbconn
+        # bounded, so that the analysis does not get too far ahead of the
+        # writer: everything that is queued is in memory
+        self._queue = queue.Queue(WRITER_QUEUE_SIZE)
+        self._error = None
+
+    def run(self):
+        cursor = self._dbconn.cursor()
+        # all rows go through this batch; nothing else writes to the
+        # database while we're running, so the ids it allocates are safe
+        sql_batch = SqlBatch(cursor)
+
+        done = False
+        while not done:
+            batch = [ self._queue.get() ]
+            try:
+                while len(batch) < WRITER_BATCH_SIZE:
+                    batch.append(self._queue.get(block = False))
+            except queue.Empty:
+                pass
+
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+                # keep emptying the queue after an error, but do not write
+                # anything anymore
+                if self._error:
+                    continue
+                try:
+                    item.sql_add(cursor, sql_batch)
+                    if sql_batch.size >= WRITER_FLUSH_ROWS:
+                        sql_batch.flush()
+                except Exception as e:
+                    self._error = e
+
+        if not self._error:
+            try:
+                sql_batch.flush()
+            except Exception as e:
+                self._error = e
+
+        cursor.close()
+
+    def _raise_if_error(self):
+        if self._error:
+            raise self._error
+
+    def add(self, item):
+        """ Queue a Project or a SrcPackage to be added to the database. """
+        self._raise_if_error()
+        self._queue.put(item)
+
+    def finish(self):
+        """ Wait for everything to be written. """
+        self._queue.put(None)
+        self.join()
+        self._raise_if_error()
 
 #######################################################################
 
@@ -1897,6 +2696,25 @@ class ObsDb:
         self._dbconn = None
         self._cursor = None
 
+        # ids of source packages that got added, updated or removed
+        self._changed_srcpackages = set()
+        # (project, package) of source packages that got removed, since we
+        # cannot find them from their id anymore
+        self._removed_srcpackages = set()
+        # whether the next post-analysis needs to look at all source packages
+        self._post_analysis_full = False
+        # id of the run in which changes are recorded, see _get_run()
+        self._run = None
+
+        reset_analysis_caches()
+
+        if self.conf.spec_cache_size > 0:
+            self._spec_cache_args = (os.path.join(self.db_dir, 'spec-cache.db'), SPEC_PARSER_VERSION, self.conf.spec_cache_size)
+            self._spec_cache = speccache.SpecCache(*self._spec_cache_args, debug = self.conf.debug)
+        else:
+            self._spec_cache_args = None
+            self._spec_cache = None
+
     def _debug_print(self, s):
         """ Print s if debug is enabled. """
         if self.conf.debug:
@@ -1911,6 +2729,16 @@ class ObsDb:
         self._open_existing_db_if_necessary()
         return self._dbconn.cursor()
 
+    def get_filename_for_readers(self):
+        """ Return the path of the database, for other processes reading it.
+
+            Pending changes are committed first, so that they are visible.
+
+        """
+        self._open_existing_db_if_necessary()
+        self._dbconn.commit()
+        return self._filename
+
     def exists(self):
         """ Return True if a database already exists. """
         if not os.path.exists(self._filename):
@@ -1939,13 +2767,29 @@ class ObsDb:
         """ Open a database file, and sets up everything. """
         if self._dbconn:
             self._close_db()
-        self._dbconn = sqlite3.connect(filename)
+        # the connection is used by the writer thread during rebuilds
+        self._dbconn = sqlite3.connect(filename, check_same_thread = False)
         self._dbconn.row_factory = sqlite3.Row
         self._dbconn.text_factory = sqlite3.OptimizedUnicode
+        # needed for ON DELETE CASCADE
+        self._dbconn.execute('''PRAGMA foreign_keys = ON;''')
+        # WAL is safe with synchronous = NORMAL, and makes writes cheaper;
+        # other processes only read the snapshot (see publish_snapshot())
+        self._dbconn.execute('''PRAGMA journal_mode = WAL;''')
+        self._dbconn.execute('''PRAGMA synchronous = NORMAL;''')
+        self._dbconn.execute('''PRAGMA cache_size = -%d;''' % DB_CACHE_SIZE)
+        self._dbconn.execute('''PRAGMA mmap_size = %d;''' % DB_MMAP_SIZE)
         self._cursor = self._dbconn.cursor()
 
     def _close_db(self):
         """ Closes the currently open database. """
+        if self._spec_cache:
+            try:
+                self._spec_cache.flush()
+            except sqlite3.Error as e:
+                print('Cannot save spec cache: %s' % e, file=sys.stderr)
+        if self._dbconn:
+            self._end_run()
         if self._cursor:
             self._cursor.close()
             self._cursor = None
@@ -1971,13 +2815,22 @@ class ObsDb:
             ?, ?
             );''', (DB_MAJOR, DB_MINOR))
 
-        Project.sql_setup(self._cursor)
-        SrcPackage.sql_setup(self._cursor)
-        Package.sql_setup(self._cursor)
-        Source.sql_setup(self._cursor)
-        Patch.sql_setup(self._cursor)
-        File.sql_setup(self._cursor)
-        RpmlintReport.sql_setup(self._cursor)
+        _sql_setup_data_tables(self._cursor)
+
+        # The creation of the database counts as a first run in the log of
+        # changes, so that changes made before cannot be asked for.
+        _sql_setup_changes_tables(self._cursor)
+        self._cursor.execute('''INSERT INTO run VALUES (
+            ?, 1
+            );''', (int(time.time()),))
+        # The token identifying the last published snapshot, and the last
+        # run it contains. See publish_snapshot().
+        self._cursor.execute('''CREATE TABLE snapshot (
+            token TEXT,
+            run INTEGER
+            );''')
+
+        _sql_setup_dependency_table(self._cursor)
 
         self._dbconn.commit()
 
@@ -1985,28 +2838,141 @@ class ObsDb:
         """ Rebuild the database from scratch. """
         # We rebuild in a temporary file in case there's a bug in the script :-)
         tmpfilename = self._filename + '.new'
-        if os.path.exists(tmpfilename):
-            os.unlink(tmpfilename)
+        _remove_db_file(tmpfilename)
 
         util.safe_mkdir_p(self.db_dir)
 
         self._debug_print('Rebuilding the database')
 
+        pool = None
+        previous_dbconn = self._open_previous_db()
+
         try:
             self._open_db(tmpfilename)
             self._create_tables()
 
-            for file in os.listdir(self.mirror_dir):
-                if not os.path.isdir(os.path.join(self.mirror_dir, file)):
-                    continue
-                self.add_project(file)
+            # The parsing of the mirror is done by a pool of processes, while
+            # a thread writes the results to the database; the main thread
+            # only looks up the upstream data, and dispatches work.
+            pool = self._create_analysis_pool()
+            writer = ObsDbWriter(self._dbconn)
+            writer.start()
+
+            try:
+                for file in os.listdir(self.mirror_dir):
+                    if not os.path.isdir(os.path.join(self.mirror_dir, file)):
+                        continue
+                    self._add_project_with_writer(file, writer, pool, previous_dbconn)
+            finally:
+                writer.finish()
+
+            if pool:
+                pool.close()
+                pool.join()
+                pool = None
+
+            self._update_project_dependencies()
 
             self._close_db()
+            if previous_dbconn:
+                previous_dbconn.close()
+                previous_dbconn = None
+            # the WAL of the old database must not be applied to the new one
+            _remove_db_file(self._filename, only_wal = True)
             os.rename(tmpfilename, self._filename)
+            self._post_analysis_full = True
         except Exception as e:
-            if os.path.exists(tmpfilename):
-                os.unlink(tmpfilename)
+            if pool:
+                pool.terminate()
+                pool.join()
+            _remove_db_file(tmpfilename)
             raise e
+        finally:
+            if previous_dbconn:
+                previous_dbconn.close()
+
+    def _open_previous_db(self):
+        """ Open the current database, to reuse its data during a rebuild.
+
+            Return None if there's no database with the current format.
+
+        """
+        if not self.exists():
+            return None
+
+        self._close_db()
+
+        dbconn = sqlite3.connect(self._filename)
+        dbconn.row_factory = sqlite3.Row
+        dbconn.text_factory = sqlite3.OptimizedUnicode
+
+        self._debug_print('Reusing the analysis of unchanged packages from the current database')
+        return dbconn
+
+    def _create_analysis_pool(self):
+        """ Create the pool of processes used to analyze the mirror.
+
+            Return None if no pool should be used.
+
+        """
+        processes = self.conf.processes
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1:
+            return None
+
+        self._debug_print('Using %d processes for analysis' % processes)
+
+        spec_cache_args = None
+        if self._spec_cache:
+            # the cache needs to exist before the workers open it
+            self._spec_cache.prepare()
+            spec_cache_args = self._spec_cache_args
+
+        return multiprocessing.Pool(processes, _init_analysis_worker, (spec_cache_args,))
+
+    def _add_project_with_writer(self, project, writer, pool, previous_dbconn = None):
+        """ Add data of all packages from project, via the writer thread.
+
+            previous_dbconn -- A connection to a previous database, from which
+                               the data of unchanged packages is copied.
+
+        """
+        self._debug_print('Adding project %s' % project)
+
+        prj_object = Project(project)
+        prj_object.read_config(self.conf.projects, self.mirror_dir)
+
+        previous = None
+        previous_cursor = None
+        if previous_dbconn:
+            previous_cursor = previous_dbconn.cursor()
+            previous_prj_object = Project.sql_get(previous_cursor, project)
+            if previous_prj_object:
+                previous = PreviousAnalysis(previous_cursor, previous_prj_object)
+
+        srcpackages = prj_object.iter_from_disk(self.mirror_dir, self.upstream, pool, previous, self._spec_cache)
+
+        # The source packages are not kept once they've been written, so
+        # memory usage does not depend on the size of the project
+        count = 0
+        writer.add(prj_object)
+        for srcpackage in srcpackages:
+            writer.add(srcpackage)
+            count += 1
+
+        if previous_cursor:
+            previous_cursor.close()
+
+        self._debug_print_memory_usage('Added project %s (%d source packages)' % (project, count))
+
+    def _debug_print_memory_usage(self, s):
+        """ Print s, with the memory usage, if debug is enabled. """
+        if not self.conf.debug:
+            return
+
+        (current, peak) = util.get_memory_usage()
+        self._debug_print('%s -- memory: %d kB, peak: %d kB' % (s, current, peak))
 
     def add_project(self, project):
         """ Add data of all packages from project in the database. """
@@ -2016,20 +2982,110 @@ class ObsDb:
 
         prj_object = Project(project)
         prj_object.read_config(self.conf.projects, self.mirror_dir)
-        prj_object.read_from_disk(self.mirror_dir, self.upstream)
+        srcpackages = prj_object.iter_from_disk(self.mirror_dir, self.upstream, spec_cache = self._spec_cache)
+
+        # Source packages are written as soon as they're analyzed, and not
+        # kept in the project, to keep a low-memory profile
+        batch = SqlBatch(self._cursor)
+        prj_object.sql_add(self._cursor, batch)
+
+        ids = []
+        for srcpackage in srcpackages:
+            srcpackage.sql_add(self._cursor, batch)
+            ids.append(srcpackage.sql_id)
+            if batch.size >= WRITER_FLUSH_ROWS:
+                batch.flush()
+        count = len(ids)
 
-        prj_object.sql_add(self._cursor)
+        batch.flush()
+
+        self._mark_project_changed(project, CHANGE_ADD)
+        self._mark_srcpackages_changed(ids, CHANGE_ADD)
+
+        self._debug_print_memory_usage('Added project %s (%d source packages)' % (project, count))
         # It's apparently not needed to commit each time to keep a low-memory
         # profile, and committing is slowing things down.
         # self._dbconn.commit()
 
     def update_project(self, project):
-        """ Update data of all packages from project in the database. """
+        """ Update data of all packages from project in the database.
+
+            Only the rows that changed are written. Return the set of ids of
+            source packages that changed (including removed ones).
+
+        """
         self._open_existing_db_if_necessary()
 
-        # It's simpler to just remove all packages and add them again
-        self.remove_project(project)
-        self.add_project(project)
+        prj_object = Project.sql_get(self._cursor, project)
+        if not prj_object or not os.path.exists(os.path.join(self.mirror_dir, project)):
+            if prj_object:
+                self._cursor.execute('''SELECT id FROM %s WHERE project = ?;''' % SrcPackage.sql_table, (prj_object.sql_id,))
+                changed = set([ id for (id,) in self._cursor.fetchall() ])
+            else:
+                changed = set()
+            self.remove_project(project)
+            self.add_project(project)
+            self._cursor.execute('''SELECT A.id FROM %s AS A, %s AS B
+                                    WHERE A.project = B.id AND B.name = ?
+                                    ;''' % (SrcPackage.sql_table, Project.sql_table),
+                                    (project,))
+            changed.update([ id for (id,) in self._cursor.fetchall() ])
+            self._changed_srcpackages.update(changed)
+            return changed
+
+        self._debug_print('Updating project %s' % project)
+
+        old_parent = prj_object.parent
+        old_ignore_upstream = prj_object.ignore_upstream
+
+        prj_object.read_config(self.conf.projects, self.mirror_dir)
+        if prj_object.parent != old_parent or (not prj_object.branches) != old_ignore_upstream:
+            prj_object.sql_update_row(self._cursor)
+            self._mark_project_changed(project, CHANGE_UPDATE)
+        if prj_object.parent != old_parent:
+            # the errors about the parent of all packages of the project need
+            # to be checked again
+            self._post_analysis_full = True
+
+        # Only load the rows of the source packages: their children are loaded
+        # one source package at a time, to not keep the whole project in
+        # memory
+        old_srcpackages = {}
+        for srcpackage in SrcPackage.sql_get_all(self._cursor, prj_object):
+            old_srcpackages[srcpackage.name] = srcpackage
+
+        added = []
+        updated = []
+        changed = set()
+
+        previous = PreviousAnalysis(self._cursor, prj_object, list(old_srcpackages.values()))
+        srcpackages = prj_object.iter_from_disk(self.mirror_dir, self.upstream, previous = previous, spec_cache = self._spec_cache)
+        for srcpackage in srcpackages:
+            if srcpackage.name in old_srcpackages:
+                old_srcpackage = old_srcpackages.pop(srcpackage.name)
+                # if the analysis was reused, the children have already been
+                # loaded by previous
+                if not previous.was_reused(srcpackage.name):
+                    old_srcpackage._sql_fill(self._cursor)
+                if old_srcpackage.sql_update_from(self._cursor, srcpackage):
+                    updated.append(old_srcpackage.sql_id)
+            else:
+                srcpackage.sql_add(self._cursor)
+                added.append(srcpackage.sql_id)
+
+        for old_srcpackage in old_srcpackages.values():
+            old_srcpackage.sql_remove(self._cursor)
+            changed.add(old_srcpackage.sql_id)
+            self._mark_srcpackage_removed(project, old_srcpackage.name)
+
+        self._mark_srcpackages_changed(added, CHANGE_ADD)
+        self._mark_srcpackages_changed(updated, CHANGE_UPDATE)
+        changed.update(added)
+        changed.update(updated)
+
+        self._debug_print('%d source package(s) changed in %s' % (len(changed), project))
+
+        return changed
 
     def remove_project(self, project):
         """ Remove the project from the database. """
@@ -2037,7 +3093,16 @@ class ObsDb:
 
         self._debug_print('Removing project %s' % project)
 
+        self._cursor.execute('''SELECT A.id, A.name FROM %s AS A, %s AS B
+                                WHERE A.project = B.id AND B.name = ?
+                                ;''' % (SrcPackage.sql_table, Project.sql_table),
+                                (project,))
+        for row in self._cursor.fetchall():
+            self._changed_srcpackages.add(row['id'])
+            self._mark_srcpackage_removed(project, row['name'])
+
         Project.sql_simple_remove(self._cursor, project)
+        self._mark_project_changed(project, CHANGE_REMOVE)
 
     def _add_package_internal(self, prj_object, package):
         """ Internal helper to add a package. """
@@ -2050,7 +3115,7 @@ class ObsDb:
             return
 
         pkg_object = SrcPackage(package, prj_object)
-        pkg_object.read_from_disk(project_dir, self.upstream)
+        pkg_object.read_from_disk(project_dir, self.upstream, self._spec_cache)
         if not pkg_object.has_meta:
             # In theory, this shouldn't be needed since added packages
             # should have a _meta file. Since it's unlikely to happen, it's
@@ -2059,6 +3124,7 @@ class ObsDb:
             (pkg_object.devel_project, pkg_object.devel_package) = prj_object.get_meta(self.mirror_dir, package)
 
         pkg_object.sql_add(self._cursor)
+        self._mark_srcpackages_changed([ pkg_object.sql_id ], CHANGE_ADD)
 
         # Make sure we also have the devel project if we're interested in that
         if pkg_object.has_meta and pkg_object.devel_project and prj_object.name in self.conf.projects and self.conf.projects[prj_object.name].checkout_devel_projects:
@@ -2076,10 +3142,19 @@ class ObsDb:
             print('Updated package %s in %s does not exist in mirror.' % (package, prj_object.name), file=sys.stderr)
             return
 
+        # Nothing to parse if the package did not change
+        if oldpkg_object.can_reuse_analysis(oldpkg_object.get_fingerprint(project_dir)):
+            self._debug_print('%s/%s did not change' % (prj_object.name, package))
+            if oldpkg_object.sql_update_upstream(self._cursor, self.upstream):
+                self._mark_srcpackages_changed([ oldpkg_object.sql_id ], CHANGE_UPSTREAM)
+            return
+
+        oldpkg_object._sql_fill(self._cursor)
+
         update_children = False
 
         pkg_object = SrcPackage(package, prj_object)
-        pkg_object.read_from_disk(project_dir, self.upstream)
+        pkg_object.read_from_disk(project_dir, self.upstream, self._spec_cache)
         if not pkg_object.has_meta:
             # If the metadata was updated, we should have a _meta file for the
             # package. If this is not the case, then the metadata was not
@@ -2092,7 +3167,8 @@ class ObsDb:
                 pkg_object.devel_package != oldpkg_object.devel_package):
                 update_children = True
 
-        oldpkg_object.sql_update_from(self._cursor, pkg_object)
+        if oldpkg_object.sql_update_from(self._cursor, pkg_object):
+            self._mark_srcpackages_changed([ oldpkg_object.sql_id ], CHANGE_UPDATE)
 
         # If the devel package has changed, then "children" packages might have
         # a different error now. See _not_real_devel_package().
@@ -2126,7 +3202,8 @@ class ObsDb:
 
         prj_object.read_config(self.conf.projects, self.mirror_dir)
 
-        pkg_object = SrcPackage.sql_get(self._cursor, prj_object, package, True)
+        # children are only loaded if the package needs to be updated
+        pkg_object = SrcPackage.sql_get(self._cursor, prj_object, package)
         if pkg_object:
             self._update_package_internal(prj_object, package, pkg_object)
         else:
@@ -2143,7 +3220,350 @@ class ObsDb:
 
         self._debug_print('Removing %s/%s' % (project, package))
 
-        SrcPackage.sql_simple_remove(self._cursor, project, package)
+        ids = SrcPackage.sql_simple_remove(self._cursor, project, package)
+        self._changed_srcpackages.update(ids)
+        if ids:
+            self._mark_srcpackage_removed(project, package)
+
+    def _get_srcpackage_keys(self, ids):
+        """ Return the (project, package) of the source packages with ids. """
+        keys = set()
+        ids = list(ids)
+        for index in range(0, len(ids), SQL_IN_CHUNK_SIZE):
+            chunk = ids[index:index + SQL_IN_CHUNK_SIZE]
+            self._cursor.execute('''SELECT A.name, B.name AS project FROM %s AS A, %s AS B
+                                    WHERE A.project = B.id AND A.id IN (%s)
+                                    ;''' % (SrcPackage.sql_table, Project.sql_table, ', '.join([ '?' ] * len(chunk))),
+                                    chunk)
+            keys.update([ (row['project'], row['name']) for row in self._cursor ])
+        return keys
+
+    def _get_run(self):
+        """ Return the id of the current run, starting a new one if needed.
+
+            Ids of runs are increasing, and are based on the time, so that
+            they keep increasing when the database is rebuilt.
+
+        """
+        if self._run is None:
+            self._cursor.execute('''SELECT MAX(id) FROM run;''')
+            last = self._cursor.fetchone()[0] or 0
+            self._run = max(int(time.time()), last + 1)
+            self._cursor.execute('''INSERT INTO run VALUES (
+                ?, 0
+                );''', (self._run,))
+        return self._run
+
+    def _end_run(self):
+        """ Mark the current run as finished, and forget about old runs. """
+        if self._run is None:
+            return
+
+        # the dependencies change with the projects whose data changed in this
+        # run; the post-analysis and upstream changes only touch errors and
+        # upstream data, which do not matter for dependencies (this also
+        # avoids looking at all projects again after a rebuild, when the
+        # post-analysis changes many packages)
+        self._cursor.execute('''SELECT DISTINCT project FROM changes WHERE run = ? AND kind IN (?, ?, ?);''',
+                             (self._run, CHANGE_ADD, CHANGE_UPDATE, CHANGE_REMOVE))
+        self._update_project_dependencies([ project for (project,) in self._cursor.fetchall() ])
+
+        self._cursor.execute('''UPDATE run SET finished = 1 WHERE id = ?;''', (self._run,))
+        self._run = None
+
+        self._cursor.execute('''SELECT id FROM run ORDER BY id DESC LIMIT 1 OFFSET ?;''', (CHANGES_MAX_RUNS - 1,))
+        row = self._cursor.fetchone()
+        if row:
+            self._cursor.execute('''DELETE FROM changes WHERE run < ?;''', (row['id'],))
+            self._cursor.execute('''DELETE FROM run WHERE id < ?;''', (row['id'],))
+
+        self._dbconn.commit()
+
+    def _update_project_dependencies(self, projects = None):
+        """ Update the dependencies between projects that come from the data
+            of projects. See _sql_setup_dependency_table().
+
+            projects -- The projects whose data changed. None means all
+                        projects, and is used when the database is created.
+
+        """
+        query = '''INSERT OR IGNORE INTO project_dependency
+            SELECT A.link_project, B.name, B.name FROM %(SrcPackage)s AS A, %(Project)s AS B
+            WHERE A.project = B.id AND A.link_project != '' %(restrict)s
+            UNION SELECT A.devel_project, B.name, B.name FROM %(SrcPackage)s AS A, %(Project)s AS B
+            WHERE A.project = B.id AND A.devel_project != '' %(restrict)s
+            UNION SELECT B.name, A.devel_project, B.name FROM %(SrcPackage)s AS A, %(Project)s AS B
+            WHERE A.project = B.id AND A.devel_project != '' %(restrict)s
+            UNION SELECT B.parent, B.name, B.name FROM %(Project)s AS B
+            WHERE B.parent != '' %(restrict)s
+            ;'''
+        mapping = { 'SrcPackage': SrcPackage.sql_table, 'Project': Project.sql_table }
+
+        if projects is None:
+            mapping['restrict'] = ''
+            self._cursor.execute('''DELETE FROM project_dependency;''')
+            self._cursor.execute(query % mapping)
+            return
+
+        mapping['restrict'] = 'AND B.name = ?'
+        lost = []
+
+        for project in projects:
+            self._cursor.execute('''SELECT project, dependent FROM project_dependency WHERE origin = ?;''', (project,))
+            old = set([ tuple(row) for row in self._cursor ])
+            self._cursor.execute('''DELETE FROM project_dependency WHERE origin = ?;''', (project,))
+            self._cursor.execute(query % mapping, (project,) * 4)
+            self._cursor.execute('''SELECT project, dependent FROM project_dependency WHERE origin = ?;''', (project,))
+            new = set([ tuple(row) for row in self._cursor ])
+
+            # a project that does not depend on this one anymore still needs
+            # to be looked at for this run (eg, for packages that do not need
+            # to be listed as missing anymore)
+            lost.extend([ (dependent, '', CHANGE_DEPENDENCY) for (dependency, dependent) in old - new if dependent != project ])
+
+        self._record_changes(lost)
+
+    def _record_changes(self, changes):
+        """ Record (project, package, kind) changes in the current run.
+
+            package is '' for changes to the project itself.
+
+        """
+        run = self._get_run()
+        self._cursor.executemany('''INSERT OR IGNORE INTO changes VALUES (
+            ?, ?, ?, ?
+            );''', [ (run, project, package, kind) for (project, package, kind) in changes ])
+
+    def _mark_srcpackages_changed(self, ids, kind):
+        """ Remember that the source packages with ids were added or updated. """
+        if not ids:
+            return
+        self._changed_srcpackages.update(ids)
+        self._record_changes([ (project, package, kind) for (project, package) in self._get_srcpackage_keys(ids) ])
+
+    def _mark_srcpackage_removed(self, project, package):
+        """ Remember that a source package was removed, or is about to be. """
+        self._removed_srcpackages.add((project, package))
+        self._record_changes([ (project, package, CHANGE_REMOVE) ])
+
+    def _mark_project_changed(self, project, kind):
+        """ Remember that the row of a project was added, updated or removed. """
+        self._record_changes([ (project, '', kind) ])
+
+    def get_changes_since(self, run, kinds = None):
+        """ Return the changes made after the run with id run.
+
+            kinds -- If not None, the kinds of changes to return.
+
+            Return a tuple (last_run, changes): last_run is the id of the last
+            finished run, to use in the next call, and changes is a set of
+            (project, package, kind) tuples, package being '' for changes to
+            the project itself. changes is None if the changes since run are
+            not known (for instance, for run -1, after a rebuild of the
+            database, or when run is too old): everything should then be
+            considered as changed.
+
+        """
+        self._open_existing_db_if_necessary()
+
+        self._cursor.execute('''SELECT MAX(id) FROM run WHERE finished = 1;''')
+        last_run = self._cursor.fetchone()[0]
+        self._cursor.execute('''SELECT MIN(id) FROM run;''')
+        first_run = self._cursor.fetchone()[0]
+
+        if last_run is None:
+            return (-1, None)
+        if run < first_run or run > last_run:
+            return (last_run, None)
+
+        if kinds is None:
+            self._cursor.execute('''SELECT DISTINCT project, package, kind FROM changes
+                                    WHERE run > ? AND run <= ?;''', (run, last_run))
+        else:
+            self._cursor.execute('''SELECT DISTINCT project, package, kind FROM changes
+                                    WHERE run > ? AND run <= ? AND kind IN (%s);''' % ', '.join([ '?' ] * len(kinds)),
+                                    [ run, last_run ] + list(kinds))
+
+        changes = set([ (row['project'], row['package'], row['kind']) for row in self._cursor ])
+        return (last_run, changes)
+
+    def get_changed_projects_since(self, run):
+        """ Return the projects that changed after the run with id run.
+
+            Return a tuple (last_run, projects), with projects being None if
+            the changes since run are not known. See get_changes_since().
+
+        """
+        (last_run, changes) = self.get_changes_since(run)
+        if changes is None:
+            return (last_run, None)
+        return (last_run, set([ project for (project, package, kind) in changes ]))
+
+    def get_snapshot_filename(self):
+        """ Return the path of the snapshot created by publish_snapshot(). """
+        return os.path.join(self.db_dir, 'snapshot', 'obs.db')
+
+    def get_delta_filename(self):
+        """ Return the path of the delta created by publish_snapshot(). """
+        return os.path.join(self.db_dir, 'snapshot', 'obs-delta.db')
+
+    def publish_snapshot(self):
+        """ Write a consistent copy of the database, to be used by others
+            (like the upload to the web server).
+
+            The copy is written to a temporary file that is then renamed, so
+            the snapshot is never seen half-written. It does not use WAL, so
+            it can be read without write access to its directory.
+
+            Each snapshot is identified by a random token. If the changes
+            since the previous snapshot are known, a delta against it is also
+            written (see _write_delta()); else, any old delta is removed.
+
+        """
+        self._open_existing_db_if_necessary()
+
+        filename = self.get_snapshot_filename()
+        tmpfilename = filename + '.new'
+        delta_filename = self.get_delta_filename()
+        tmpdelta_filename = delta_filename + '.new'
+
+        self._debug_print('Publishing snapshot of the database')
+
+        util.safe_mkdir_p(os.path.dirname(filename))
+        _remove_db_file(tmpfilename)
+        _remove_db_file(delta_filename)
+
+        # the snapshot contains everything up to the current run
+        self._end_run()
+
+        self._cursor.execute('''SELECT token, run FROM snapshot;''')
+        row = self._cursor.fetchone()
+        if row:
+            (base_token, base_run) = (row['token'], row['run'])
+        else:
+            (base_token, base_run) = (None, -1)
+        (last_run, changes) = self.get_changes_since(base_run)
+        token = uuid.uuid4().hex
+
+        self._cursor.execute('''DELETE FROM snapshot;''')
+        self._cursor.execute('''INSERT INTO snapshot VALUES (?, ?);''', (token, last_run))
+        self._dbconn.commit()
+
+        snapshot = sqlite3.connect(tmpfilename)
+        try:
+            self._dbconn.backup(snapshot)
+            snapshot.execute('''PRAGMA journal_mode = DELETE;''')
+            snapshot.close()
+            os.rename(tmpfilename, filename)
+        except:
+            snapshot.close()
+            _remove_db_file(tmpfilename)
+            raise
+
+        if changes is None:
+            return
+
+        keys = set([ (project, package) for (project, package, kind) in changes ])
+        self._debug_print('Writing delta with %d change(s)' % len(keys))
+
+        try:
+            self._write_delta(tmpdelta_filename, base_token, token, base_run, keys)
+            os.rename(tmpdelta_filename, delta_filename)
+        except:
+            _remove_db_file(tmpdelta_filename)
+            raise
+
+    def _write_delta(self, filename, base_token, token, base_run, keys):
+        """ Write the changes between the snapshot identified by base_token and
+            the current database, identified by token.
+
+            The delta contains the (project, package) keys that changed (with
+            package being '' for the project itself), and the current rows
+            for those keys, with their ids. It can be applied to a copy of the
+            previous snapshot by removing the rows for the keys, and
+            inserting the rows from the delta.
+
+            The log of changes is part of the snapshot: the delta contains all
+            runs, and the changes made after base_run. The dependencies
+            between projects are too: the delta contains those coming from
+            the changed projects, which replace the ones with the same origin.
+
+        """
+        _remove_db_file(filename)
+
+        delta = sqlite3.connect(filename)
+        cursor = delta.cursor()
+        _sql_setup_data_tables(cursor)
+        _sql_setup_changes_tables(cursor)
+        _sql_setup_dependency_table(cursor)
+        cursor.execute('''CREATE TABLE delta_info (
+            base_token TEXT,
+            token TEXT,
+            major INTEGER,
+            minor INTEGER,
+            projects INTEGER,
+            srcpackages INTEGER
+            );''')
+        cursor.execute('''CREATE TABLE delta_keys (
+            project TEXT,
+            package TEXT
+            );''')
+        cursor.executemany('''INSERT INTO delta_keys VALUES (?, ?);''', keys)
+
+        # the number of rows, to verify the result once the delta is applied
+        self._cursor.execute('''SELECT COUNT(*) FROM %s;''' % Project.sql_table)
+        projects = self._cursor.fetchone()[0]
+        self._cursor.execute('''SELECT COUNT(*) FROM %s;''' % SrcPackage.sql_table)
+        srcpackages = self._cursor.fetchone()[0]
+        cursor.execute('''INSERT INTO delta_info VALUES (
+            ?, ?, ?, ?, ?, ?
+            );''', (base_token, token, DB_MAJOR, DB_MINOR, projects, srcpackages))
+
+        delta.commit()
+        cursor.close()
+        delta.close()
+
+        # the delta only contains some of the rows, so the foreign keys cannot
+        # be satisfied there
+        self._dbconn.execute('''PRAGMA foreign_keys = OFF;''')
+        self._cursor.execute('''ATTACH DATABASE ? AS delta;''', (filename,))
+        try:
+            self._cursor.execute('''INSERT INTO delta.%(project)s
+                SELECT * FROM main.%(project)s WHERE name IN (
+                    SELECT project FROM delta.delta_keys WHERE package = ''
+                );''' % { 'project': Project.sql_table })
+            self._cursor.execute('''INSERT INTO delta.%(srcpackage)s
+                SELECT A.* FROM main.%(srcpackage)s AS A, main.%(project)s AS B, delta.delta_keys AS K
+                WHERE A.project = B.id AND B.name = K.project AND A.name = K.package
+                ;''' % { 'srcpackage': SrcPackage.sql_table, 'project': Project.sql_table })
+            for cls in [ Package, Source, Patch, File, RpmlintReport ]:
+                self._cursor.execute('''INSERT INTO delta.%(table)s
+                    SELECT * FROM main.%(table)s WHERE srcpackage IN (
+                        SELECT id FROM delta.%(srcpackage)s
+                    );''' % { 'table': cls.sql_table, 'srcpackage': SrcPackage.sql_table })
+            self._cursor.execute('''INSERT INTO delta.run SELECT * FROM main.run;''')
+            self._cursor.execute('''INSERT INTO delta.changes SELECT * FROM main.changes WHERE run > ?;''', (base_run,))
+            self._cursor.execute('''INSERT INTO delta.project_dependency
+                SELECT * FROM main.project_dependency WHERE origin IN (
+                    SELECT project FROM delta.delta_keys
+                );''')
+            self._dbconn.commit()
+        finally:
+            self._cursor.execute('''DETACH DATABASE delta;''')
+            self._dbconn.execute('''PRAGMA foreign_keys = ON;''')
+
+    def get_changed_srcpackages(self):
+        """ Return the ids of source packages that got added, updated or
+            removed since the database was opened, or since the last call to
+            reset_changed_srcpackages().
+
+        """
+        return set(self._changed_srcpackages)
+
+    def reset_changed_srcpackages(self):
+        """ Forget about the source packages that changed. """
+        self._changed_srcpackages = set()
+        self._removed_srcpackages = set()
 
     def get_devel_projects(self, project):
         """ Return the list of devel projects used by packages in project. """
@@ -2163,11 +3583,12 @@ class ObsDb:
         self._cursor.execute('''SELECT name FROM %s;''' % Project.sql_table)
         return [ name for (name,) in self._cursor.fetchall() ]
 
-    def upstream_changes(self, upstream_mtime):
-        """ Updates the upstream data that has changed since last time.
-        
-            Return a list of projects that have been updated.
-        
+    def _get_upstream_changed_srcpackages(self, upstream_mtime):
+        """ Get the source packages that are affected by upstream changes.
+
+            Return a list of (project, id, name) tuples, where project is the
+            Project object (with its config) of the source package.
+
         """
         branches = self.upstream.get_changed_packages(upstream_mtime)
 
@@ -2176,48 +3597,73 @@ class ObsDb:
 
         self._open_existing_db_if_necessary()
 
-        # Get all projects, with their config, and update the necessary
-        # packages if needed
-        projects = Project.sql_get_all(self._cursor, recursive = False)
-        for project in projects:
+        projects = {}
+        for project in Project.sql_get_all(self._cursor, recursive = False):
             project.read_config(self.conf.projects, self.mirror_dir)
+            projects[project.sql_id] = project
+
+        # Look for all the changed names at once, with the index on the names
+        # of source packages, instead of looking at each project for each
+        # branch
+        self._cursor.execute('''DROP TABLE IF EXISTS temp.upstream_changed;''')
+        self._cursor.execute('''CREATE TEMP TABLE upstream_changed (branch TEXT, name TEXT);''')
+        self._cursor.executemany('''INSERT INTO upstream_changed VALUES (?, ?);''',
+                                 [ (branch, name) for (branch, names) in branches.items() for name in names ])
+        self._cursor.execute('''SELECT A.project, A.id, A.name, B.branch FROM %s AS A, upstream_changed AS B
+                                WHERE A.name = B.name
+                                ;''' % SrcPackage.sql_table)
+        rows = self._cursor.fetchall()
+        self._cursor.execute('''DROP TABLE temp.upstream_changed;''')
+
+        affected = {}
+
+        for (project_id, id, name, branch) in rows:
+            if id in affected:
+                continue
 
-        updated_projects = set()
-
-        for project in projects:
-            for branch in list(branches.keys()):
-                if branch != upstream.MATCH_CHANGE_NAME and not branch in project.branches:
-                    continue
+            project = projects[project_id]
 
+            if branch == upstream.MATCH_CHANGE_NAME:
                 branches_before = []
-                if branch in project.branches:
-                    branches_before = project.branches[:project.branches.index(branch)]
+            elif branch in project.branches:
+                branches_before = project.branches[:project.branches.index(branch)]
+            else:
+                continue
 
-                self._cursor.execute('''SELECT name FROM %s WHERE project = ?;''' % SrcPackage.sql_table, (project.sql_id,))
-                srcpackages = [ name for (name,) in self._cursor ]
+            # the data comes from a branch that has precedence
+            if self.upstream.exists_in_branches(branches_before, name):
+                continue
 
-                # so we're only interested in the intersection of the two sets
-                # (in the project, and in the changed entries)
-                affected_srcpackages = set(branches[branch]).intersection(srcpackages)
+            affected[id] = (project, id, name)
 
-                if not affected_srcpackages:
-                    continue
+        result = sorted(affected.values(), key = lambda item: (item[0].name, item[2]))
+        for (project, id, name) in result:
+            self._debug_print('Upstream changes: %s -- %s' % (project.name, name))
 
-                updated_projects.add(project.name)
+        return result
 
-                self._debug_print('Upstream changes: %s -- %s' % (project.name, affected_srcpackages))
+    def upstream_changes(self, upstream_mtime):
+        """ Updates the upstream data that has changed since last time.
+        
+            Return a list of projects that have been updated.
+        
+        """
+        srcpackages = self._get_upstream_changed_srcpackages(upstream_mtime)
 
-                for srcpackage in affected_srcpackages:
-                    if self.upstream.exists_in_branches(branches_before, srcpackage):
-                        continue
+        if not srcpackages:
+            return []
 
-                    (upstream_name, upstream_version, upstream_url) = self.upstream.get_upstream_data(project.branches, srcpackage)
-                    self._cursor.execute('''UPDATE %s SET
-                            upstream_name = ?, upstream_version = ?, upstream_url = ?
-                            WHERE name = ? AND project = ?;''' % SrcPackage.sql_table,
-                            (upstream_name, upstream_version, upstream_url, srcpackage, project.sql_id))
+        updated = []
+        for (project, id, name) in srcpackages:
+            (upstream_name, upstream_version, upstream_url) = self.upstream.get_upstream_data(project.branches, name)
+            updated.append((upstream_name, upstream_version, upstream_url, id))
 
-        return list(updated_projects)
+        self._cursor.executemany('''UPDATE %s SET
+                upstream_name = ?, upstream_version = ?, upstream_url = ?
+                WHERE id = ?;''' % SrcPackage.sql_table, updated)
+        self._record_changes([ (project.name, name, CHANGE_UPSTREAM) for (project, id, name) in srcpackages ])
+
+        return list(set([ project.name for (project, id, name) in srcpackages ]))
 
     def get_packages_with_upstream_change(self, upstream_mtime):
         """ Get the list of packages that are affected by upstream changes.
@@ -2226,155 +3672,229 @@ class ObsDb:
             one containing a tuple (upstream_version, upstream_url).
 
         """
-        branches = self.upstream.get_changed_packages(upstream_mtime)
-
-        if not branches:
-            return {}
-
-        self._open_existing_db_if_necessary()
-
-        # Get all projects, with their config, and update the necessary
-        # packages if needed
-        projects = Project.sql_get_all(self._cursor, recursive = False)
-        for project in projects:
-            project.read_config(self.conf.projects, self.mirror_dir)
-
         result = {}
 
-        for project in projects:
-            for branch in list(branches.keys()):
-                if branch != upstream.MATCH_CHANGE_NAME and not branch in project.branches:
-                    continue
+        for (project, id, name) in self._get_upstream_changed_srcpackages(upstream_mtime):
+            (upstream_name, upstream_version, upstream_url) = self.upstream.get_upstream_data(project.branches, name)
+            if project.name not in result:
+                result[project.name] = {}
+            result[project.name][name] = (upstream_version, upstream_url)
 
-                branches_before = []
-                if branch in project.branches:
-                    branches_before = project.branches[:project.branches.index(branch)]
+        return result
 
-                self._cursor.execute('''SELECT name FROM %s WHERE project = ?;''' % SrcPackage.sql_table, (project.sql_id,))
-                srcpackages = [ name for (name,) in self._cursor ]
+    def get_packages_upstream_data(self, keys):
+        """ Get the upstream data of some packages.
 
-                # so we're only interested in the intersection of the two sets
-                # (in the project, and in the changed entries)
-                affected_srcpackages = set(branches[branch]).intersection(srcpackages)
+            keys -- (project, package) of the packages. Packages that do not
+                    exist are ignored.
 
-                if not affected_srcpackages:
-                    continue
+            Return the same structure as get_packages_with_upstream_change().
 
-                if project.name not in result:
-                    result[project.name] = {}
+        """
+        self._open_existing_db_if_necessary()
 
-                self._debug_print('Upstream changes: %s -- %s' % (project.name, affected_srcpackages))
+        result = {}
 
-                for srcpackage in affected_srcpackages:
-                    if self.upstream.exists_in_branches(branches_before, srcpackage):
-                        continue
+        for (project, package) in keys:
+            self._cursor.execute('''SELECT A.upstream_version, A.upstream_url FROM %s AS A, %s AS B
+                                    WHERE A.project = B.id AND B.name = ? AND A.name = ?
+                                    ;''' % (SrcPackage.sql_table, Project.sql_table),
+                                    (project, package))
+            row = self._cursor.fetchone()
+            if not row:
+                continue
 
-                    (upstream_name, upstream_version, upstream_url) = self.upstream.get_upstream_data(project.branches, srcpackage)
-                    result[project.name][srcpackage] = (upstream_version, upstream_url)
+            if project not in result:
+                result[project] = {}
+            result[project][package] = (row['upstream_version'], row['upstream_url'])
 
         return result
 
-    def post_analyze(self):
+    def _get_post_analysis_ids(self):
+        """ Return the ids of source packages that the post-analysis needs to
+            look at, because of the source packages that changed.
+
+            Those are the changed source packages themselves, the source
+            packages with the same name in projects using their project as
+            parent, and the source packages linking to them.
+
+        """
+        keys = set(self._removed_srcpackages)
+        keys.update(self._get_srcpackage_keys(self._changed_srcpackages))
+
+        ids = set(self._changed_srcpackages)
+        for (project, package) in keys:
+            # packages that could exist in this project
+            self._cursor.execute('''SELECT A.id FROM %s AS A, %s AS B
+                                    WHERE A.project = B.id AND A.name = ? AND B.parent = ?
+                                    ;''' % (SrcPackage.sql_table, Project.sql_table),
+                                    (package, project))
+            ids.update([ id for (id,) in self._cursor ])
+            # packages linking to this package
+            self._cursor.execute('''SELECT id FROM %s
+                                    WHERE link_project = ? AND link_package = ?
+                                    ;''' % SrcPackage.sql_table,
+                                    (project, package))
+            ids.update([ id for (id,) in self._cursor ])
+            self._cursor.execute('''SELECT id FROM %s
+                                    WHERE name = ? AND link_project = ? AND (link_package = '' OR link_package IS NULL)
+                                    ;''' % SrcPackage.sql_table,
+                                    (package, project))
+            ids.update([ id for (id,) in self._cursor ])
+
+        return ids
+
+    def post_analyze(self, full = False):
         """
             Do some post-commit analysis on the db, to find new errors now that
             we have all the data.
+
+            Only the source packages that might be affected by the changes
+            since the database was opened are looked at (see
+            _get_post_analysis_ids()), unless full is True. A full pass gives
+            the same result, and can be used as a consistency check. A full
+            pass is also done after a rebuild, after the parent of a project
+            changed in update_project(), and when too many source packages
+            changed (see POST_ANALYSIS_INCREMENTAL_MAX).
         """
         self._open_existing_db_if_necessary()
 
-        self._debug_print('Post analysis')
+        ids = None
+        if not full and not self._post_analysis_full and len(self._changed_srcpackages) + len(self._removed_srcpackages) <= POST_ANALYSIS_INCREMENTAL_MAX:
+            ids = self._get_post_analysis_ids()
 
-        def _not_link_and_not_in_parent(devel_package_cache, cursor_helper, row):
-            """
-                Check if this is not a link and if it doesn't exist in the
-                potential parent. In that case, the error is that maybe it
-                should exist there
-            """
-            # Note: if the package was changed in any way, we won't have
-            # the 'not-link-not-in-parent' error (since it's added only here).
-            # So if we have it, it means the package hasn't been updated and is
-            # therefore still a link. But the parent might have been created in
-            # the meantime, so it's possible to go back to 'not-link'.
+        self._cursor.execute('''DROP TABLE IF EXISTS temp.post_analysis_ids;''')
+        if ids is None:
+            self._debug_print('Post analysis')
+            restrict = ''
+        else:
+            self._debug_print('Post analysis of %d source package(s)' % len(ids))
+            self._cursor.execute('''CREATE TEMP TABLE post_analysis_ids (id INTEGER PRIMARY KEY);''')
+            self._cursor.executemany('''INSERT INTO post_analysis_ids VALUES (?);''', [ (id,) for id in ids ])
+            restrict = 'AND A.id IN (SELECT id FROM post_analysis_ids)'
+
+        # The errors are computed in temporary tables, and then applied with
+        # one UPDATE per rule. All this happens in the current transaction,
+        # which is committed with the rest of the run.
+
+        # Not a link, and doesn't exist in the potential parent: the error is
+        # that maybe it should exist there.
+        #
+        # Note: if the package was changed in any way, we won't have the
+        # 'not-link-not-in-parent' error (since it's added only here). So if
+        # we have it, it means the package hasn't been updated and is
+        # therefore still a link. But the parent might have been created in
+        # the meantime, so it's possible to go back to 'not-link'.
+        self._cursor.execute('''DROP TABLE IF EXISTS temp.post_analysis_not_in_parent;''')
+        self._cursor.execute('''CREATE TEMP TABLE post_analysis_not_in_parent (id INTEGER PRIMARY KEY, error TEXT, details TEXT);''')
+        self._cursor.execute('''INSERT INTO post_analysis_not_in_parent
+            SELECT id, error, '' FROM (
+                SELECT A.id AS id, A.obs_error AS old_error,
+                    CASE WHEN EXISTS (
+                        SELECT 1 FROM %(srcpackage)s AS P, %(project)s AS PB
+                        WHERE P.project = PB.id AND PB.name = B.parent AND P.name = A.name
+                    ) THEN 'not-link' ELSE 'not-link-not-in-parent' END AS error
+                FROM %(srcpackage)s AS A, %(project)s AS B
+                WHERE A.project = B.id
+                    AND A.obs_error IN ('not-link', 'not-link-not-in-parent')
+                    AND B.parent IS NOT NULL AND B.parent != ''
+                    %(restrict)s
+            )
+            WHERE error != old_error
+            ;''' % { 'srcpackage': SrcPackage.sql_table, 'project': Project.sql_table, 'restrict': restrict })
+
+        # A link package that is not the devel package of its parent. The
+        # errors here are not relevant to toplevel projects (ie, projects
+        # without a parent), nor to internal links inside a project (to build
+        # another spec file). If the parent package doesn't exist, the link
+        # will be broken, so we already have an error.
+        #
+        # Note: the errors created here can disappear when the devel package
+        # of the link package changes, without the current package changing.
+        # This is handled in _update_package_internal().
+        self._cursor.execute('''DROP TABLE IF EXISTS temp.post_analysis_not_real_devel;''')
+        self._cursor.execute('''CREATE TEMP TABLE post_analysis_not_real_devel (id INTEGER PRIMARY KEY, error TEXT, details TEXT);''')
+        self._cursor.execute('''INSERT INTO post_analysis_not_real_devel
+            SELECT id, error, details FROM (
+                SELECT A.id AS id, A.obs_error AS old_error, A.obs_error_details AS old_details,
+                    CASE WHEN T.devel_project != '' THEN 'not-real-devel' ELSE 'parent-without-devel' END AS error,
+                    CASE WHEN T.devel_project != '' THEN 'development project is ' || T.devel_project ELSE '' END AS details
+                FROM %(srcpackage)s AS A, %(project)s AS B, %(project)s AS TB, %(srcpackage)s AS T
+                WHERE A.project = B.id
+                    AND (B.parent IS NULL OR B.parent != '')
+                    AND A.link_project IS NOT B.name
+                    AND TB.name = A.link_project
+                    AND T.project = TB.id AND T.name = COALESCE(NULLIF(A.link_package, ''), A.name)
+                    AND (T.devel_project IS NOT B.name OR COALESCE(NULLIF(T.devel_package, ''), T.name) IS NOT A.name)
+                    AND A.id NOT IN (SELECT id FROM post_analysis_not_in_parent)
+                    %(restrict)s
+            )
+            WHERE error IS NOT old_error OR details IS NOT old_details
+            ;''' % { 'srcpackage': SrcPackage.sql_table, 'project': Project.sql_table, 'restrict': restrict })
+
+        for table in [ 'post_analysis_not_in_parent', 'post_analysis_not_real_devel' ]:
+            self._cursor.execute('''UPDATE %(srcpackage)s SET
+                obs_error = (SELECT error FROM %(table)s WHERE %(table)s.id = %(srcpackage)s.id),
+                obs_error_details = (SELECT details FROM %(table)s WHERE %(table)s.id = %(srcpackage)s.id)
+                WHERE id IN (SELECT id FROM %(table)s)
+                ;''' % { 'srcpackage': SrcPackage.sql_table, 'table': table })
+
+            self._cursor.execute('''SELECT id FROM %s;''' % table)
+            self._mark_srcpackages_changed([ id for (id,) in self._cursor.fetchall() ], CHANGE_ANALYSIS)
+            self._cursor.execute('''DROP TABLE %s;''' % table)
+
+        self._cursor.execute('''DROP TABLE IF EXISTS temp.post_analysis_ids;''')
+
+        self._post_analysis_full = False
 
-            if row['obs_error'] not in [ 'not-link', 'not-link-not-in-parent' ]:
-                return False
 
-            project_parent = row['project_parent']
-            if not project_parent:
-                return False
 
-            try:
-                devel_package_cache[project_parent][row['name']]
-                error = 'not-link'
-            except KeyError:
-                error = 'not-link-not-in-parent'
+#######################################################################
 
-            if row['obs_error'] != error:
-                details = ''
-                cursor_helper.execute('''UPDATE %s SET obs_error = ?, obs_error_details = ? WHERE id = ?;''' % SrcPackage.sql_table, (error, details, row['id']))
-                return True
 
-            return False
+def main(args):
+    """ Benchmark the parsing of spec files.
 
-        def _not_real_devel_package(devel_package_cache, cursor_helper, row):
-            """
-                Look if the link package should really exist there (ie, is it
-                the devel package of the parent?)
-            """
-            # Note: the errors created here can disappear when the devel
-            # package of the link package changes, without the current package
-            # changing. This is handled in _update_package_internal().
+        Usage: database.py DIRECTORY...
 
-            # the errors here are not relevant to toplevel projects (ie,
-            # projects without a parent)
-            if row['project_parent'] == '':
-                return False
+        All the spec files found in the directories (for instance, a checkout
+        of openSUSE:Factory) are parsed a few times, and the best time is
+        kept. The spec cache is not used.
 
-            link_project = row['link_project']
-            link_package = row['link_package'] or row['name']
+    """
 
-            # internal link inside a project (to build another spec file)
-            if link_project == row['project']:
-                return False
+    if len(args) < 2:
+        print('Usage: %s DIRECTORY...' % args[0], file=sys.stderr)
+        return 1
 
-            try:
-                (devel_project, devel_package) = devel_package_cache[link_project][link_package]
-                if devel_project != row['project'] or devel_package != row['name']:
-                    if devel_project:
-                        error = 'not-real-devel'
-                        details = 'development project is %s' % devel_project
-                    else:
-                        error = 'parent-without-devel'
-                        details = ''
-                    cursor_helper.execute('''UPDATE %s SET obs_error = ?, obs_error_details = ? WHERE id = ?;''' % SrcPackage.sql_table, (error, details, row['id']))
-                    return True
-
-            except KeyError:
-                # this happens when the parent package doesn't exist; link will
-                # be broken, so we already have an error
-                pass
+    specs = []
+    for directory in args[1:]:
+        for (root, dirs, files) in os.walk(directory):
+            specs.extend([ os.path.join(root, file) for file in files if file.endswith('.spec') ])
 
-            return False
+    if not specs:
+        print('No spec file found.', file=sys.stderr)
+        return 1
 
+    project = Project('benchmark')
 
-        devel_package_cache = {}
-        cursor_helper = self._dbconn.cursor()
+    best = None
+    for i in range(3):
+        start = time.time()
+        for spec in specs:
+            srcpackage = SrcPackage(os.path.basename(spec)[:-len('.spec')], project)
+            srcpackage._parse_spec(spec)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
 
-        self._cursor.execute('''SELECT name FROM %s;''' % Project.sql_table)
-        for row in self._cursor:
-            devel_package_cache[row['name']] = {}
+    print('Parsed %d spec files in %.3fs (%.0f spec files per second)' % (len(specs), best, len(specs) / best))
 
-        self._cursor.execute('''SELECT A.name, A.devel_project, A.devel_package, B.name AS project FROM %s AS A, %s AS B WHERE A.project = B.id;''' % (SrcPackage.sql_table, Project.sql_table))
-        for row in self._cursor:
-            devel_package = row['devel_package'] or row['name']
-            devel_package_cache[row['project']][row['name']] = (row['devel_project'], devel_package)
+    return 0
 
-        self._cursor.execute('''SELECT A.id, A.name, A.obs_error, A.link_project, A.link_package, B.name AS project, B.parent AS project_parent FROM %s AS A, %s AS B WHERE A.project = B.id;''' % (SrcPackage.sql_table, Project.sql_table))
-        for row in self._cursor:
-            if _not_link_and_not_in_parent(devel_package_cache, cursor_helper, row):
-                continue
-
-            if _not_real_devel_package(devel_package_cache, cursor_helper, row):
-                continue
-
-        cursor_helper.close()
 
+if __name__ == '__main__':
+    try:
+      sys.exit(main(sys.argv))
+    except KeyboardInterrupt:
+      pass
@@ -38,7 +38,13 @@ import os
 import sys
 
 import errno
-import filecmp
+import gzip
+import hashlib
+import json
+import multiprocessing
+import shutil
+import sqlite3
+from xml.sax.saxutils import XMLGenerator
 
 try:
     from lxml import etree as ET
@@ -74,13 +80,122 @@ class InfoXmlException(Exception):
 #######################################################################
 
 
+# Name of the file containing the digests of the XML files
+DIGESTS_FILE = 'digests'
+
+
+class DigestWriter:
+    """ File-like object writing to a file, while computing the digest of
+        what is written.
+
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        self._md5.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def _write_node(generator, node):
+    """ Write an XML node, and its children, with generator. """
+    generator.startElement(node.tag, node.attrib)
+    if node.text:
+        generator.characters(node.text)
+    for child in node:
+        _write_node(generator, child)
+    generator.endElement(node.tag)
+
+
+def _get_dict_from_node(node):
+    """ Return a dictionary with the data of an XML node, for JSON.
+
+        Attributes and children are keys of the dictionary, and the text is
+        under the 'text' key. Nodes with only text are turned into strings.
+
+    """
+    if node.text and not node.attrib and len(node) == 0:
+        return node.text
+
+    result = dict(node.attrib)
+    for child in node:
+        result[child.tag] = _get_dict_from_node(child)
+    if node.text:
+        result['text'] = node.text
+
+    return result
+
+
+def _write_json_from_xml(xmlfile, file):
+    """ Write the JSON rendition of a project XML file to file.
+
+        The result is an object with the attributes of the project, and the
+        "packages" and "missing" lists of packages.
+
+    """
+    def dump(data):
+        return json.dumps(data, separators = (',', ':'), sort_keys = True)
+
+    depth = 0
+    in_missing = False
+    first = True
+
+    for (event, node) in ET.iterparse(xmlfile, events = ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                file.write(dump(dict(node.attrib))[:-1])
+                if node.attrib:
+                    file.write(',')
+                file.write('"packages":[')
+            elif depth == 2 and node.tag == 'missing':
+                file.write('],"missing":[')
+                in_missing = True
+                first = True
+            continue
+
+        depth -= 1
+        if (depth == 1 and node.tag == 'package') or (depth == 2 and in_missing):
+            if not first:
+                file.write(',')
+            file.write(dump(_get_dict_from_node(node)))
+            first = False
+            node.clear()
+
+    if not in_missing:
+        file.write('],"missing":[')
+    file.write(']}')
+
+
+def _get_file_digest(filename):
+    """ Return the digest of the content of filename. """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as file:
+        while True:
+            data = file.read(65536)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+#######################################################################
+
+
 class InfoXml:
 
-    def __init__(self, dest_dir, debug = False):
+    def __init__(self, dest_dir, debug = False, processes = 1):
         self.dest_dir = dest_dir
         self._debug = debug
+        self._processes = processes
 
         self._version_cache = None
+        self._version_cursor = None
 
     def _debug_print(self, s):
         """ Print s if debug is enabled. """
@@ -89,10 +204,9 @@ class InfoXml:
 
     def _get_version(self, project, package):
         """ Gets the version of a package, in a safe way. """
-        try:
-            return self._version_cache[project][package]
-        except KeyError as e:
-            return None
+        if project not in self._version_cache:
+            self._version_cache[project] = self._get_project_versions(project)
+        return self._version_cache[project].get(package)
 
     def _get_package_node_from_row(self, row, ignore_upstream, default_parent_project):
         """ Get the XML node for the package defined in row. """
@@ -167,27 +281,28 @@ class InfoXml:
 
         return package
 
-    def _get_project_node(self, cursor, project):
-        """ Get the XML node for project. """
+    def _write_project(self, cursor, project, generator):
+        """ Write the XML for project with generator.
+
+            The XML is written one package at a time, so that the whole
+            document never needs to be in memory.
+
+        """
         cursor.execute('''SELECT * FROM %(Project)s WHERE name = ?;''' % SQL_TABLES, (project,))
         row = cursor.fetchone()
 
         if not row:
             raise InfoXmlException('Non-existing project: %s' % project)
 
-        if project not in self._version_cache:
-            raise InfoXmlException('Version cache was not created correctly: %s is not in the cache' % project)
-
         project_id = row['id']
         parent_project = row['parent']
         ignore_upstream = row['ignore_upstream']
 
-        prj_node = ET.Element('project')
-        prj_node.set('name', project)
+        attrs = { 'name': project }
         if parent_project:
-            prj_node.set('parent', parent_project)
+            attrs['parent'] = parent_project
         if ignore_upstream:
-            prj_node.set('ignore_upstream', 'true')
+            attrs['ignore_upstream'] = 'true'
 
         should_exist = {}
         cursor.execute('''SELECT A.name AS parent_project, B.name AS parent_package, B.devel_package
@@ -200,94 +315,190 @@ class InfoXml:
             should_devel_package = row['devel_package'] or should_parent_package
             should_exist[should_devel_package] = (should_parent_project, should_parent_package)
 
+        generator.startDocument()
+        generator.startElement('project', attrs)
+
         cursor.execute('''SELECT * FROM %(SrcPackage)s
                           WHERE project = ?
                           ORDER BY name;''' % SQL_TABLES, (project_id,))
         for row in cursor:
             pkg_node = self._get_package_node_from_row(row, ignore_upstream, parent_project)
-            prj_node.append(pkg_node)
+            _write_node(generator, pkg_node)
             try:
                 del should_exist[row['name']]
             except KeyError:
                 pass
 
         if len(should_exist) > 0:
-            missing_node = ET.Element('missing')
+            generator.startElement('missing', {})
             for (should_package_name, (should_parent_project, should_parent_package)) in should_exist.items():
-                missing_pkg_node = ET.Element('package')
-
-                missing_pkg_node.set('name', should_package_name)
-                missing_pkg_node.set('parent_project', should_parent_project)
+                attrs = { 'name': should_package_name, 'parent_project': should_parent_project }
                 if should_package_name != should_parent_package:
-                    missing_pkg_node.set('parent_package', should_parent_package)
+                    attrs['parent_package'] = should_parent_package
 
-                missing_node.append(missing_pkg_node)
+                generator.startElement('package', attrs)
+                generator.endElement('package')
+            generator.endElement('missing')
 
-            prj_node.append(missing_node)
+        generator.endElement('project')
+        generator.endDocument()
 
-        return prj_node
-
-    def _create_version_cache(self, cursor, projects = None):
-        """ Creates a cache containing version of all packages. """
+    def _create_version_cache(self, cursor):
+        """ Creates a cache containing version of packages. """
         # This helps us avoid doing many small SQL queries, which is really
-        # slow.
+        # slow: the versions of all packages of a project are loaded with one
+        # query, the first time a version in this project is needed. This
+        # way, writing the XML for a few projects only needs the versions of
+        # the projects they use.
         #
-        # The main difference is that we do one SQL query + many hash accesses,
-        # vs 2*(total number of packages in the database) SQL queries. On a
-        # test run, the difference results in ~1min15s vs ~5s. That's a 15x
-        # time win.
+        # The cursor used to create the XML is busy while we need versions,
+        # so we use another one.
         self._version_cache = {}
+        self._version_cursor = cursor.connection.cursor()
 
-        if not projects:
-            cursor.execute('''SELECT name FROM %(Project)s;''' % SQL_TABLES)
-            projects = [ row['name'] for row in cursor ]
-
-        for project in projects:
-            self._version_cache[project] = {}
-
-        cursor.execute('''SELECT A.name, A.version, B.name AS project
-                          FROM %(SrcPackage)s AS A, %(Project)s AS B
-                          WHERE A.project = B.id;''' % SQL_TABLES)
+    def _get_project_versions(self, project):
+        """ Return a dictionary with the versions of packages in project. """
+        self._version_cursor.execute('''SELECT A.name, A.version
+                                        FROM %(SrcPackage)s AS A, %(Project)s AS B
+                                        WHERE A.project = B.id AND B.name = ?;''' % SQL_TABLES,
+                                        (project,))
+        return dict([ (row['name'], row['version']) for row in self._version_cursor ])
 
-        for row in cursor:
-            self._version_cache[row['project']][row['name']] = row['version']
-
-    def _write_xml_for_project(self, cursor, project):
+    def _write_xml_for_project(self, cursor, project, old_digest = None):
         """ Writes the XML file for a project.
 
             Note that we don't touch the old file if the result is the same.
             This can be useful for browser cache.
 
-        """
-        node = self._get_project_node(cursor, project)
+            old_digest -- The digest of the current file, if known.
 
+            Return the digest of the file.
+
+        """
         filename = os.path.join(self.dest_dir, project + '.xml')
         tmpfilename = filename + '.tmp'
 
-        tree = ET.ElementTree(node)
-
         try:
-            tree.write(tmpfilename)
+            with open(tmpfilename, 'wb') as file:
+                writer = DigestWriter(file)
+                generator = XMLGenerator(writer, 'utf-8', short_empty_elements = True)
+                self._write_project(cursor, project, generator)
+            digest = writer.hexdigest()
 
             # keep the old file if there's no change (useful when downloaded
             # from the web to not re-download again the file)
             if os.path.exists(filename):
-                if filecmp.cmp(filename, tmpfilename, shallow = False):
+                if old_digest is None:
+                    old_digest = _get_file_digest(filename)
+                if old_digest == digest:
                     self._debug_print('XML for %s did not change' % project)
                     os.unlink(tmpfilename)
-                    return
+                    if not self._has_renditions(filename):
+                        self._write_renditions(filename, filename)
+                    return digest
 
+            # the renditions are written first: if we get interrupted, the
+            # digest of the XML file will still be the old one
+            self._write_renditions(tmpfilename, filename)
             os.rename(tmpfilename, filename)
         except Exception as e:
             if os.path.exists(tmpfilename):
                 os.unlink(tmpfilename)
             raise e
 
-    def run(self, cursor, changed_projects = None):
+        return digest
+
+    def _has_renditions(self, filename):
+        """ Return True if the renditions of the XML file filename exist. """
+        return os.path.exists(filename + '.gz') and os.path.exists(filename[:-len('.xml')] + '.json')
+
+    def _write_renditions(self, xmlfile, filename):
+        """ Write the compressed and JSON renditions of a XML file.
+
+            xmlfile -- The file containing the XML.
+            filename -- The final name of the XML file, used for the names of
+                        the renditions.
+
+        """
+        gzfilename = filename + '.gz'
+        jsonfilename = filename[:-len('.xml')] + '.json'
+
+        try:
+            # no name nor time in the header, so that the file only depends
+            # on the content
+            with open(xmlfile, 'rb') as src, open(gzfilename + '.tmp', 'wb') as file:
+                with gzip.GzipFile(filename = '', mode = 'wb', fileobj = file, mtime = 0) as dest:
+                    shutil.copyfileobj(src, dest)
+
+            with open(jsonfilename + '.tmp', 'w') as file:
+                _write_json_from_xml(xmlfile, file)
+
+            os.rename(gzfilename + '.tmp', gzfilename)
+            os.rename(jsonfilename + '.tmp', jsonfilename)
+        finally:
+            for tmpfilename in [ gzfilename + '.tmp', jsonfilename + '.tmp' ]:
+                if os.path.exists(tmpfilename):
+                    os.unlink(tmpfilename)
+
+    def _read_digests(self):
+        """ Return the digests of the XML files, as stored by
+            _write_digests().
+
+        """
+        digests = {}
+
+        filename = os.path.join(self.dest_dir, DIGESTS_FILE)
+        if not os.path.exists(filename):
+            return digests
+
+        # same format as md5sum
+        with open(filename) as file:
+            for line in file:
+                (digest, xmlfile) = line[:-1].split('  ', 1)
+                if xmlfile.endswith('.xml'):
+                    digests[xmlfile[:-len('.xml')]] = digest
+
+        return digests
+
+    def _write_digests(self, digests):
+        """ Store the digests of the XML files. """
+        filename = os.path.join(self.dest_dir, DIGESTS_FILE)
+        tmpfilename = filename + '.tmp'
+
+        with open(tmpfilename, 'w') as file:
+            for project in sorted(digests.keys()):
+                file.write('%s  %s.xml\n' % (digests[project], project))
+
+        os.rename(tmpfilename, filename)
+
+    def _create_pool(self, dbfile, projects):
+        """ Create the pool of processes used to write the XML files.
+
+            Return None if no pool should be used.
+
+        """
+        if not dbfile:
+            return None
+
+        processes = self._processes
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(projects))
+        if processes <= 1:
+            return None
+
+        self._debug_print('Using %d processes' % processes)
+
+        return multiprocessing.Pool(processes, _init_xml_worker, (self.dest_dir, self._debug, dbfile))
+
+    def run(self, cursor, changed_projects = None, dbfile = None):
         """ Creates the XML files for all projects.
 
             changed_projects -- The list of projects for which we need to
                                 generate a XML file. "None" means all projects.
+            dbfile -- The database file cursor is using. If set, XML files are
+                      written by a pool of processes reading this file, which
+                      must not have uncommitted changes.
 
         """
         if not cursor:
@@ -297,8 +508,9 @@ class InfoXml:
 
         cursor.execute('''SELECT name FROM %(Project)s;''' % SQL_TABLES)
         projects = [ row['name'] for row in cursor ]
+        all_projects = set(projects)
 
-        self._create_version_cache(cursor, projects)
+        self._create_version_cache(cursor)
 
         if changed_projects is not None:
             # We have a specific list of projects for which we need to create
@@ -306,36 +518,81 @@ class InfoXml:
             if not changed_projects:
                 return
 
-            # Get the list of projects containing a package which links to a
-            # changed project, or which has a a devel project that has changed
-            where = ' OR '.join([ 'B.link_project = ? OR B.devel_project = ?' for i in range(len(changed_projects)) ])
-            where_args = []
-            for changed_project in changed_projects:
-                where_args.append(changed_project)
-                where_args.append(changed_project)
-
-            mapping = SQL_TABLES.copy()
-            mapping['where'] = where
+            # Add the projects depending on a changed project: packages
+            # linking to it or using it as devel project, projects using it
+            # as parent, and devel projects of its packages. See
+            # ObsDb._update_project_dependencies().
+            changed_projects = set(changed_projects)
+            for changed_project in list(changed_projects):
+                cursor.execute('''SELECT dependent FROM project_dependency
+                                  WHERE project = ?;''', (changed_project,))
+                changed_projects.update([ project for (project,) in cursor ])
 
-            cursor.execute('''SELECT A.name FROM %(Project)s as A, %(SrcPackage)s as B
-                              WHERE A.id = B.project AND (%(where)s)
-                              GROUP BY A.name
-                              ;''' % mapping, where_args)
+            # removed projects are handled with remove_project()
+            projects = changed_projects.intersection(projects)
 
-            changed_projects = set(changed_projects)
-            for (project,) in cursor:
-                changed_projects.add(project)
+        old_digests = self._read_digests()
+        # forget about removed projects
+        digests = dict([ (project, digest) for (project, digest) in old_digests.items() if project in all_projects ])
 
-            projects = changed_projects
+        pool = self._create_pool(dbfile, projects)
 
-        for project in projects:
-            self._debug_print('Writing XML for %s' % project)
-            self._write_xml_for_project(cursor, project)
+        try:
+            if not pool:
+                for project in projects:
+                    self._debug_print('Writing XML for %s' % project)
+                    digests[project] = self._write_xml_for_project(cursor, project, old_digests.get(project))
+            else:
+                args = [ (project, old_digests.get(project)) for project in projects ]
+                for (project, digest) in pool.imap_unordered(_write_xml_for_project_in_worker, args):
+                    self._debug_print('Wrote XML for %s' % project)
+                    digests[project] = digest
+                pool.close()
+                pool.join()
+        except Exception as e:
+            if pool:
+                pool.terminate()
+                pool.join()
+            raise e
+        finally:
+            self._write_digests(digests)
 
     def remove_project(self, project):
-        filename = os.path.join(self.dest_dir, project + '.xml')
-        if os.path.exists(filename):
-            os.unlink(filename)
+        basename = os.path.join(self.dest_dir, project)
+        for filename in [ basename + '.xml', basename + '.xml.gz', basename + '.json' ]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+#######################################################################
+
+
+# InfoXml object and database cursor of the worker processes
+_worker_info = None
+_worker_cursor = None
+
+def _init_xml_worker(dest_dir, debug, dbfile):
+    """ Initialize a worker process of the pool used by InfoXml. """
+    global _worker_info
+    global _worker_cursor
+
+    db = sqlite3.connect('file:%s?mode=ro' % dbfile, uri = True)
+    db.row_factory = sqlite3.Row
+    db.text_factory = sqlite3.OptimizedUnicode
+    _worker_cursor = db.cursor()
+
+    _worker_info = InfoXml(dest_dir, debug)
+    _worker_info._create_version_cache(_worker_cursor)
+
+
+def _write_xml_for_project_in_worker(args):
+    """ Write the XML file for a project. This is run in worker processes.
+
+        Return the project and the digest of its file.
+
+    """
+    (project, old_digest) = args
+    return (project, _worker_info._write_xml_for_project(_worker_cursor, project, old_digest))
 
 
 #######################################################################
@@ -369,18 +626,13 @@ def main(args):
 
     try:
         info._create_version_cache(cursor)
-        node = info._get_project_node(cursor, project)
+        generator = XMLGenerator(sys.stdout, 'utf-8', short_empty_elements = True)
+        info._write_project(cursor, project, generator)
+        print()
     except InfoXmlException as e:
         print('Error while creating the XML for %s: %s' % (project, e), file=sys.stderr)
         sys.exit(1)
 
-    tree = ET.ElementTree(node)
-    try:
-        print(ET.tostring(tree, pretty_print = True))
-    except TypeError:
-        # pretty_print only works with lxml
-        tree.write(sys.stdout)
-
     cursor.close()
     db.close()
 
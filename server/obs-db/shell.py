@@ -91,6 +91,8 @@ class Runner:
         self._status['db'] = -1
         # Last hermes event recorded in xml (it cannot be greater than the db one)
         self._status['xml'] = -1
+        # Last run of the db recorded in xml
+        self._status['xml-run'] = -1
         # mtime of the configuration that was last known
         self._status['conf-mtime'] = -1
         # mtime of the openSUSE configuration that was last known
@@ -374,70 +376,26 @@ class Runner:
             return (False, changed)
 
 
-    def _run_xml(self, changed_projects = None):
+    def _run_xml(self, full = False):
         """ Update XML files.
 
-            changed_projects -- List of projects that we know will need an
-                                update
+            full -- Whether all XML files need to be written, instead of only
+                    the ones of projects that changed since last time
 
         """
         if self.conf.skip_xml:
             return
 
-        if self.conf.force_xml or self._status['xml'] == -1:
-            changed_projects = None
-        else:
-            # adds projects that have changed, according to hermes
-
-            if changed_projects is None:
-                changed_projects = set()
-            else:
-                changed_projects = set(changed_projects)
-
-            # Order of events does not matter here
-            events = self.hermes.get_events(self._status['xml'])
+        # the log of changes of the database tells us which projects changed
+        # since the last time we wrote XML files
+        (last_run, changed_projects) = self.db.get_changed_projects_since(self._status['xml-run'])
 
-            for event in events:
-                # ignore events that belong to a project we do not monitor
-                # (ie, there's no checkout)
-                project_dir = os.path.join(self._mirror_dir, event.project)
-                if not os.path.exists(project_dir):
-                    continue
-
-                # do not handle packages that had an issue while mirroring
-                if self._had_mirror_error(event.project, event.package):
-                    continue
-
-                if isinstance(event, hermes.HermesEventCommit):
-                    changed_projects.add(event.project)
-
-                elif isinstance(event, hermes.HermesEventProjectDeleted):
-                    # this will have been removed already, as stale data
-                    pass
-
-                elif isinstance(event, hermes.HermesEventPackageMeta):
-                    changed_projects.add(event.project)
-
-                elif isinstance(event, hermes.HermesEventPackageAdded):
-                    changed_projects.add(event.project)
-
-                elif isinstance(event, hermes.HermesEventPackageDeleted):
-                    changed_projects.add(event.project)
-
-                else:
-                    raise RunnerException('Unhandled Hermes event type by XML generator: %s' % event.__class__.__name__)
-
-            for (project, package) in self._catchup:
-                # do not handle packages that had an issue while mirroring
-                if self._had_mirror_error(project, package):
-                    continue
+        if full or self.conf.force_xml or self._status['xml'] == -1:
+            changed_projects = None
 
-                if package:
-                    changed_projects.add(project)
-                elif self.conf.allow_project_catchup:
-                    changed_projects.add(project)
+        self.xml.run(self.db.get_cursor(), changed_projects, self.db.get_filename_for_readers())
 
-        self.xml.run(self.db.get_cursor(), changed_projects)
+        self._status['xml-run'] = last_run
 
 
     def _remove_stale_data(self):
@@ -569,7 +527,7 @@ class Runner:
             projects_changed_upstream = []
 
         # Prepare the creation of xml files
-        self.xml = infoxml.InfoXml(self._xml_dir, self.conf.debug)
+        self.xml = infoxml.InfoXml(self._xml_dir, self.conf.debug, self.conf.processes)
 
         # Post-analysis to remove stale data, or enhance the database
         self._remove_stale_data()
@@ -580,12 +538,13 @@ class Runner:
             else:
                 self._debug_print('No need to run the post-analysis')
 
+        # Publish the database for the upload, now that it's complete
+        if not self.conf.skip_db or (self.db.exists() and not os.path.exists(self.db.get_snapshot_filename())):
+            self.db.publish_snapshot()
+
         # Create xml last, after we have all the right data
-        if db_full_rebuild:
-            # we want to generate all XML files for full rebuilds
-            self._run_xml()
-        else:
-            self._run_xml(projects_changed_upstream)
+        # (we want to generate all XML files for full rebuilds)
+        self._run_xml(db_full_rebuild)
 
         if not self.conf.skip_xml:
             # if we didn't skip the xml step, then we are at the same point as
@@ -0,0 +1,244 @@
+# vim: set ts=4 sw=4 et: coding=UTF-8
+
+#
+# Copyright (c) 2008-2009, Novell, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#  * Neither the name of the <ORGANIZATION> nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# (Licensed under the simplified BSD license)
+#
+# Authors: Vincent Untz <vuntz@opensuse.org>
+#
+
+import os
+import sys
+
+import hashlib
+import pickle
+import sqlite3
+import time
+
+import util
+
+# Number of new entries after which they are written to the cache
+FLUSH_SIZE = 1000
+
+#######################################################################
+
+class SpecCacheException(Exception):
+    pass
+
+#######################################################################
+
+def get_key(name, data):
+    """ Return the key to use in the cache for a spec file.
+
+        name -- The name of the source package. It is used as default value
+                for the %{name} macro, so it's part of the key.
+        data -- The content of the spec file, as bytes.
+
+    """
+    md5 = hashlib.md5()
+    md5.update(name.encode('utf-8'))
+    md5.update(b'\0')
+    md5.update(data)
+    return md5.hexdigest()
+
+
+#######################################################################
+
+class SpecCache:
+    """ Persistent cache of the analysis of spec files.
+
+        The analysis is pickled, and is opaque to this class. The cache is
+        emptied when the version of the parser changes, and the entries that
+        were used least recently are removed when there are more than
+        max_entries entries.
+
+        A cache opened read-only can be used from several processes at the
+        same time as the one writing to it. In that case, get() is the only
+        method that can be used.
+
+    """
+
+    def __init__(self, filename, parser_version, max_entries, readonly = False, debug = False):
+        self._filename = filename
+        self._parser_version = parser_version
+        self._max_entries = max_entries
+        self._readonly = readonly
+        self._debug = debug
+
+        # we'll store an int, so let's use an int right now
+        self._now = int(time.time())
+
+        # entries to add, and keys of entries that were used
+        self._added = {}
+        self._used = set()
+
+        self.db = None
+        self.cursor = None
+
+    def _debug_print(self, s):
+        """ Print s if debug is enabled. """
+        if self._debug:
+            print('SpecCache: %s' % s)
+
+    def __del__(self):
+        # needed for the commit
+        self.close()
+
+    def _open_db(self):
+        """ Open the cache, and sets up everything.
+
+            Return False if the cache cannot be used.
+
+        """
+        if self.db:
+            return True
+
+        if self._readonly:
+            if not os.path.exists(self._filename):
+                return False
+            self.db = sqlite3.connect('file:%s?mode=ro' % self._filename, uri = True)
+        else:
+            util.safe_mkdir_p(os.path.dirname(self._filename))
+            self.db = sqlite3.connect(self._filename)
+            # so that readers do not block the writer, and the other way round
+            self.db.execute('''PRAGMA journal_mode = WAL;''')
+
+        self.cursor = self.db.cursor()
+
+        try:
+            self.cursor.execute('''SELECT version FROM cache_version;''')
+            row = self.cursor.fetchone()
+            version = row and row[0]
+        except sqlite3.OperationalError:
+            version = None
+
+        if version == self._parser_version:
+            return True
+
+        if self._readonly:
+            self._debug_print('Cache has not been created with the current parser, ignoring it')
+            self.close()
+            return False
+
+        if version is not None:
+            self._debug_print('Parser version changed, emptying cache')
+
+        self.cursor.execute('''DROP TABLE IF EXISTS spec;''')
+        self.cursor.execute('''DROP TABLE IF EXISTS cache_version;''')
+        self.cursor.execute('''CREATE TABLE cache_version (
+            version INTEGER
+            );''')
+        self.cursor.execute('''INSERT INTO cache_version VALUES (?);''', (self._parser_version,))
+        self.cursor.execute('''CREATE TABLE spec (
+            key TEXT PRIMARY KEY,
+            analysis BLOB,
+            used INTEGER
+            );''')
+        self.cursor.execute('''CREATE INDEX spec_used ON spec (used);''')
+        self.db.commit()
+
+        return True
+
+    def close(self):
+        """ Write pending changes, and close the cache. """
+        if self.db and not self._readonly:
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print('Cannot save spec cache: %s' % e, file=sys.stderr)
+        if self.cursor:
+            self.cursor.close()
+            self.cursor = None
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def prepare(self):
+        """ Make sure the cache exists, and can be opened read-only by other processes. """
+        self._open_db()
+
+    def get(self, key):
+        """ Return the analysis stored for key, or None. """
+        if key in self._added:
+            return self._added[key]
+
+        if not self._open_db():
+            return None
+
+        self.cursor.execute('''SELECT analysis FROM spec WHERE key = ?;''', (key,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+
+        return pickle.loads(row[0])
+
+    def add(self, key, analysis):
+        """ Add analysis for key to the cache.
+
+            analysis -- Something that can be pickled. If None, this only marks
+                        the entry for key as used.
+
+        """
+        if self._readonly:
+            raise SpecCacheException('Trying to add an entry to the read-only spec cache %s.' % self._filename)
+
+        if analysis is None:
+            self._used.add(key)
+            return
+
+        self._added[key] = analysis
+        if len(self._added) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Write new entries to the cache, and remove old entries if needed. """
+        if not self._added and not self._used:
+            return
+
+        if not self._open_db():
+            return
+
+        self.cursor.executemany('''INSERT OR REPLACE INTO spec VALUES (?, ?, ?);''',
+                                [ (key, pickle.dumps(analysis, pickle.HIGHEST_PROTOCOL), self._now) for (key, analysis) in self._added.items() ])
+        self.cursor.executemany('''UPDATE spec SET used = ? WHERE key = ?;''',
+                                [ (self._now, key) for key in self._used ])
+
+        self._added = {}
+        self._used = set()
+
+        self.cursor.execute('''SELECT COUNT(*) FROM spec;''')
+        extra = self.cursor.fetchone()[0] - self._max_entries
+        if extra > 0:
+            self._debug_print('Removing %d old entries' % extra)
+            self.cursor.execute('''DELETE FROM spec WHERE key IN (
+                SELECT key FROM spec ORDER BY used LIMIT ?
+                );''', (extra,))
+
+        self.db.commit()
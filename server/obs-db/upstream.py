@@ -37,6 +37,7 @@
 import os
 import sys
 
+import hashlib
 import re
 import sqlite3
 import time
@@ -45,6 +46,10 @@ from posixpath import join as posixjoin
 
 import util
 
+# Version of the format of the database, stored as user_version. Increase
+# when changing the database, and add the migration to _sql_migrate().
+DB_VERSION = 2
+
 MATCH_CHANGE_NAME = ''
 # FIXME: we hardcode this list of branches since, well, there's no better way to do that :/
 BRANCHES_WITHOUT_PKG_MATCH = [ 'fallback', 'cpan', 'pypi' ]
@@ -70,6 +75,11 @@ class UpstreamDb:
         self.db = None
         self.cursor = None
 
+        # in-memory copy of the data used for lookups, see _get_matches() and
+        # _get_branch()
+        self._matches = None
+        self._branches = {}
+
     def _debug_print(self, s):
         """ Print s if debug is enabled. """
         if self._debug:
@@ -98,9 +108,49 @@ class UpstreamDb:
 
         if create:
             self._sql_setup()
+        else:
+            self._sql_migrate()
 
         return True
 
+    def _invalidate_snapshot(self):
+        """ Forget the in-memory copy of the data, after it changed. """
+        self._matches = None
+        self._branches = {}
+
+    def _get_matches(self):
+        """ Return a dictionary mapping source packages to upstream names.
+
+            The lookups are done for each source package, so they use a copy
+            of the data loaded once in memory, instead of SQL queries.
+
+        """
+        if self._matches is None:
+            intern = sys.intern
+            self.cursor.execute('''SELECT srcpackage, upstream FROM upstream_pkg_name_match;''')
+            self._matches = dict([ (intern(srcpackage), intern(upstream)) for (srcpackage, upstream) in self.cursor ])
+
+        return self._matches
+
+    def _get_branch(self, branch):
+        """ Return a dictionary mapping upstream names to (version, url) for
+            branch, or None if the branch is not known.
+
+            See _get_matches().
+
+        """
+        if branch not in self._branches:
+            (branch_id, branch_mtime) = self._get_branch_data(branch)
+            if not branch_id:
+                self._branches[branch] = None
+            else:
+                intern = sys.intern
+                self.cursor.execute('''SELECT name, version, url FROM upstream WHERE
+                    branch = ?;''', (branch_id,))
+                self._branches[branch] = dict([ (intern(name), (intern(version), url)) for (name, version, url) in self.cursor ])
+
+        return self._branches[branch]
+
     def _close_db(self):
         """ Closes the currently open database. """
         if self.cursor:
@@ -131,6 +181,59 @@ class UpstreamDb:
             branch TEXT,
             mtime INTEGER
             );''')
+        # the rest is created as for an old database
+        self._sql_migrate()
+
+    def _sql_create_indexes(self):
+        self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS upstream_pkg_name_match_srcpackage ON upstream_pkg_name_match (srcpackage);''')
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS upstream_pkg_name_match_upstream ON upstream_pkg_name_match (upstream);''')
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS upstream_pkg_name_match_updated ON upstream_pkg_name_match (updated);''')
+        self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS upstream_branch_name ON upstream (branch, name);''')
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS upstream_branch_updated ON upstream (branch, updated);''')
+        self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS branches_branch ON branches (branch);''')
+
+    def _sql_migrate(self):
+        """ Update a database created with an older version of the format. """
+        self.cursor.execute('''PRAGMA user_version;''')
+        version = self.cursor.fetchone()[0]
+        if version >= DB_VERSION:
+            return
+
+        self._debug_print('Migrating database from version %d to %d' % (version, DB_VERSION))
+
+        if version < 1:
+            # Nothing was unique before the indexes got added; the code never
+            # creates duplicates, but let's be safe.
+            self.cursor.execute('''DELETE FROM branches WHERE id NOT IN (
+                SELECT MAX(id) FROM branches GROUP BY branch
+                );''')
+            self.cursor.execute('''DELETE FROM upstream WHERE branch NOT IN (
+                SELECT id FROM branches
+                ) OR id NOT IN (
+                SELECT MAX(id) FROM upstream GROUP BY branch, name
+                );''')
+            self.cursor.execute('''DELETE FROM upstream_pkg_name_match WHERE id NOT IN (
+                SELECT MAX(id) FROM upstream_pkg_name_match GROUP BY srcpackage
+                );''')
+            self._sql_create_indexes()
+
+        if version < 2:
+            # Digest of the lines of each upstream name in branch files, and
+            # mtime of other files, to only handle what changed. See
+            # _update_upstream_data().
+            self.cursor.execute('''CREATE TABLE upstream_blocks (
+                branch INTEGER,
+                name TEXT,
+                digest TEXT,
+                UNIQUE (branch, name)
+                );''')
+            self.cursor.execute('''CREATE TABLE files (
+                name TEXT PRIMARY KEY,
+                mtime INTEGER
+                );''')
+
+        self.cursor.execute('''PRAGMA user_version = %d;''' % DB_VERSION)
+        self.db.commit()
 
     def _is_line_comment(self, line):
         return line[0] == '#' or line.strip() == ''
@@ -138,16 +241,30 @@ class UpstreamDb:
     def _update_upstream_pkg_name_match(self, matchfile):
         matchpath = os.path.join(self.dest_dir, matchfile)
 
-        self.cursor.execute('''SELECT * FROM upstream_pkg_name_match;''')
-        oldmatches = {}
-        for row in self.cursor:
-            oldmatches[row['srcpackage']] = (row['id'], row['upstream'])
+        self._removed_matches = []
 
         if not os.path.exists(matchpath):
             print('No upstream/package name match database available, keeping previous data.', file=sys.stderr)
             return
 
-        handled = []
+        # do not update anything if the file has not changed
+        new_mtime = os.stat(matchpath).st_mtime
+        self.cursor.execute('''SELECT mtime FROM files WHERE name = ?;''', (matchfile,))
+        row = self.cursor.fetchone()
+        if row and row['mtime'] >= new_mtime:
+            return
+        self.cursor.execute('''INSERT OR REPLACE INTO files VALUES (
+            ?, ?
+            );''', (matchfile, new_mtime))
+
+        self.cursor.execute('''SELECT * FROM upstream_pkg_name_match;''')
+        oldmatches = {}
+        for row in self.cursor:
+            oldmatches[row['srcpackage']] = (row['id'], row['upstream'])
+
+        handled = set()
+        added = []
+        updated = []
 
         file = open(matchpath)
         re_names = re.compile('^(.+):(.*)$')
@@ -177,32 +294,30 @@ class UpstreamDb:
                 if oldupstream != upstream:
                     # Note: we don't put the mtime here, since we use the
                     # updated time in get_changed_packages
-                    self.cursor.execute('''UPDATE upstream_pkg_name_match SET
-                        upstream = ?, updated = ?
-                        WHERE id = ?
-                        ;''',
-                        (upstream, self._now, id))
+                    updated.append((upstream, self._now, id))
                 del oldmatches[srcpackage]
-                handled.append(srcpackage)
+                handled.add(srcpackage)
             else:
                 # Add the entry
-                self.cursor.execute('''INSERT INTO upstream_pkg_name_match VALUES (
-                    NULL, ?, ?, ?
-                    );''',
-                    (srcpackage, upstream, self._now))
-                handled.append(srcpackage)
+                added.append((srcpackage, upstream, self._now))
+                handled.add(srcpackage)
 
         file.close()
 
+        self.cursor.executemany('''UPDATE upstream_pkg_name_match SET
+            upstream = ?, updated = ?
+            WHERE id = ?
+            ;''', updated)
+        self.cursor.executemany('''INSERT INTO upstream_pkg_name_match VALUES (
+            NULL, ?, ?, ?
+            );''', added)
+
         # Remove matches that were removed in the source file
         if len(oldmatches) > 0:
             ids = [ id for (id, oldupstream) in list(oldmatches.values()) ]
-            where = ' OR '.join([ 'id = ?' for i in range(len(ids)) ])
-            self.cursor.execute('''DELETE FROM upstream_pkg_name_match WHERE %s;''' % where, ids)
+            self.cursor.executemany('''DELETE FROM upstream_pkg_name_match WHERE id = ?;''', [ (id,) for id in ids ])
             #  will be used in get_changed_packages()
             self._removed_matches = list(oldmatches.keys())
-        else:
-            self._removed_matches = []
 
     def _get_upstream_name_branches(self):
         result = {}
@@ -233,6 +348,68 @@ class UpstreamDb:
         else:
             return ('', '')
 
+    def _parse_upstream_line(self, line, re_upstream_data):
+        """ Return (name, version, url) for a line of a branch file, or None
+            if the line is not valid.
+
+        """
+        line = line[:-1]
+
+        match = re_upstream_data.match(line)
+        if not match:
+            return None
+
+        (group, name, version, extra) = match.groups()
+
+        if group == 'fallback':
+            url = ''
+        elif group == 'nonfgo':
+            url = extra
+        elif group == 'upstream':
+            url = ''
+        elif group == 'cpan':
+            url = posixjoin('http://cpan.perl.org/CPAN/authors/id/', extra)
+        elif group == 'pypi':
+            url = extra
+        elif group == 'fgo':
+            versions = version.split('.')
+            if len(versions) == 1:
+                majmin = version
+            elif int(versions[0]) >= 40:
+                majmin = versions[0]
+            else:
+                majmin = versions[0] + '.' + versions[1]
+            url = 'https://download.gnome.org/sources/%s/%s/%s-%s.tar.xz' % (name, majmin, name, version)
+        else:
+            print('Unknown upstream group for metadata: %s (full line: \'%s\').' % (group, line), file=sys.stderr)
+            url = ''
+
+        return (name, version, url)
+
+    def _get_old_upstream_data(self, branch_id, names):
+        """ Return the rows of branch for upstream names, including the
+            "name|limit" names. If names is None, return all rows of branch.
+
+        """
+        olddata = {}
+
+        if names is None:
+            self.cursor.execute('''SELECT id, name, version, url FROM upstream WHERE
+                branch = ?;''', (branch_id,))
+            for row in self.cursor:
+                olddata[row['name']] = (row['id'], row['version'], row['url'])
+            return olddata
+
+        # '}' is the character after '|'
+        for name in names:
+            self.cursor.execute('''SELECT id, name, version, url FROM upstream WHERE
+                branch = ? AND (name = ? OR (name > ? AND name < ?));''',
+                (branch_id, name, name + '|', name + '}'))
+            for row in self.cursor:
+                olddata[row['name']] = (row['id'], row['version'], row['url'])
+
+        return olddata
+
     def _update_upstream_data(self, branch, upstream_name_branches):
         branch_path = os.path.join(self.dest_dir, branch)
 
@@ -261,10 +438,49 @@ class UpstreamDb:
                 mtime = ? WHERE id = ?;''',
                 (new_mtime, branch_id))
 
-        self.cursor.execute('''SELECT * FROM upstream WHERE branch = ?;''', (branch_id,))
-        olddata = {}
-        for row in self.cursor:
-            olddata[row['name']] = (row['id'], row['version'], row['url'])
+        # Group the lines by upstream name: the data of a name only depends on
+        # its lines (and on the "name|limit" names from the match file). We
+        # keep a digest of this for each name, so that only the names that
+        # changed since last time need to be parsed and written.
+        blocks = {}
+
+        file = open(branch_path)
+        for line in file:
+            if self._is_line_comment(line):
+                continue
+            fields = line.split(':', 3)
+            if len(fields) < 4:
+                continue
+            name = fields[1]
+            if name in blocks:
+                blocks[name].append(line)
+            else:
+                blocks[name] = [ line ]
+        file.close()
+
+        self.cursor.execute('''SELECT name, digest FROM upstream_blocks WHERE
+            branch = ?;''', (branch_id,))
+        olddigests = dict([ (row['name'], row['digest']) for row in self.cursor ])
+        # without digests, we cannot know what changed
+        full = len(olddigests) == 0
+
+        digests = {}
+        changed = []
+        for (name, lines) in blocks.items():
+            block = '%s\0%r' % (''.join(lines), upstream_name_branches.get(name))
+            digest = hashlib.md5(block.encode('utf-8')).hexdigest()
+            if olddigests.pop(name, None) != digest:
+                digests[name] = digest
+                changed.append(name)
+        # names that are not in the file anymore
+        removed = list(olddigests.keys())
+
+        self._debug_print('%d upstream name(s) changed in %s' % (len(changed) + len(removed), branch))
+
+        if full:
+            olddata = self._get_old_upstream_data(branch_id, None)
+        else:
+            olddata = self._get_old_upstream_data(branch_id, changed + removed)
 
         # upstream data, after we've converted the names to branch names if
         # needed. For instance, glib:1.2.10 will translate to the "glib|1.3"
@@ -274,70 +490,40 @@ class UpstreamDb:
 
         re_upstream_data = re.compile('^([^:]*):([^:]+):([^:]+):(.*)$')
 
-        file = open(branch_path)
-        while True:
-            line = file.readline()
-
-            if len(line) == 0:
-                break
-            if self._is_line_comment(line):
-                continue
-            line = line[:-1]
-
-            match = re_upstream_data.match(line)
-            if not match:
-                continue
-
-            name = match.group(2)
-            version = match.group(3)
-
-            if match.group(1) == 'fallback':
-                url = ''
-            elif match.group(1) == 'nonfgo':
-                url = match.group(4)
-            elif match.group(1) == 'upstream':
-                url = ''
-            elif match.group(1) == 'cpan':
-                url = posixjoin('http://cpan.perl.org/CPAN/authors/id/', match.group(4))
-            elif match.group(1) == 'pypi':
-                url = match.group(4)
-            elif match.group(1) == 'fgo':
-                versions = version.split('.')
-                if len(versions) == 1:
-                    majmin = version
-                elif int(versions[0]) >= 40:
-                    majmin = versions[0]
-                else:
-                    majmin = versions[0] + '.' + versions[1]
-                url = 'https://download.gnome.org/sources/%s/%s/%s-%s.tar.xz' % (name, majmin, name, version)
-            else:
-                print('Unknown upstream group for metadata: %s (full line: \'%s\').' % (match.group(1), line), file=sys.stderr)
-                url = ''
-
-            ignore = False
-            if name in real_upstream_data:
-                (current_version, current_url) = real_upstream_data[name]
-                if util.version_ge(current_version, version):
-                    ignore = True
-
-            if not ignore:
-                real_upstream_data[name] = (version, url)
-
-            # Now also fill data for 'glib|1.2.10' if it fits
-            if name in upstream_name_branches:
-                # name = 'glib', upstream_name_branch = 'glib|1.2.10'
-                # and limit = '1.2.10'
-                for (upstream_name_branch, limit) in upstream_name_branches[name]:
-                    if upstream_name_branch in real_upstream_data:
-                        (current_version, current_url) = real_upstream_data[upstream_name_branch]
-                        if util.version_ge(current_version, version):
+        for block_name in changed:
+            for line in blocks[block_name]:
+                parsed = self._parse_upstream_line(line, re_upstream_data)
+                if not parsed:
+                    continue
+
+                (name, version, url) = parsed
+
+                ignore = False
+                if name in real_upstream_data:
+                    (current_version, current_url) = real_upstream_data[name]
+                    if util.version_ge(current_version, version):
+                        ignore = True
+
+                if not ignore:
+                    real_upstream_data[name] = (version, url)
+
+                # Now also fill data for 'glib|1.2.10' if it fits
+                if name in upstream_name_branches:
+                    # name = 'glib', upstream_name_branch = 'glib|1.2.10'
+                    # and limit = '1.2.10'
+                    for (upstream_name_branch, limit) in upstream_name_branches[name]:
+                        if upstream_name_branch in real_upstream_data:
+                            (current_version, current_url) = real_upstream_data[upstream_name_branch]
+                            if util.version_ge(current_version, version):
+                                continue
+
+                        if util.version_ge(version, limit):
                             continue
 
-                    if util.version_ge(version, limit):
-                        continue
-
-                    real_upstream_data[upstream_name_branch] = (version, url)
+                        real_upstream_data[upstream_name_branch] = (version, url)
 
+        added = []
+        updated = []
 
         for (name, (version, url)) in list(real_upstream_data.items()):
             if name in olddata:
@@ -346,42 +532,38 @@ class UpstreamDb:
                 if oldversion != version or oldurl != url:
                     # Note: we don't put the mtime here, since we use the
                     # updated time in get_changed_packages
-                    self.cursor.execute('''UPDATE upstream SET
-                        version = ?, url = ?, updated = ?
-                        WHERE id = ?
-                        ;''',
-                        (version, url, self._now, id))
+                    updated.append((version, url, self._now, id))
                 del olddata[name]
             else:
                 # Add the entry
-                self.cursor.execute('''INSERT INTO upstream VALUES (
-                    NULL, ?, ?, ?, ?, ?
-                    );''',
-                    (branch_id, name, version, url, self._now))
+                added.append((branch_id, name, version, url, self._now))
 
-        file.close()
+        self.cursor.executemany('''UPDATE upstream SET
+            version = ?, url = ?, updated = ?
+            WHERE id = ?
+            ;''', updated)
+        self.cursor.executemany('''INSERT INTO upstream VALUES (
+            NULL, ?, ?, ?, ?, ?
+            );''', added)
 
         # Remove data that was removed in the source file
         if len(olddata) > 0:
             ids = [ id for (id, version, url) in list(olddata.values()) ]
-            # Delete by group of 50, since it once had to remove ~1800 items
-            # and it didn't work fine
-            chunk_size = 50
-            ids_len = len(ids)
-            for index in range(int(ids_len / chunk_size)):
-                chunk_ids = ids[index * chunk_size : (index + 1) * chunk_size]
-                where = ' OR '.join([ 'id = ?' for i in range(len(chunk_ids)) ])
-                self.cursor.execute('''DELETE FROM upstream WHERE %s;''' % where, chunk_ids)
-            remainder = ids_len % chunk_size
-            if remainder > 0:
-                chunk_ids = ids[- remainder:]
-                where = ' OR '.join([ 'id = ?' for i in range(len(chunk_ids)) ])
-                self.cursor.execute('''DELETE FROM upstream WHERE %s;''' % where, chunk_ids)
+            # One statement, executed for each id: a long chain of "id = ? OR"
+            # does not work fine when there are many items (it once had to
+            # remove ~1800 items)
+            self.cursor.executemany('''DELETE FROM upstream WHERE id = ?;''', [ (id,) for id in ids ])
 
             self._removed_upstream[branch] = list(olddata.keys())
         else:
             self._removed_upstream[branch] = []
 
+        self.cursor.executemany('''DELETE FROM upstream_blocks WHERE
+            branch = ? AND name = ?;''', [ (branch_id, name) for name in removed ])
+        self.cursor.executemany('''INSERT OR REPLACE INTO upstream_blocks VALUES (
+            ?, ?, ?
+            );''', [ (branch_id, name, digest) for (name, digest) in digests.items() ])
+
     def _remove_old_branches(self, branches):
         self.cursor.execute('''SELECT * FROM branches;''')
         for row in self.cursor:
@@ -389,6 +571,7 @@ class UpstreamDb:
             if not branch in branches:
                 id = row['id']
                 self.cursor.execute('''DELETE FROM upstream WHERE branch = ?;''', (id,))
+                self.cursor.execute('''DELETE FROM upstream_blocks WHERE branch = ?;''', (id,))
                 self.cursor.execute('''DELETE FROM branches WHERE id = ?;''', (id,))
 
     def _is_without_upstream(self, name):
@@ -398,26 +581,11 @@ class UpstreamDb:
         return False
 
     def _get_upstream_name(self, srcpackage):
-        self.cursor.execute('''SELECT upstream FROM upstream_pkg_name_match WHERE
-            srcpackage = ?;''', (srcpackage,))
-        row = self.cursor.fetchone()
-        if row:
-            return row[0]
-        else:
-            return ''
+        return self._get_matches().get(srcpackage, '')
 
     def _exist_in_branch_from_db(self, branch, name):
-        (branch_id, branch_mtime) = self._get_branch_data(branch)
-        if not branch_id:
-            return False
-
-        self.cursor.execute('''SELECT name FROM upstream WHERE
-            name = ? AND branch = ?;''', (name, branch_id))
-        row = self.cursor.fetchone()
-        if row:
-            return True
-        else:
-            return False
+        data = self._get_branch(branch)
+        return data is not None and name in data
 
     def exists_in_branches(self, branches, srcpackage):
         if not self._open_db():
@@ -437,17 +605,11 @@ class UpstreamDb:
         return False
 
     def _get_data_from_db(self, branch, name):
-        (branch_id, branch_mtime) = self._get_branch_data(branch)
-        if not branch_id:
+        data = self._get_branch(branch)
+        if data is None:
             return ('', '')
 
-        self.cursor.execute('''SELECT version, url FROM upstream WHERE
-            name = ? AND branch = ?;''', (name, branch_id))
-        row = self.cursor.fetchone()
-        if row:
-            return (row[0], row[1])
-        else:
-            return ('', '')
+        return data.get(name, ('', ''))
 
     def get_upstream_data(self, branches, srcpackage):
         if not self._open_db():
@@ -489,6 +651,13 @@ class UpstreamDb:
         return max(max_match, max_data)
 
     def get_changed_packages(self, old_mtime):
+        """ Return the source packages affected by changes since old_mtime.
+
+            Return a dictionary mapping branches (or MATCH_CHANGE_NAME, for
+            changes in the upstream/package name match database) to sets of
+            source package names.
+
+        """
         if not self._open_db():
             return {}
 
@@ -496,43 +665,33 @@ class UpstreamDb:
 
         self.cursor.execute('''SELECT srcpackage FROM upstream_pkg_name_match
                     WHERE updated > ?;''', (old_mtime,))
-        changed[MATCH_CHANGE_NAME] = [ row['srcpackage'] for row in self.cursor ]
-        changed[MATCH_CHANGE_NAME].extend(self._removed_matches)
+        changed[MATCH_CHANGE_NAME] = set([ row['srcpackage'] for row in self.cursor ])
+        changed[MATCH_CHANGE_NAME].update(self._removed_matches)
 
         self.cursor.execute('''SELECT id, branch FROM branches;''')
-        branches = []
-        for (id, branch) in self.cursor:
-            branches.append((id, branch))
-            if branch in self._removed_upstream:
-                changed[branch] = self._removed_upstream[branch]
-            else:
-                changed[branch] = []
-
-        # Doing a joint query is slow, so we do a cache first
-        match_cache = {}
-        self.cursor.execute('''SELECT srcpackage, upstream FROM upstream_pkg_name_match;''')
-        for (srcpackage, upstream) in self.cursor:
-            if upstream in match_cache:
-                match_cache[upstream].append(srcpackage)
-            else:
-                match_cache[upstream] = [ srcpackage ]
-
+        branches = self.cursor.fetchall()
 
         for (id, branch) in branches:
-            # Joint query that is slow
-            #self.cursor.execute('''SELECT A.srcpackage
-            #            FROM upstream_pkg_name_match as A, upstream as B
-            #            WHERE B.updated > ? AND B.name = A.upstream AND B.branch = ?;''', (old_mtime, id))
-            #changed[branch].extend([ row['srcpackage'] for row in self.cursor ])
-            self.cursor.execute('''SELECT name FROM upstream
-                        WHERE updated > ? AND branch = ?;''', (old_mtime, id))
+            changed[branch] = set(self._removed_upstream.get(branch, []))
+
+            # Both queries use the (branch, updated) index on upstream, and the
+            # join uses the index on the upstream names of the matches.
             if branch in BRANCHES_WITHOUT_PKG_MATCH:
-                for (name,) in self.cursor:
-                    changed[branch].append(name)
+                self.cursor.execute('''SELECT name FROM upstream
+                            WHERE branch = ? AND updated > ?;''', (id, old_mtime))
             else:
-                for (name,) in self.cursor:
-                    if name in match_cache:
-                        changed[branch].extend(match_cache[name])
+                self.cursor.execute('''SELECT A.srcpackage
+                            FROM upstream as B, upstream_pkg_name_match as A
+                            WHERE B.branch = ? AND B.updated > ? AND A.upstream = B.name;''', (id, old_mtime))
+            changed[branch].update([ name for (name,) in self.cursor ])
+
+            # Removed entries are upstream names: also look at the source
+            # packages using them.
+            if branch not in BRANCHES_WITHOUT_PKG_MATCH:
+                for name in self._removed_upstream.get(branch, []):
+                    self.cursor.execute('''SELECT srcpackage FROM upstream_pkg_name_match
+                                WHERE upstream = ?;''', (name,))
+                    changed[branch].update([ srcpackage for (srcpackage,) in self.cursor ])
 
         self._debug_print('%d upstream(s) changed' % sum([ len(i) for i in list(changed.values()) ]))
 
@@ -543,6 +702,8 @@ class UpstreamDb:
         return changed
 
     def update(self, project_configs, rebuild = False):
+        self._invalidate_snapshot()
+
         if rebuild:
             self._close_db()
             if os.path.exists(self._dbfile):
@@ -35,8 +35,13 @@
 #
 
 import os
+import sys
 
 import errno
+import functools
+import re
+import resource
+import time
 
 def safe_mkdir(dir):
     if not dir:
@@ -66,46 +71,75 @@ def safe_unlink(filename):
         if e.errno != errno.ENOENT:
             raise e
 
+def get_memory_usage():
+    """ Return the current and the peak resident memory of the process, in kB.
+
+        The current memory is -1 if it cannot be known.
+
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    try:
+        statm = open('/proc/self/statm')
+        pages = int(statm.read().split()[1])
+        statm.close()
+        current = pages * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        current = -1
+
+    return (current, peak)
+
 
 ########################################################
 
 
-# comes from convert-to-tarball.py
-def _strict_bigger_version(a, b):
-    a_nums = a.split('.')
-    b_nums = b.split('.')
-    num_fields = min(len(a_nums), len(b_nums))
-    for i in range(0,num_fields):
-        if   int(a_nums[i]) > int(b_nums[i]):
-            return a
-        elif int(a_nums[i]) < int(b_nums[i]):
-            return b
-    if   len(a_nums) > len(b_nums):
-        return a
-    elif len(a_nums) < len(b_nums):
-        return b
-    else:
-        return None
+# Number of parsed versions kept by version_key(). Versions are compared in
+# tight loops (all the upstream data, for instance), with a limited number of
+# different versions.
+VERSION_KEY_CACHE_SIZE = 100000
+
+_re_version_part = re.compile('([0-9]*)(.*)', re.DOTALL)
+
+@functools.lru_cache(maxsize = VERSION_KEY_CACHE_SIZE)
+def version_key(version):
+    """ Return a key for version, so that versions can be compared by
+        comparing their keys.
+
+        We compare versions this way (with examples):
+          + 0.3 and 0.3.1:
+            0.3.1 wins: 0.3 == 0.3 and 0.3.1 has another digit
+          + 0.3-1 and 0.3-2:
+            0.3-2 wins: 0.3 == 0.3 and 1 < 2
+          + 0.3.1-1 and 0.3-2:
+            0.3.1-1 wins: 0.3.1 > 0.3
+          + 0.3 and 0.3a, or 0.3a and 0.3b:
+            the second one wins: parts are compared by their leading number,
+            and then by what follows it
+          + 0.3.a and 0.3.0:
+            0.3.0 wins: a part without leading number is older than a part
+            with one
+
+        The key is computed once for each version, and kept in a cache.
+
+    """
+    key = []
+    for field in version.split('-'):
+        parts = []
+        for part in field.split('.'):
+            if part.isdigit() and part.isascii():
+                parts.append((1, int(part), ''))
+                continue
+            (number, rest) = _re_version_part.match(part).groups()
+            if number:
+                parts.append((1, int(number), rest))
+            else:
+                parts.append((0, 0, rest))
+        key.append(tuple(parts))
+    return tuple(key)
 
 
 def bigger_version(a, b):
-    # We compare versions this way (with examples):
-    #   + 0.3 and 0.3.1:
-    #     0.3.1 wins: 0.3 == 0.3 and 0.3.1 has another digit
-    #   + 0.3-1 and 0.3-2:
-    #     0.3-2 wins: 0.3 == 0.3 and 1 < 2
-    #   + 0.3.1-1 and 0.3-2:
-    #     0.3.1-1 wins: 0.3.1 > 0.3
-    a_nums = a.split('-')
-    b_nums = b.split('-')
-    num_fields = min(len(a_nums), len(b_nums))
-    for i in range(0,num_fields):
-        bigger = _strict_bigger_version(a_nums[i], b_nums[i])
-        if   bigger == a_nums[i]:
-            return a
-        elif bigger == b_nums[i]:
-            return b
-    if len(a_nums) > len(b_nums):
+    if version_key(a) > version_key(b):
         return a
     else:
         return b
@@ -115,12 +149,76 @@ def version_gt(a, b):
     if a == b:
         return False
 
-    bigger = bigger_version(a, b)
-    return a == bigger
+    return version_key(a) > version_key(b)
 
 def version_ge(a, b):
     if a == b:
         return True
 
-    bigger = bigger_version(a, b)
-    return a == bigger
+    return version_key(a) >= version_key(b)
+
+
+########################################################
+
+
+# (a, b, expected result of the comparison of a with b)
+_VERSION_TESTS = [
+    ('1.0', '1.0', 0),
+    ('1.0', '1.00', 0),
+    ('0.3.1', '0.3', 1),
+    ('0.3-2', '0.3-1', 1),
+    ('0.3.1-1', '0.3-2', 1),
+    ('0.3-1', '0.3', 1),
+    ('1.10', '1.9', 1),
+    ('1.10', '1.9.1', 1),
+    ('2.0', '1.99.99', 1),
+    ('1.2.3', '1.2.3', 0),
+    ('0.3a', '0.3', 1),
+    ('0.3b', '0.3a', 1),
+    ('0.4', '0.3b', 1),
+    ('0.3.0', '0.3.a', 1),
+    ('0.3.b', '0.3.a', 1),
+    ('1.0', '', 1),
+    ('1.0', '--', 1),
+    ('2013.1', '2.40', 1),
+]
+
+def main(args):
+    failed = 0
+    for (a, b, expected) in _VERSION_TESTS:
+        for (x, y, result) in [ (a, b, expected), (b, a, -expected) ]:
+            got = (version_key(x) > version_key(y)) - (version_key(x) < version_key(y))
+            ok = got == result and version_gt(x, y) == (result > 0) and version_ge(x, y) == (result >= 0)
+            if not ok:
+                failed += 1
+                print('FAIL: %s vs %s: expected %d, got %d' % (x, y, result, got))
+    print('%d/%d version comparisons passed' % (len(_VERSION_TESTS) * 2 - failed, len(_VERSION_TESTS) * 2))
+
+    # micro-benchmark: comparisons of n versions with each other, parsing
+    # the versions for each comparison, and using the cache
+    n = 300
+    versions = [ '%d.%d.%d-%d' % (i % 7, i % 13, i, i % 3) for i in range(n) ]
+    parse = version_key.__wrapped__
+    start = time.time()
+    for a in versions:
+        for b in versions:
+            a == b or parse(a) >= parse(b)
+    elapsed = time.time() - start
+    print('without cache: %.2f us per comparison' % (elapsed * 1000000 / (n * n)))
+    version_key.cache_clear()
+    start = time.time()
+    for a in versions:
+        for b in versions:
+            version_ge(a, b)
+    elapsed = time.time() - start
+    print('with cache: %.2f us per comparison' % (elapsed * 1000000 / (n * n)))
+
+    return failed == 0
+
+
+if __name__ == '__main__':
+    try:
+        if not main(sys.argv):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -36,6 +36,7 @@
 
 import os
 
+import shutil
 import sqlite3
 import time
 
@@ -91,6 +92,94 @@ class ObsDbException(Exception):
 #######################################################################
 
 
+def apply_delta(delta_file, db_file = None):
+    ''' Apply a delta created by the obs-db scripts to the database.
+
+        The delta is applied to a copy of the database, which then replaces
+        it, so the database is never seen half-updated. ObsDbException is
+        raised if the delta was not created against this database: a full
+        upload is then needed.
+
+    '''
+    if not db_file:
+        db_file = _db_file
+
+    if not os.path.exists(db_file):
+        raise ObsDbException('Database %s unavailable' % (os.path.abspath(db_file)))
+
+    tmp_file = db_file + '.delta'
+    shutil.copyfile(db_file, tmp_file)
+
+    conn = sqlite3.connect(tmp_file)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''ATTACH DATABASE ? AS delta;''', (delta_file,))
+
+        cursor.execute('''SELECT base_token, token, major, minor, projects, srcpackages FROM delta.delta_info;''')
+        row = cursor.fetchone()
+        if not row:
+            raise ObsDbException('Delta %s is not valid' % delta_file)
+        (base_token, token, major, minor, projects, srcpackages) = row
+
+        cursor.execute('''SELECT major, minor FROM db_version;''')
+        if cursor.fetchone() != (major, minor):
+            raise ObsDbException('Delta is for another version of the database')
+
+        try:
+            cursor.execute('''SELECT token FROM snapshot;''')
+            row = cursor.fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if not row or row[0] != base_token:
+            raise ObsDbException('Delta is not based on the current database')
+
+        # remove everything related to the changed keys, and then add what
+        # they are now
+        srcpackage_ids = '''SELECT A.id FROM %(srcpackage)s AS A, %(project)s AS B, delta.delta_keys AS K
+                            WHERE A.project = B.id AND B.name = K.project AND A.name = K.package''' % { 'srcpackage': table_srcpackage, 'project': table_project }
+        for table in [ table_package, table_source, table_patch, table_file, table_rpmlint ]:
+            cursor.execute('''DELETE FROM %s WHERE srcpackage IN (%s);''' % (table, srcpackage_ids))
+        cursor.execute('''DELETE FROM %s WHERE id IN (%s);''' % (table_srcpackage, srcpackage_ids))
+        cursor.execute('''DELETE FROM %s WHERE name IN (
+                          SELECT project FROM delta.delta_keys WHERE package = ''
+                          );''' % table_project)
+
+        for table in [ table_project, table_srcpackage, table_package, table_source, table_patch, table_file, table_rpmlint ]:
+            cursor.execute('''INSERT INTO main.%s SELECT * FROM delta.%s;''' % (table, table))
+
+        # the log of changes, for the cache of XML files
+        cursor.execute('''DELETE FROM run;''')
+        cursor.execute('''INSERT INTO run SELECT * FROM delta.run;''')
+        cursor.execute('''DELETE FROM changes WHERE run NOT IN (SELECT id FROM run);''')
+        cursor.execute('''INSERT OR IGNORE INTO changes SELECT * FROM delta.changes;''')
+
+        # the dependencies between projects, coming from the changed projects
+        cursor.execute('''DELETE FROM project_dependency WHERE origin IN (SELECT project FROM delta.delta_keys);''')
+        cursor.execute('''INSERT INTO project_dependency SELECT * FROM delta.project_dependency;''')
+
+        cursor.execute('''SELECT COUNT(*) FROM %s;''' % table_project)
+        real_projects = cursor.fetchone()[0]
+        cursor.execute('''SELECT COUNT(*) FROM %s;''' % table_srcpackage)
+        real_srcpackages = cursor.fetchone()[0]
+        if (real_projects, real_srcpackages) != (projects, srcpackages):
+            raise ObsDbException('Delta does not lead to the expected database')
+
+        cursor.execute('''UPDATE snapshot SET token = ?;''', (token,))
+        conn.commit()
+        cursor.execute('''DETACH DATABASE delta;''')
+        cursor.close()
+        conn.close()
+    except:
+        conn.close()
+        os.unlink(tmp_file)
+        raise
+
+    os.rename(tmp_file, db_file)
+
+
+#######################################################################
+
+
 class ObsDb:
 
     def __init__(self):
@@ -121,5 +210,33 @@ class ObsDb:
     def get_db_version(self):
         return (self.db_major, self.db_minor)
 
+    def get_changed_projects_since(self, run):
+        ''' Return the projects that changed after the run with id run.
+
+            Return a tuple (last_run, projects): last_run is the id of the
+            last run in the database, and projects is None if the changes
+            since run are not known (everything should then be considered as
+            changed).
+
+        '''
+        try:
+            self.cursor.execute('''SELECT MAX(id) FROM run WHERE finished = 1;''')
+            last_run = self.cursor.fetchone()[0]
+            self.cursor.execute('''SELECT MIN(id) FROM run;''')
+            first_run = self.cursor.fetchone()[0]
+        except sqlite3.OperationalError:
+            # database created before the log of changes existed
+            return (-1, None)
+
+        if last_run is None:
+            return (-1, None)
+        if run < first_run or run > last_run:
+            return (last_run, None)
+
+        self.cursor.execute('''SELECT DISTINCT project FROM changes WHERE run > ? AND run <= ?;''', (run, last_run))
+        projects = set([ row['project'] for row in self.cursor ])
+
+        return (last_run, projects)
+
     def cursor_new(self):
         return self.conn.cursor()
@@ -53,6 +53,11 @@ import libdbcore
 
 # Directory containing XML caches for projects data
 XML_CACHE_DIR = os.path.join(config.datadir, 'xml')
+# File in the cache directory containing the last run of the database that
+# the cache knows about
+CACHE_RUN_FILE = 'last-run'
+# Maximum number of values in a "IN (...)" SQL expression
+CHUNK_SIZE = 400
 
 
 #######################################################################
@@ -73,6 +78,7 @@ class InfoXmlException(Exception):
 class InfoXml:
 
     version_query = 'SELECT %s.version FROM %s, %s WHERE %s.name = ? AND %s.name = ? AND %s.project = %s.id ;' % (libdbcore.table_srcpackage, libdbcore.table_project, libdbcore.table_srcpackage, libdbcore.table_project, libdbcore.table_srcpackage, libdbcore.table_srcpackage, libdbcore.table_project)
+    project_versions_query = 'SELECT %s.name, %s.version FROM %s, %s WHERE %s.name = ? AND %s.project = %s.id ;' % (libdbcore.table_srcpackage, libdbcore.table_srcpackage, libdbcore.table_project, libdbcore.table_srcpackage, libdbcore.table_project, libdbcore.table_srcpackage, libdbcore.table_project)
 
     def __init__(self, obsdb = None):
         if not obsdb:
@@ -96,16 +102,23 @@ class InfoXml:
         else:
             return None
 
+    def _find_versions_for_project_sql(self, project):
+        self.cursor_helper.execute(self.project_versions_query, (project,))
+        versions = {}
+        for row in self.cursor_helper:
+            versions[row['name']] = row['version']
+        return versions
+
     def _find_version_for(self, project, package):
         # We have a cache here because we want to avoid doing SQL queries.
         # See also comment in create_cache()
         if self.version_cache is None:
             return self._find_version_for_sql(project, package)
 
-        try:
-            return self.version_cache[project][package]
-        except KeyError:
-            return None
+        if not self.version_cache.has_key(project):
+            self.version_cache[project] = self._find_versions_for_project_sql(project)
+
+        return self.version_cache[project].get(package)
 
     def _get_package_node_from_row(self, row, ignore_upstream, default_parent_project):
         name = row['name']
@@ -289,7 +302,55 @@ class InfoXml:
         except:
             pass
 
+    def _read_cache_run(self):
+        path = os.path.join(self.cache_dir, CACHE_RUN_FILE)
+
+        try:
+            if os.path.exists(path):
+                return int(open(path).read().strip())
+        except:
+            pass
+
+        return -1
+
+    def _write_cache_run(self, run):
+        path = os.path.join(self.cache_dir, CACHE_RUN_FILE)
+
+        fout = open(path + '.tmp', 'w')
+        fout.write('%d\n' % run)
+        fout.close()
+        os.rename(path + '.tmp', path)
+
+    def _invalidate_cache(self, projects, changed_projects):
+        # Projects depending on a changed project also need a new cache:
+        # packages linking to it or using it as devel project, projects using
+        # it as parent, and devel projects of its packages (for the list of
+        # missing packages). This is computed by the obs-db scripts.
+        invalid = set(changed_projects)
+        changed_projects = list(changed_projects)
+        for index in range(0, len(changed_projects), CHUNK_SIZE):
+            chunk = changed_projects[index:index + CHUNK_SIZE]
+            marks = ', '.join([ '?' ] * len(chunk))
+            self.cursor.execute('''SELECT DISTINCT dependent FROM project_dependency WHERE project IN (%s);''' % marks, chunk)
+            invalid.update([ row['dependent'] for row in self.cursor ])
+
+        # Also remove the cache of projects that do not exist anymore
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.xml') and file[:-len('.xml')] not in projects:
+                invalid.add(file[:-len('.xml')])
+
+        for project in invalid:
+            cache = self._get_cache_path(project)
+            if os.path.exists(cache):
+                os.unlink(cache)
+
     def create_cache(self, verbose = False):
+        ''' Write the cache of projects.
+
+            If the cache already exists, only the cache of projects that
+            changed since it was written is updated.
+
+        '''
         try:
             if not os.path.exists(self.cache_dir):
                 os.makedirs(self.cache_dir)
@@ -303,25 +364,28 @@ class InfoXml:
         # We need to first take all names because cursor will be re-used
         projects = [ row['name'] for row in self.cursor ]
 
-        # Create the cache containing version of all packages. This will help
-        # us avoid doing many small SQL queries, which is really slow.
-        #
-        # The main difference is that we do one SQL query + many hash accesses,
-        # vs 2*(total number of packages in the database) SQL queries. On a
-        # test run, the difference results in ~1min15s vs ~5s. That's a 15x
-        # time win.
+        (last_run, changed_projects) = self.obsdb.get_changed_projects_since(self._read_cache_run())
+        if changed_projects is None:
+            changed_projects = projects
+        self._invalidate_cache(set(projects), changed_projects)
+
+        # Enable the cache containing version of packages. This will help us
+        # avoid doing many small SQL queries, which is really slow: the
+        # versions of all packages of a project are loaded with one SQL query,
+        # the first time we need a version from this project. When only a few
+        # projects changed, we only load the versions of the projects they
+        # use, instead of all versions in the database.
         self.version_cache = {}
-        for project in projects:
-            self.version_cache[project] = {}
-        self.cursor.execute('''SELECT A.name, A.version, B.name AS project FROM %s AS A, %s AS B WHERE A.project = B.id;''' % (libdbcore.table_srcpackage, libdbcore.table_project))
-        for row in self.cursor:
-            self.version_cache[row['project']][row['name']] = row['version']
 
         for project in projects:
+            if os.path.exists(self._get_cache_path(project)):
+                continue
             self.get_project_node(project, write_cache = True)
             if verbose:
                 print 'Wrote cache for %s.' % project
 
+        self._write_cache_run(last_run)
+
 #if __name__ == '__main__':
 #    try:
 #        info = InfoXml()
@@ -0,0 +1,90 @@
+# vim: set ts=4 sw=4 et: coding=UTF-8
+
+#
+# Copyright (c) 2008-2010, Novell, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#  * Neither the name of the <ORGANIZATION> nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# (Licensed under the simplified BSD license)
+#
+# Authors: Vincent Untz <vuntz@opensuse.org>
+#
+
+import re
+
+# This follows the rules of version_key() in the util.py module of obs-db,
+# so that versions are compared the same way everywhere.
+
+# Number of parsed versions kept by version_key()
+VERSION_KEY_CACHE_SIZE = 10000
+
+_re_version_part = re.compile('([0-9]*)(.*)', re.DOTALL)
+
+_version_keys = {}
+
+def version_key(version):
+    """ Return a key for version, so that versions can be compared by
+        comparing their keys.
+
+        Versions are split in fields on '-' and in parts on '.'. Parts are
+        compared by their leading number, and then by what follows it; a
+        part without leading number is older than a part with one. When
+        everything else is equal, the version with more parts (or fields)
+        wins.
+
+        The key is computed once for each version, and kept in a cache.
+
+    """
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+
+    key = []
+    for field in version.split('-'):
+        parts = []
+        for part in field.split('.'):
+            (number, rest) = _re_version_part.match(part).groups()
+            if number:
+                parts.append((1, int(number), rest))
+            else:
+                parts.append((0, 0, rest))
+        key.append(tuple(parts))
+    key = tuple(key)
+
+    if len(_version_keys) >= VERSION_KEY_CACHE_SIZE:
+        _version_keys.clear()
+    _version_keys[version] = key
+
+    return key
+
+
+def version_gt(a, b):
+    if a == b:
+        return False
+
+    return version_key(a) > version_key(b)
@@ -45,11 +45,15 @@ import socket
 import shutil
 
 from libdissector import config
+from libdissector import libdbcore
 from libdissector import libinfoxml
 
 # Upload with:
 # # Upload the db
 # curl --silent --show-error -F dbfile=@/path/to/obs.db http://server/path/obs-upload.py
+# # Upload a delta against the previously uploaded db; if the output does not
+# # start with 'Delta applied', the full db should be uploaded instead
+# curl --silent --show-error -F destfile=obs-delta.db -F dbfile=@/path/to/obs-delta.db http://server/path/obs-upload.py
 
 UPLOAD_DIR = config.datadir
 AUTHORIZED_IPS = config.upload_authorized_ips
@@ -127,6 +131,22 @@ def save_uploaded_file (form, form_field, upload_dir, filename):
 
     return ret
 
+def apply_delta(filename):
+    path = os.path.join(UPLOAD_DIR, filename)
+
+    try:
+        libdbcore.apply_delta(path)
+    except Exception, e:
+        print 'Delta not applied: %s' % str(e)
+        log_error ('Delta not applied: %s' % str(e))
+        return False
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+    print 'Delta applied'
+    return True
+
 def create_cache(filename):
     if filename != 'obs.db':
         return
@@ -161,6 +181,13 @@ def create_cache(filename):
     #    return
 
     try:
+        # Start from the current cache, so that only the projects that changed
+        # are written again
+        if os.path.exists(tmp_cache_dir):
+            shutil.rmtree(tmp_cache_dir)
+        if os.path.exists(cache_dir):
+            shutil.copytree(cache_dir, tmp_cache_dir)
+
         info.create_cache()
 
         # First move the old cache away before installing the new one (fast
@@ -191,7 +218,7 @@ print 'content-type: text/html\n'
 form = cgi.FieldStorage()
 if form.has_key('destfile'):
     dest = form.getfirst('destfile')
-    if not dest in ['obs.db']:
+    if not dest in ['obs.db', 'obs-delta.db']:
         print 'Unknown file'
         sys.exit(0)
 else:
@@ -208,7 +235,10 @@ for host in AUTHORIZED_HOSTS:
 
 if os.environ['REMOTE_ADDR'] in authorized_ips:
     ret = save_uploaded_file (form, 'dbfile', UPLOAD_DIR, dest)
-    if ret and dest in ['obs.db']:
+    if ret and dest == 'obs-delta.db':
+        if apply_delta(dest):
+            create_cache('obs.db')
+    elif ret and dest in ['obs.db']:
         create_cache(dest)
 else:
     print 'Unauthorized access'
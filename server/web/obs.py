@@ -46,6 +46,7 @@ from libdissector import config
 from libdissector import libdbhtml
 from libdissector import libhttp
 from libdissector import libinfoxml
+from libdissector import libversion
 
 if config.cgitb:
     import cgitb; cgitb.enable()
@@ -54,31 +55,6 @@ if config.cgitb:
 #######################################################################
 
 
-def compare_versions_a_gt_b (a, b):
-    split_a = a.split('.')
-    split_b = b.split('.')
-    if len(split_a) != len(split_b):
-        return a > b
-    for i in range(len(split_a)):
-        try:
-            int_a = int(split_a[i])
-            int_b = int(split_b[i])
-            if int_a > int_b:
-                return True
-            if int_b > int_a:
-                return False
-        except ValueError:
-            if split_a[i] > split_b[i]:
-                return True
-            if split_b[i] > split_a[i]:
-                return False
-
-    return False
-
-
-#######################################################################
-
-
 def colortype_to_style(colortype):
     if colortype is None:
         return ''
@@ -198,8 +174,8 @@ def get_colortype(package, parent, use_upstream):
 
     if use_upstream:
         if package.upstream_version not in [ '', '--' ]:
-            newer_than_parent = package.parent_version == '--' or compare_versions_a_gt_b(package.upstream_version, package.parent_version)
-            newer = compare_versions_a_gt_b(package.upstream_version, package.version)
+            newer_than_parent = package.parent_version == '--' or libversion.version_gt(package.upstream_version, package.parent_version)
+            newer = libversion.version_gt(package.upstream_version, package.version)
             if newer and newer_than_parent:
                 color = 'new-upstream'
 